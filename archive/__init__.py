@@ -0,0 +1,6 @@
+"""
+Utilities for reading and maintaining the traffic archive written by Wumpus In The Middle.
+
+This package is shared by the recorder, the exporters and archive_tool.py,
+so it must only depend on the standard library; mitmproxy's bundled Python can't import much else.
+"""
@@ -0,0 +1,29 @@
+"""
+Utilities to register archive maintenance commands for archive_tool.py.
+Works like exporters/registry.py.
+"""
+
+import argparse
+
+parser = argparse.ArgumentParser(description="Maintain a traffic archive recorded by Wumpus In The Middle.")
+subparsers = parser.add_subparsers(required=True, title="Available commands", metavar="<command>")
+
+
+def register_command(name: str, command_args, description: str = ""):
+    def archive_command_decorator(func):
+        subcommand_parser = subparsers.add_parser(
+            name,
+            help=description,
+            description=description,
+            parents=[command_args],
+            add_help=False,
+        )
+        subcommand_parser.set_defaults(func=func)
+        return func
+
+    return archive_command_decorator
+
+
+def parse_args_and_run():
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,116 @@
+"""
+Commands to compress archived REST responses with zstd.
+
+Discord's API responses are JSON that compresses extremely well,
+especially with a dictionary trained on responses we've already archived.
+Compressed responses are stored as {filename}.zst; ResponseStore decompresses them transparently.
+Images, video and audio are left alone, since they're already compressed.
+
+Don't run these while Wumpus In The Middle is recording to the same archive.
+"""
+
+import argparse
+import os
+import random
+import urllib.parse
+
+from . import commands
+from .index import RequestIndexEntry, read_request_index, open_index, replace_request_index, discard_recorder_state
+from .packs import is_pack_ref
+from .storage import ResponseStore, DictionaryDirectory, COMPRESSED_SUFFIX, compress, require_pyzstd, pyzstd, stored_encoding_suffix_of
+
+"""
+Returns whether a url is a Discord API endpoint, which means its responses are JSON.
+Older index entries don't record content types, so this is how we pick compressible responses after the fact.
+"""
+def is_api_url(url):
+    return urllib.parse.urlparse(url).path.startswith("/api/")
+
+def is_api_response(entry: RequestIndexEntry):
+    return is_api_url(entry.url) and entry.is_json()
+
+def read_index_lines(archive_path):
+    with open_index(archive_path) as index_file:
+        return list(index_file)
+
+
+train_arg_parser = argparse.ArgumentParser()
+train_arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory. Per default 'traffic_archive/'", metavar="<dir>")
+train_arg_parser.add_argument("--samples", type=int, default=20000, help="how many archived API responses to train on. Per default 20000", metavar="<int>")
+train_arg_parser.add_argument("--dictionary-size", type=int, default=112640, help="dictionary size in bytes. Per default 112640", metavar="<int>")
+
+@commands.register_command("train-dictionary", train_arg_parser, description="Train a zstd dictionary on archived API responses, for Wumpus In The Middle's witm_zstd option and the compress command.")
+def train_dictionary_command(args):
+    require_pyzstd()
+    store = ResponseStore(args.traffic_archive)
+    # Error pages would teach the dictionary the wrong things.
+    filenames = list({entry.filename for entry in read_request_index(args.traffic_archive) if is_api_response(entry) and entry.is_success() and entry.has_content()})
+    random.shuffle(filenames)
+    samples = []
+    for filename in filenames[:args.samples]:
+        try:
+            samples.append(store.read(filename))
+        except FileNotFoundError:
+            continue
+    if not samples:
+        print("No archived API responses to train on.")
+        return
+    print(f"Training a {args.dictionary_size} byte dictionary on {len(samples)} responses.")
+    try:
+        zstd_dict = pyzstd.train_dict(samples, args.dictionary_size)
+    except pyzstd.ZstdError as e:
+        print(f"Couldn't train a dictionary ({e}). This usually means there aren't enough archived responses yet.")
+        return
+    path = DictionaryDirectory(os.path.join(args.traffic_archive, "dictionaries")).save(zstd_dict)
+    print(f"Saved dictionary {zstd_dict.dict_id} to {path}.")
+
+
+compress_arg_parser = argparse.ArgumentParser()
+compress_arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory. Per default 'traffic_archive/'", metavar="<dir>")
+compress_arg_parser.add_argument("--level", type=int, default=19, help="zstd compression level. Per default 19", metavar="<int>")
+
+@commands.register_command("compress", compress_arg_parser, description="Compress archived API responses with zstd, using the newest trained dictionary if there is one.")
+def compress_command(args):
+    require_pyzstd()
+    store = ResponseStore(args.traffic_archive)
+    zstd_dict = store.dictionaries.newest()
+    if zstd_dict is None:
+        print("No dictionary found; compressing without one. Run train-dictionary first for much better compression.")
+
+    compressed_filenames = {} # old filename : new filename
+    bytes_before = bytes_after = 0
+    new_lines = []
+    for line in read_index_lines(args.traffic_archive):
+        try:
+            entry = RequestIndexEntry.parse(line)
+        except ValueError:
+            new_lines.append(line)
+            continue
+        # Packed contents can't be replaced in place; they're compressed when witm_zstd is on as they're recorded.
+        # Responses stored as they came over the wire are already compressed, and message pages are stored as small manifests.
+        if not entry.has_content() or entry.filename.endswith(COMPRESSED_SUFFIX) or is_pack_ref(entry.filename) or stored_encoding_suffix_of(entry.filename) or not is_api_response(entry):
+            new_lines.append(line)
+            continue
+        filename = entry.filename
+        if filename not in compressed_filenames:
+            compressed_filenames[filename] = filename
+            if os.path.exists(store.path(filename)):
+                content = store.read(filename)
+                compressed = compress(content, zstd_dict, args.level)
+                if len(compressed) < len(content):
+                    with open(store.path(filename + COMPRESSED_SUFFIX), "wb") as file:
+                        file.write(compressed)
+                    compressed_filenames[filename] = filename + COMPRESSED_SUFFIX
+                    bytes_before += len(content)
+                    bytes_after += len(compressed)
+        entry.filename = compressed_filenames[filename]
+        new_lines.append(entry.format())
+
+    replace_request_index(args.traffic_archive, new_lines)
+    # The recorder's asset maps point at the uncompressed files; have them rebuilt on the next start.
+    discard_recorder_state(args.traffic_archive, "asset_locations", "asset_variants", "archive_size")
+    # Only remove the originals once the index no longer points at them.
+    for filename, new_filename in compressed_filenames.items():
+        if new_filename != filename:
+            os.remove(store.path(filename))
+    print(f"Compressed {bytes_before} bytes of responses to {bytes_after} bytes.")
@@ -0,0 +1,88 @@
+"""
+Content addressing for archived responses.
+
+Responses are stored under a stable digest of their contents,
+so identical bytes fetched under different URLs (or in different sessions) are only stored once.
+The files are spread over subdirectories of requests/ named after the first SHARD_LENGTH hex digits of their digest,
+like requests/3f/3f9a...png, so that no one directory holds hundreds of thousands of them.
+request_index has the path within requests/ as the filename. Archives from before that have all their files
+straight in requests/; `archive_tool.py reshard` moves them into subdirectories, and ResponseStore finds them either way.
+"""
+
+import hashlib
+import mimetypes
+import os
+import urllib.parse
+
+DIGEST_SIZE = 16 # bytes; 32 hex characters
+SHARD_LENGTH = 2 # hex digits of the digest in the name of a file's subdirectory of requests/, so 256 of them
+
+"""
+Returns the hex digest that identifies some response contents.
+Unlike hash(), this is stable across processes.
+"""
+def content_digest(content) -> str:
+    return hashlib.blake2b(content, digest_size=DIGEST_SIZE).hexdigest()
+
+"""
+Returns the extension to keep for a url's contents, from its path, if it has a reasonable one
+(so that images still open nicely); otherwise "".
+"""
+def content_extension(url: str) -> str:
+    extension = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+    if not (1 < len(extension) <= 6 and extension[1:].isalnum()):
+        extension = ""
+    return extension
+
+"""
+Returns the filename to store some response contents under, within requests/.
+"""
+def content_filename(digest: str, url: str) -> str:
+    return sharded_filename(digest + content_extension(url))
+
+"""
+Returns where a file straight in requests/ goes in its subdirectory, going by the digest it's named after.
+Filenames that are in a subdirectory already are returned as they are.
+"""
+def sharded_filename(filename: str) -> str:
+    if "/" in filename:
+        return filename
+    return filename[:SHARD_LENGTH] + "/" + filename
+
+"""
+Returns where a file in a subdirectory of requests/ was before archives were sharded.
+"""
+def flat_filename(filename: str) -> str:
+    return filename.rpartition("/")[2]
+
+"""
+Returns whether a filename straight in requests/ is named after a digest, and so can be moved into a subdirectory.
+Files from before `archive_tool.py dedupe` are named after their url; dedupe moves those itself.
+"""
+def is_digest_filename(filename: str) -> bool:
+    digest = filename[:DIGEST_SIZE * 2]
+    return "/" not in filename and len(digest) == DIGEST_SIZE * 2 and all(c in "0123456789abcdef" for c in digest)
+
+# (offset, magic bytes, media type) for the formats Discord's CDN serves most
+MAGIC_NUMBERS = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (4, b"ftyp", "video/mp4"),
+    (0, b"\x1a\x45\xdf\xa3", "video/webm"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"%PDF-", "application/pdf"),
+)
+
+"""
+Returns the media type of some contents, judging by their first bytes, or failing that the url's extension.
+The extension alone can lie: media.discordapp.net serves .png urls as WebP when asked to.
+"""
+def sniff_media_type(content, url: str) -> str:
+    for offset, magic, media_type in MAGIC_NUMBERS:
+        if content[offset:offset + len(magic)] == magic:
+            return media_type
+    return mimetypes.guess_type(urllib.parse.urlparse(url).path)[0] or "application/octet-stream"
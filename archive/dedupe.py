@@ -0,0 +1,89 @@
+"""
+Migrates requests/ to content-addressed storage.
+
+Older versions of Wumpus In The Middle stored every response under its own filename and deduplicated with
+Python's per-process hash(), so the same avatars and attachments piled up again after every restart.
+This rewrites request_index so every entry references the content digest of its response,
+and keeps a single copy of each distinct response.
+
+Don't run this while Wumpus In The Middle is recording to the same archive.
+"""
+
+import argparse
+import os
+
+from . import commands
+from .content import content_digest, content_filename
+from .index import RequestIndexEntry, open_index, replace_request_index, discard_recorder_state
+from .packs import is_pack_ref
+from .storage import ResponseStore, COMPRESSED_SUFFIX, stored_encoding_suffix_of
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory to migrate. Per default 'traffic_archive/'", metavar="<dir>")
+arg_parser.add_argument("-d", "--dry", action="store_true", help="report what would be deduplicated without changing anything")
+
+
+@commands.register_command("dedupe", arg_parser, description="Store each distinct response in requests/ once, keyed by its content digest.")
+def dedupe_command(args):
+    dedupe_archive(args.traffic_archive, dry_run=args.dry)
+
+
+def dedupe_archive(archive_path, dry_run=False):
+    store = ResponseStore(archive_path)
+    requests_path = store.requests_path
+
+    migrated_filenames = {} # old filename : (digest, new filename)
+    stored_filenames = set() # new filenames we've already kept a copy for
+    bytes_freed = 0
+    new_lines = []
+    with open_index(archive_path) as index_file:
+        for line in index_file:
+            try:
+                entry = RequestIndexEntry.parse(line)
+            except ValueError:
+                new_lines.append(line)
+                continue
+            # Packed contents are already stored by digest, and so are responses stored as they came over the wire
+            # (whose digests are of their encoded contents) and message pages, which only came about after dedupe.
+            if is_pack_ref(entry.filename) or stored_encoding_suffix_of(entry.filename) or not entry.has_content():
+                new_lines.append(line)
+                continue
+            filename = entry.filename
+
+            if filename not in migrated_filenames:
+                old_path = os.path.join(requests_path, filename)
+                if not os.path.exists(old_path):
+                    print(f"Missing {filename}; leaving its index entry alone.")
+                    new_lines.append(line)
+                    continue
+                digest = content_digest(store.read(filename))
+                new_filename = content_filename(digest, entry.url)
+                if filename.endswith(COMPRESSED_SUFFIX):
+                    new_filename += COMPRESSED_SUFFIX
+                new_path = os.path.join(requests_path, new_filename)
+                migrated_filenames[filename] = (digest, new_filename)
+
+                if new_filename != filename:
+                    if new_filename in stored_filenames or os.path.exists(new_path):
+                        bytes_freed += os.path.getsize(old_path)
+                        if not dry_run:
+                            os.remove(old_path)
+                    elif not dry_run:
+                        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                        os.rename(old_path, new_path)
+                stored_filenames.add(new_filename)
+
+            entry.response_hash, entry.filename = migrated_filenames[filename]
+            new_lines.append(entry.format())
+
+    print(f"{len(migrated_filenames)} response files hold {len(stored_filenames)} distinct responses.")
+    if dry_run:
+        print(f"Would free {bytes_freed} bytes.")
+        return
+
+    replace_request_index(archive_path, new_lines)
+
+    # The recorder's dedup index still has the old hashes, and its asset maps the old filenames;
+    # have them rebuilt from the new request_index on the next start.
+    discard_recorder_state(archive_path, "dedup_index", "dedup_bloom", "asset_locations", "asset_variants", "archive_size")
+    print(f"Freed {bytes_freed} bytes.")
@@ -0,0 +1,229 @@
+"""
+Compact on-disk sets of fixed-width fingerprints.
+
+Wumpus In The Middle uses these to remember what it has already archived
+without reading the whole request_index into memory every time it starts.
+A fingerprint is a 64-bit hash of some key; false positives are possible in theory,
+but at 64 bits they're rare enough to not matter for deduplication.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+
+"""
+Returns the 64-bit fingerprint of a key. Never returns 0, since 0 marks empty slots.
+"""
+def fingerprint(*parts: str) -> int:
+    key = "\0".join(parts).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+"""
+An open-addressed hash set of fingerprints, stored in a memory-mapped file.
+Lookups and insertions touch a slot or two, so they stay fast no matter how big the archive gets,
+and only the pages that are actually used need to be in memory.
+The table doubles in size when it gets half full.
+With value_count, each fingerprint also carries that many unsigned 64-bit values, making it a map.
+Slots are stored in native byte order, so the file shouldn't be copied to a machine with different endianness;
+if it is lost, it can always be rebuilt from the index it was built from.
+"""
+class FingerprintTable:
+    HEADER = struct.Struct("<8sQQQ") # magic, capacity, count, values per slot (0 in plain sets, where this used to be padding)
+    MAGIC = b"WITMFPT1"
+
+    def __init__(self, path, initial_capacity=1 << 16, value_count=0):
+        self.path = path
+        if not os.path.exists(path):
+            self._create(path, initial_capacity, value_count)
+        self._open()
+        assert self.value_count == value_count, f"{self.path} has {self.value_count} values per slot, not {value_count}"
+
+    @classmethod
+    def _create(cls, path, capacity, value_count):
+        with open(path + ".new", "wb") as file:
+            file.write(cls.HEADER.pack(cls.MAGIC, capacity, 0, value_count))
+            file.truncate(cls.HEADER.size + capacity * (1 + value_count) * 8)
+        os.replace(path + ".new", path)
+
+    def _open(self):
+        self.file = open(self.path, "r+b")
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity, self.count, self.value_count = self.HEADER.unpack_from(self.mmap)
+        assert magic == self.MAGIC, f"{self.path} is not a fingerprint table"
+        self.width = 1 + self.value_count
+        self.slots = memoryview(self.mmap)[self.HEADER.size:].cast("Q")
+
+    def __len__(self):
+        return self.count
+
+    """
+    Returns the slot index where fp is, or where it would go if it isn't in the table.
+    """
+    def _find(self, fp: int) -> int:
+        mask = self.capacity - 1
+        i = fp & mask
+        while True:
+            slot = self.slots[i * self.width]
+            if slot == fp or slot == 0:
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, fp: int) -> bool:
+        return self.slots[self._find(fp) * self.width] == fp
+
+    """
+    Returns the values stored with fp, or None if it isn't in the table.
+    """
+    def get(self, fp: int):
+        start = self._find(fp) * self.width
+        if self.slots[start] != fp:
+            return None
+        return tuple(self.slots[start + 1:start + self.width])
+
+    """
+    Adds a fingerprint, with its values if the table has any. Returns True if it wasn't already in the table;
+    if it was, its values are left alone.
+    """
+    def add(self, fp: int, *values: int) -> bool:
+        assert len(values) == self.value_count
+        start = self._find(fp) * self.width
+        if self.slots[start] == fp:
+            return False
+        for i, value in enumerate(values, start=1):
+            self.slots[start + i] = value
+        self.slots[start] = fp # key last, so a torn write never leaves a key with garbage values
+        self.count += 1
+        self.HEADER.pack_into(self.mmap, 0, self.MAGIC, self.capacity, self.count, self.value_count)
+        if self.count * 2 > self.capacity:
+            self._grow()
+        return True
+
+    """
+    Adds a fingerprint with its values, or replaces the values of one that's already in the table.
+    A crash in the middle of replacing them can leave a mix of old and new values; like the rest of the table,
+    they can be rebuilt from the index they came from.
+    """
+    def replace(self, fp: int, *values: int):
+        assert len(values) == self.value_count
+        start = self._find(fp) * self.width
+        if self.slots[start] != fp:
+            self.add(fp, *values)
+            return
+        for i, value in enumerate(values, start=1):
+            self.slots[start + i] = value
+
+    def __iter__(self):
+        for start in range(0, len(self.slots), self.width):
+            if self.slots[start]:
+                yield self.slots[start]
+
+    def _grow(self):
+        new_capacity = self.capacity * 2
+        new_path = self.path + ".grow"
+        self._create(new_path, new_capacity, self.value_count)
+        new_table = FingerprintTable(new_path, value_count=self.value_count)
+        mask = new_capacity - 1
+        for start in range(0, len(self.slots), self.width):
+            fp = self.slots[start]
+            if not fp:
+                continue
+            i = fp & mask
+            while new_table.slots[i * self.width]:
+                i = (i + 1) & mask
+            new_table.slots[i * self.width:(i + 1) * self.width] = self.slots[start:start + self.width]
+        new_table.count = self.count
+        new_table.HEADER.pack_into(new_table.mmap, 0, self.MAGIC, new_capacity, self.count, self.value_count)
+        new_table.close()
+        self.close()
+        os.replace(new_path, self.path)
+        self._open()
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.slots.release()
+        self.mmap.close()
+        self.file.close()
+
+"""
+A Bloom filter over fingerprints, kept in memory in front of a FingerprintTable,
+so that most lookups of things we haven't seen yet don't have to touch the table at all.
+It has a fixed size, so its memory use stays bounded; as it fills up it just gets less selective.
+Saved alongside the table and reloaded in one read; if it's out of date, it's rebuilt from the table.
+"""
+class BloomFilter:
+    HASH_COUNT = 7
+
+    def __init__(self, size_bits=1 << 24):
+        self.size_bits = size_bits
+        self.bits = bytearray(size_bits // 8)
+        self.count = 0
+
+    def _positions(self, fp: int):
+        # Kirsch-Mitzenmacher double hashing: derive every position from the two halves of the fingerprint.
+        h1, h2 = fp & 0xFFFFFFFF, fp >> 32
+        for k in range(self.HASH_COUNT):
+            yield (h1 + k * h2) % self.size_bits
+
+    def add(self, fp: int):
+        for position in self._positions(fp):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    """
+    False means definitely absent; True means maybe present.
+    """
+    def __contains__(self, fp: int) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(fp))
+
+    def save(self, path):
+        with open(path + ".new", "wb") as file:
+            file.write(struct.pack("<QQ", self.size_bits, self.count))
+            file.write(self.bits)
+        os.replace(path + ".new", path)
+
+    """
+    Returns a filter loaded from path that covers every fingerprint in table,
+    rebuilding it from the table if the saved copy is missing or stale.
+    """
+    @classmethod
+    def load_for(cls, path, table: FingerprintTable, size_bits=1 << 24):
+        bloom_filter = cls(size_bits)
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                saved_size_bits, saved_count = struct.unpack("<QQ", file.read(16))
+                if saved_size_bits == size_bits and saved_count == len(table):
+                    file.readinto(bloom_filter.bits)
+                    bloom_filter.count = saved_count
+                    return bloom_filter
+        for fp in table:
+            bloom_filter.add(fp)
+        return bloom_filter
+
+"""
+A persistent set of fingerprints: a FingerprintTable with a BloomFilter in front of it.
+"""
+class FingerprintSet:
+    def __init__(self, table_path, bloom_path):
+        self.bloom_path = bloom_path
+        self.table = FingerprintTable(table_path)
+        self.bloom_filter = BloomFilter.load_for(bloom_path, self.table)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, fp: int) -> bool:
+        return fp in self.bloom_filter and fp in self.table
+
+    def add(self, fp: int) -> bool:
+        if self.table.add(fp):
+            self.bloom_filter.add(fp)
+            return True
+        return False
+
+    def close(self):
+        self.table.flush()
+        self.bloom_filter.save(self.bloom_path)
+        self.table.close()
@@ -0,0 +1,327 @@
+"""
+Reading recorded Gateway connections, and repacking them into seekable frames.
+
+Gateways are recorded to gateways/{month}/ (see gateway_shard()), and gateway_index has {month}/{gateway id}
+as their filename prefix; Gateways from before that are straight in gateways/, until `archive_tool.py reshard`.
+
+Discord compresses a whole Gateway connection as one zlib (or zstd) stream, so the _data file
+can only be decompressed from the start: reading the last hour of a day-long Gateway means inflating the whole day.
+The repack-gateways command rewrites each Gateway next to its originals as
+ - {prefix}_frames: independently zlib-compressed frames, each holding up to N messages or M seconds of them.
+     Decompressed, a frame is a sequence of messages, each an 8-byte little-endian float timestamp,
+     a 4-byte little-endian length, and that many bytes of decompressed payload (JSON or ETF, as Discord sent it).
+ - {prefix}_frames_index: a header line `witm-frames 1 {size of _data when repacked}`, then a line per frame:
+     {first timestamp} {last timestamp} {offset} {length} {message count} {comma-separated event types, or -}
+The originals are left alone and stay readable. If _data has grown since it was repacked
+(say the Gateway was still being recorded), the frames are stale and readers fall back to the originals.
+
+Don't run the command on Gateways that Wumpus In The Middle is still recording, since it'd just have to be run again.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import mmap
+import os
+import struct
+import time
+import urllib.parse
+import zlib
+
+from . import commands
+from .index import open_index, GATEWAY_INDEX
+from .storage import require_pyzstd, pyzstd
+
+try:
+    import erlpack
+except ImportError:
+    erlpack = None
+
+FRAMES_MAGIC = "witm-frames"
+FRAMES_VERSION = 1
+MESSAGE_HEADER = struct.Struct("<dI") # timestamp, payload length
+ZLIB_SUFFIX = b'\x00\x00\xff\xff' # the end of a zlib SYNC_FLUSH, which Discord ends every zlib-stream payload with
+COMPRESSION_SCHEMES = ("zlib-stream", "zstd-stream")
+DECOMPRESSION_ERRORS = (zlib.error, pyzstd.ZstdError) if pyzstd else (zlib.error,)
+
+GATEWAY_SHARD_FORMAT = "%Y-%m" # gateways/ subdirectories, one per month (UTC)
+GATEWAY_FILE_SUFFIXES = ("_data", "_timeline", "_frames", "_frames_index") # the files of a Gateway, after its prefix
+
+"""
+Returns the subdirectory of gateways/ for a Gateway that started at a timestamp.
+"""
+def gateway_shard(timestamp):
+    return time.strftime(GATEWAY_SHARD_FORMAT, time.gmtime(timestamp))
+
+def frames_index_path(gateway_path_prefix):
+    return gateway_path_prefix + "_frames_index"
+
+def gateway_query(url):
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query))
+
+"""
+Returns a decompressor for a Gateway compression scheme (one of COMPRESSION_SCHEMES; zstd-stream needs pyzstd).
+"""
+def gateway_decompressor(compression_scheme):
+    if compression_scheme == "zlib-stream":
+        return zlib.decompressobj()
+    if compression_scheme == "zstd-stream":
+        require_pyzstd()
+        return pyzstd.ZstdDecompressor()
+    raise ValueError(f"unsupported Gateway compression scheme '{compression_scheme}'")
+
+"""
+Decompresses a Gateway connection's messages as they come, in the order they came.
+Used by Wumpus In The Middle to follow live Gateways; recorded ones are read with read_original_payloads().
+"""
+class PayloadStream:
+    def __init__(self, url):
+        self.compression_scheme = gateway_query(url).get("compress")
+        self.decompressor = gateway_decompressor(self.compression_scheme)
+        self.buffer = bytearray()
+
+    """
+    Takes the next chunk of the stream. Returns the decompressed payload once a whole one has arrived, otherwise None.
+    Raises one of DECOMPRESSION_ERRORS if the stream can't be decompressed,
+    which can happen if it wasn't followed from the start.
+    """
+    def feed(self, chunk):
+        if not self.buffer and (self.compression_scheme != "zlib-stream" or chunk.endswith(ZLIB_SUFFIX)):
+            return self.decompressor.decompress(chunk) # a whole payload in one chunk, as most are
+        self.buffer.extend(chunk)
+        if self.compression_scheme == "zlib-stream" and not self.buffer.endswith(ZLIB_SUFFIX):
+            return None
+        payload = self.decompressor.decompress(self.buffer)
+        self.buffer = bytearray()
+        return payload
+
+"""
+Returns (timestamp, length) for each chunk listed in a Gateway's _timeline, in the order they are in _data.
+Improper lines are skipped, and passed to report if given.
+"""
+def read_timeline(gateway_path_prefix, report=None):
+    with open(gateway_path_prefix + "_timeline") as timeline_file:
+        lines = timeline_file.read().split("\n")
+    chunks = []
+    for line in lines[:-1]: # anything after the last newline was cut short by a crash; its data may not have been written
+        try:
+            timestamp, length = line.split(" ")
+            chunks.append((float(timestamp), int(length)))
+        except ValueError:
+            if report is not None:
+                report(f"Improper line in the timeline of Gateway {gateway_path_prefix}: {line!r}")
+    return chunks
+
+"""
+Yields (timestamp, decompressed payload) for each message in a Gateway's original _data and _timeline files,
+where timestamp is when the last piece of the payload was received.
+Stops early if _data is cut short, or if the stream can't be decompressed, which can happen if WitM restarted
+in the middle of a Gateway connection; either is passed to report if given.
+
+_data is memory-mapped rather than read chunk by chunk. The pieces of a payload are next to each other in it,
+so each payload, however many chunks it came in, goes to the decompressor as one slice of the map, without being copied.
+"""
+def read_original_payloads(gateway_path_prefix, url, report=None):
+    compression_scheme = gateway_query(url).get("compress")
+    decompressor = gateway_decompressor(compression_scheme)
+    timeline = read_timeline(gateway_path_prefix, report)
+    with open(gateway_path_prefix + "_data", "rb") as data_file:
+        if os.fstat(data_file.fileno()).st_size == 0: # can't be mapped
+            if timeline and report is not None:
+                report(f"Incomplete Gateway {gateway_path_prefix}.")
+            return
+        with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            payload_start = end = 0
+            for timestamp, length in timeline:
+                start, end = end, end + length
+                if end > len(data):
+                    end = len(data)
+                if start == end:
+                    if report is not None:
+                        report(f"Incomplete Gateway {gateway_path_prefix}.")
+                    return
+                if compression_scheme == "zlib-stream" and data[max(payload_start, end - len(ZLIB_SUFFIX)):end] != ZLIB_SUFFIX:
+                    continue # more of this payload to come
+                try:
+                    payload = decompressor.decompress(view[payload_start:end])
+                except DECOMPRESSION_ERRORS:
+                    if report is not None:
+                        report(
+                            f"Error decompressing a message of Gateway {gateway_path_prefix}."
+                            " This can happen if WitM restarts in the middle of a Gateway connection."
+                            " Skipping the rest of this Gateway."
+                        )
+                    return
+                payload_start = end
+                yield timestamp, payload
+
+"""
+Recursively convert the bytes and Atom objects in an ETF payload to strings.
+"""
+def deserialize_erlpack(payload):
+    if isinstance(payload, bytes):
+        return payload.decode()
+    elif isinstance(payload, erlpack.Atom):
+        return str(payload)
+    elif isinstance(payload, list):
+        return [deserialize_erlpack(i) for i in payload]
+    elif isinstance(payload, dict):
+        return {deserialize_erlpack(k): deserialize_erlpack(v) for k, v in payload.items()}
+    else:
+        return payload
+
+"""
+Deserializes a decompressed payload in the Gateway's encoding ("json" or "etf"; the latter needs erlpack).
+"""
+def decode_payload(payload, encoding):
+    if encoding == "json":
+        return json.loads(payload)
+    if encoding == "etf":
+        if erlpack is None:
+            raise RuntimeError("Gateways with etf encoding need erlpack; install it with pip.")
+        return deserialize_erlpack(erlpack.unpack(payload))
+    raise ValueError(f"unsupported Gateway encoding '{encoding}'")
+
+"""
+Returns a payload's event type (its "t"), or None for payloads without one, like heartbeat acks.
+"""
+def event_type(payload, encoding):
+    if encoding == "json":
+        return json.loads(payload).get("t")
+    if encoding == "etf" and erlpack is not None:
+        for key, value in erlpack.unpack(payload).items():
+            if (key.decode() if isinstance(key, bytes) else str(key)) == "t":
+                return value.decode() if isinstance(value, bytes) else value and str(value)
+    return None
+
+"""
+Repacks a Gateway into frames; see the module docstring. Returns how many messages were repacked.
+"""
+def repack_gateway(gateway_path_prefix, url, frame_messages, frame_seconds):
+    encoding = gateway_query(url).get("encoding")
+    data_size = os.path.getsize(gateway_path_prefix + "_data")
+    frames_path = gateway_path_prefix + "_frames"
+    index_lines = [f"{FRAMES_MAGIC} {FRAMES_VERSION} {data_size}\n"]
+    message_count = 0
+
+    frame = [] # (timestamp, payload)
+    def write_frame(frames_file):
+        contents = b"".join(MESSAGE_HEADER.pack(timestamp, len(payload)) + payload for timestamp, payload in frame)
+        compressed = zlib.compress(contents)
+        event_types = sorted({event for _timestamp, payload in frame if (event := event_type(payload, encoding))})
+        index_lines.append(" ".join((
+            repr(frame[0][0]), repr(frame[-1][0]), str(frames_file.tell()), str(len(compressed)), str(len(frame)),
+            ",".join(event_types) or "-"
+        )) + "\n")
+        frames_file.write(compressed)
+        frame.clear()
+
+    with open(frames_path + ".new", "wb") as frames_file:
+        for timestamp, payload in read_original_payloads(gateway_path_prefix, url):
+            if frame and (len(frame) >= frame_messages or timestamp - frame[0][0] >= frame_seconds):
+                write_frame(frames_file)
+            frame.append((timestamp, payload))
+            message_count += 1
+        if frame:
+            write_frame(frames_file)
+
+    with open(frames_index_path(gateway_path_prefix) + ".new", "w") as index_file:
+        index_file.writelines(index_lines)
+    # The frames go in place first, so there's never an index pointing into frames that aren't there.
+    os.replace(frames_path + ".new", frames_path)
+    os.replace(frames_index_path(gateway_path_prefix) + ".new", frames_index_path(gateway_path_prefix))
+    return message_count
+
+class FrameIndexEntry:
+    def __init__(self, line):
+        first_timestamp, last_timestamp, offset, length, message_count, event_types = line.split()
+        self.first_timestamp = float(first_timestamp)
+        self.last_timestamp = float(last_timestamp)
+        self.offset = int(offset)
+        self.length = int(length)
+        self.message_count = int(message_count)
+        self.event_types = set() if event_types == "-" else set(event_types.split(","))
+
+"""
+Returns the frame index of a repacked Gateway, or None if it hasn't been repacked or the frames are stale.
+"""
+def read_frame_index(gateway_path_prefix):
+    try:
+        with open(frames_index_path(gateway_path_prefix)) as index_file:
+            magic, version, data_size = index_file.readline().split()
+            if magic != FRAMES_MAGIC or int(version) != FRAMES_VERSION:
+                return None
+            if int(data_size) != os.path.getsize(gateway_path_prefix + "_data"):
+                return None
+            return [FrameIndexEntry(line) for line in index_file]
+    except (FileNotFoundError, ValueError):
+        return None
+
+"""
+Returns a list of (timestamp, payload) for the messages in one frame.
+"""
+def read_frame(gateway_path_prefix, entry: FrameIndexEntry):
+    with open(gateway_path_prefix + "_frames", "rb") as frames_file:
+        frames_file.seek(entry.offset)
+        contents = zlib.decompress(frames_file.read(entry.length))
+    messages = []
+    position = 0
+    while position < len(contents):
+        timestamp, length = MESSAGE_HEADER.unpack_from(contents, position)
+        position += MESSAGE_HEADER.size
+        messages.append((timestamp, contents[position:position + length]))
+        position += length
+    return messages
+
+"""
+Yields (timestamp, payload) for a repacked Gateway's messages, starting at since, if given.
+With event_types, frames without any of those events are skipped (the rest of their frames' messages are still yielded).
+With workers, frames are decompressed that many at a time in parallel (zlib releases the GIL); they're yielded in order either way.
+"""
+def read_frames(gateway_path_prefix, frame_index, since=None, event_types=None, workers=1):
+    entries = [
+        entry for entry in frame_index
+        if (since is None or entry.last_timestamp >= since)
+        and (event_types is None or entry.event_types & event_types)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for messages in executor.map(lambda entry: read_frame(gateway_path_prefix, entry), entries):
+            for timestamp, payload in messages:
+                if since is None or timestamp >= since:
+                    yield timestamp, payload
+
+"""
+Yields (timestamp, decompressed payload) for a Gateway's messages, from its frames if it's been repacked
+and from the originals otherwise. report is passed on to read_original_payloads().
+"""
+def read_payloads(gateway_path_prefix, url, since=None, workers=1, report=None):
+    frame_index = read_frame_index(gateway_path_prefix)
+    if frame_index is not None:
+        yield from read_frames(gateway_path_prefix, frame_index, since=since, workers=workers)
+        return
+    for timestamp, payload in read_original_payloads(gateway_path_prefix, url, report):
+        if since is None or timestamp >= since:
+            yield timestamp, payload
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory. Per default 'traffic_archive/'", metavar="<dir>")
+arg_parser.add_argument("--messages", type=int, default=1000, help="start a new frame after this many messages. Per default 1000", metavar="<int>")
+arg_parser.add_argument("--seconds", type=float, default=600, help="start a new frame after this many seconds of messages. Per default 600", metavar="<seconds>")
+arg_parser.add_argument("-f", "--force", action="store_true", help="repack Gateways even if they already have up-to-date frames")
+
+@commands.register_command("repack-gateways", arg_parser, description="Repack recorded Gateways into independently decodable frames, so readers can seek by time.")
+def repack_gateways_command(args):
+    gateways_path = os.path.join(args.traffic_archive, "gateways")
+    with open_index(args.traffic_archive, GATEWAY_INDEX) as index_file:
+        for line in index_file:
+            _timestamp, url, gateway_filename_prefix = line.split()
+            gateway_path_prefix = os.path.join(gateways_path, gateway_filename_prefix)
+            if not args.force and read_frame_index(gateway_path_prefix) is not None:
+                continue
+            try:
+                message_count = repack_gateway(gateway_path_prefix, url, args.messages, args.seconds)
+            except (FileNotFoundError, ValueError, RuntimeError) as e:
+                print(f"Skipping Gateway {gateway_filename_prefix}: {e}")
+                continue
+            print(f"Repacked {message_count} messages from Gateway {gateway_filename_prefix}.")
@@ -0,0 +1,265 @@
+"""
+Reading and rewriting traffic_archive/request_index.
+
+Each line starts with {timestamp} {method} {url} {response hash} {filename}.
+Since version 2, Wumpus In The Middle follows that with space-separated key=value attributes:
+ - v: the line format version, 2
+ - status: the HTTP status code
+ - type: the media type from the Content-Type header, without parameters like charset
+ - size: the length of the (decoded) response body; left out for responses stored as they came over the wire
+ - encoding: the Content-Encoding the response was sent with, if any.
+     If the filename ends in a wire encoding suffix like +br, the response is stored in that encoding (see storage.py).
+ - route: what the url is, as tagged by routes.classify(), followed by the ids it extracted, each as its own attribute,
+     like `route=attachment channel_id=... attachment_id=...`
+ - superseded: 1 if the filename holds a better variant of the same asset (a bigger size of an avatar, say)
+     instead of the response itself, which was thrown away; see variants.py.
+ - evicted: why the contents were deleted to keep the archive under its size limit, "media" or "page" (see quota.py).
+     The filename is then -, like for responses recorded without their contents, but the response hash is kept.
+A filename ending in +messages is a message list response stored as a manifest of its messages (see message_pages.py);
+its response hash and size are still those of the response itself.
+Responses recorded without their contents (see the metadata action in policy.py) have - for both the response hash and the filename.
+Lines written by older versions have no attributes, so we don't know those things about them.
+Readers should go through RequestIndexEntry, which handles both, and keeps attributes it doesn't know about when rewriting.
+
+Recorder instances started with witm_instance (so several can record to one archive at once) each append to
+index segments of their own, instances/{instance}/request_index and instances/{instance}/gateway_index,
+instead of the archive's request_index and gateway_index. open_index() merges them all back into one index.
+"""
+
+import contextlib
+import glob
+import heapq
+import io
+import os
+
+from .routes import Route, ROUTE_IDS, classify
+
+INDEX_VERSION = 2
+NO_CONTENT = "-" # the response hash and filename of entries recorded without their contents
+
+"""
+One line of request_index.
+status, content_type, size, encoding and route are None when the line doesn't say.
+"""
+class RequestIndexEntry:
+    def __init__(self, timestamp, method, url, response_hash, filename, status=None, content_type=None, size=None, encoding=None, route=None, superseded=False, evicted=None, extra=None):
+        self.timestamp = timestamp # kept as a string, so rewriting a line doesn't change it
+        self.method = method
+        self.url = url
+        self.response_hash = response_hash
+        self.filename = filename
+        self.status = status
+        self.content_type = content_type
+        self.size = size
+        self.encoding = encoding
+        self.route = route
+        self.superseded = superseded
+        self.evicted = evicted
+        self.extra = extra or {} # attributes this version doesn't know about : their values
+
+    """
+    Raises ValueError for lines that aren't index entries.
+    """
+    @classmethod
+    def parse(cls, line):
+        fields = line.split()
+        if len(fields) < 5:
+            raise ValueError(f"not a request_index line: {line!r}")
+        entry = cls(*fields[:5])
+        for field in fields[5:]:
+            key, _, value = field.partition("=")
+            if key == "v":
+                continue
+            elif key == "status":
+                entry.status = int(value)
+            elif key == "type":
+                entry.content_type = value
+            elif key == "size":
+                entry.size = int(value)
+            elif key == "encoding":
+                entry.encoding = value
+            elif key == "route":
+                entry.route = Route(value)
+            elif key == "superseded":
+                entry.superseded = value == "1"
+            elif key == "evicted":
+                entry.evicted = value
+            else:
+                entry.extra[key] = value
+        if entry.route is not None:
+            for name in ROUTE_IDS.get(entry.route.tag, ()):
+                if name in entry.extra:
+                    entry.route.ids[name] = entry.extra.pop(name)
+        return entry
+
+    """
+    Returns the entry as a line of request_index. Entries without any attributes are written in the old format,
+    so rewriting an old line doesn't change more than it has to.
+    """
+    def format(self):
+        attributes = [
+            f"{key}={value}"
+            for key, value in (("status", self.status), ("type", self.content_type), ("size", self.size), ("encoding", self.encoding))
+            if value is not None
+        ]
+        if self.route is not None:
+            attributes.append(f"route={self.route.tag}")
+            attributes.extend(f"{name}={value}" for name, value in self.route.ids.items())
+        if self.superseded:
+            attributes.append("superseded=1")
+        if self.evicted is not None:
+            attributes.append(f"evicted={self.evicted}")
+        attributes.extend(f"{key}={value}" for key, value in self.extra.items())
+        fields = [self.timestamp, self.method, self.url, self.response_hash, self.filename]
+        if attributes:
+            fields.append(f"v={INDEX_VERSION}")
+            fields.extend(attributes)
+        return " ".join(fields) + "\n"
+
+    @property
+    def seen_timestamp(self):
+        return float(self.timestamp)
+
+    """
+    Returns the entry's Route: the one recorded in the index, or for older entries, its url's.
+    """
+    def get_route(self) -> Route:
+        return self.route if self.route is not None else classify(self.url)
+
+    """
+    False only if we know the response was an error, like an outage page; old entries get the benefit of the doubt.
+    """
+    def is_success(self):
+        return self.status is None or 200 <= self.status < 300
+
+    """
+    False for entries recorded without their contents, or whose contents were evicted, which have nothing to read.
+    """
+    def has_content(self):
+        return self.filename != NO_CONTENT
+
+    """
+    False only if we know the response isn't JSON.
+    """
+    def is_json(self):
+        return self.content_type is None or self.content_type == "application/json" or self.content_type.endswith("+json")
+
+REQUEST_INDEX = "request_index"
+GATEWAY_INDEX = "gateway_index"
+INSTANCES_DIRECTORY = "instances"
+
+"""
+Returns the directory a recorder instance keeps its index segments and state in.
+"""
+def instance_path(archive_path, instance):
+    return os.path.join(archive_path, INSTANCES_DIRECTORY, instance)
+
+"""
+Returns the paths of the segments of an index (REQUEST_INDEX or GATEWAY_INDEX) that exist:
+the archive's own, then each recorder instance's.
+"""
+def index_segment_paths(archive_path, index_name=REQUEST_INDEX):
+    main_path = os.path.join(archive_path, index_name)
+    instance_paths = sorted(glob.glob(os.path.join(glob.escape(archive_path), INSTANCES_DIRECTORY, "*", index_name)))
+    return ([main_path] if os.path.exists(main_path) else []) + instance_paths
+
+"""
+Returns the timestamp a line of either index starts with, for merging segments; 0 for lines that don't start with one.
+"""
+def line_timestamp(line):
+    try:
+        return float(line.split(" ", 1)[0])
+    except ValueError:
+        return 0
+
+"""
+Opens all of an index's segments as one index: use like open(), to iterate over its lines in timestamp order.
+Each segment is already in (about) timestamp order, so they're merged as they're read.
+An index without any segments yet (a new archive, or instances that haven't written anything) has no lines.
+"""
+@contextlib.contextmanager
+def open_index(archive_path, index_name=REQUEST_INDEX):
+    with contextlib.ExitStack() as stack:
+        index_files = [stack.enter_context(open(path)) for path in index_segment_paths(archive_path, index_name)]
+        if not index_files:
+            yield iter(())
+        elif len(index_files) == 1:
+            yield index_files[0]
+        else:
+            yield heapq.merge(*index_files, key=line_timestamp)
+
+"""
+Returns the lines of an index segment from byte offset start up to end (per default, its end),
+for reading a segment that a recorder is still appending to only as far as it had written at some point.
+"""
+def read_index_lines(path, start=0, end=None):
+    with open(path, "rb") as index_file:
+        index_file.seek(start)
+        data = index_file.read() if end is None else index_file.read(end - start)
+    return io.TextIOWrapper(io.BytesIO(data)).readlines()
+
+"""
+Returns the media type of a Content-Type header value, in the form request_index stores it.
+"""
+def media_type(content_type_header: str) -> str:
+    return content_type_header.split(";")[0].strip().lower()
+
+"""
+Yields a RequestIndexEntry for each line of an archive's request_index, skipping lines that aren't entries.
+With route_tags, only yields entries with one of those tags.
+"""
+def read_request_index(archive_path, route_tags=None):
+    with open_index(archive_path) as index_file:
+        for line in index_file:
+            try:
+                entry = RequestIndexEntry.parse(line)
+            except ValueError:
+                continue
+            if route_tags is None or entry.get_route().tag in route_tags:
+                yield entry
+
+"""
+Returns a RequestIndexEntry for each of some lines of request_index, or None for lines that aren't entries,
+for maintenance commands that rewrite some entries and keep the other lines as they are.
+"""
+def parse_index_lines(lines):
+    entries = []
+    for line in lines:
+        try:
+            entries.append(RequestIndexEntry.parse(line))
+        except ValueError:
+            entries.append(None)
+    return entries
+
+"""
+Atomically replace request_index with new lines, so an interrupted rewrite never leaves a half-written index behind.
+The lines are taken to be what open_index() read, so recorder instances' segments are folded into request_index.
+Only for maintenance commands; don't do this while Wumpus In The Middle is recording to the same archive.
+"""
+def replace_request_index(archive_path, lines):
+    replace_index(archive_path, REQUEST_INDEX, lines)
+
+"""
+Like replace_request_index, for either index (REQUEST_INDEX or GATEWAY_INDEX).
+"""
+def replace_index(archive_path, index_name, lines):
+    index_path = os.path.join(archive_path, index_name)
+    segment_paths = [path for path in index_segment_paths(archive_path, index_name) if path != index_path]
+    with open(index_path + ".new", "w") as new_index_file:
+        new_index_file.writelines(lines)
+    os.replace(index_path + ".new", index_path)
+    for segment_path in segment_paths:
+        os.remove(segment_path)
+
+"""
+Delete some of the recorder's bookkeeping in state/ (see wumpus_in_the_middle.py), and in each recorder instance's,
+so it's rebuilt from the indexes on its next start.
+For maintenance commands that change what the bookkeeping was built from.
+"""
+def discard_recorder_state(archive_path, *state_filenames):
+    state_paths = [os.path.join(archive_path, "state")] + glob.glob(os.path.join(glob.escape(archive_path), INSTANCES_DIRECTORY, "*", "state"))
+    for state_path in state_paths:
+        for state_filename in state_filenames:
+            state_file_path = os.path.join(state_path, state_filename)
+            if os.path.exists(state_file_path):
+                os.remove(state_file_path)
@@ -0,0 +1,90 @@
+"""
+Message list responses stored as per-message deltas.
+
+Every time the client opens a channel, it fetches the newest page of messages again, and the page is mostly the same
+messages as last time. With witm_message_deltas, Wumpus In The Middle splits a page into its messages and only stores
+the ones it hasn't stored before, appended to segments in message_packs/ (laid out like packs/, see packs.py).
+The page itself is stored as a small manifest, with a filename ending in MESSAGE_PAGE_SUFFIX (before any .zst):
+
+    witm-message-page 1
+    {JSON list: the page's text before the first message, between messages, and after the last one}
+    {message id} {digest of the message} {reference into message_packs/, like @0:1234:567, with .zst if compressed}
+    ...
+
+A message is only stored again when its JSON changes (an edit, a new reaction), since the digest is part of its key.
+The manifest still lists every message on the page, unchanged or not, so the page's request_index entry
+records that each of them was seen at that time, just like a full copy of the page would.
+ResponseStore reassembles manifests into the exact bytes Discord sent, so readers don't need to know about any of this.
+"""
+
+import json
+import re
+
+MESSAGE_PAGE_SUFFIX = "+messages"
+MESSAGE_PACKS_DIRECTORY = "message_packs"
+PAGE_MAGIC = b"witm-message-page"
+PAGE_VERSION = 1
+
+SEPARATOR_PATTERN = re.compile(r"\s*,\s*")
+CLOSING_PATTERN = re.compile(r"\s*\]\s*")
+
+"""
+Splits a message list response into (skeleton, [(message id, message JSON bytes)]), where the skeleton is
+[text before the first message, text between messages, text after the last one]; assemble() puts them back together.
+Returns None for responses that can't be split that way: anything but a non-empty list of messages,
+and lists whose messages aren't all separated the same way.
+"""
+def split_page(content):
+    try:
+        text = content.decode()
+    except UnicodeDecodeError:
+        return None
+    opening = re.match(r"\s*\[\s*", text)
+    if opening is None:
+        return None
+    decoder = json.JSONDecoder()
+    messages = []
+    separator = None
+    position = opening.end()
+    while True:
+        try:
+            message, end = decoder.raw_decode(text, position)
+        except ValueError:
+            return None
+        if not isinstance(message, dict) or not isinstance(message.get("id"), str):
+            return None
+        messages.append((message["id"], text[position:end].encode()))
+        closing = CLOSING_PATTERN.fullmatch(text, end)
+        if closing is not None:
+            return [opening.group(), separator or "", closing.group()], messages
+        next_separator = SEPARATOR_PATTERN.match(text, end)
+        if next_separator is None or (separator is not None and next_separator.group() != separator):
+            return None
+        separator = next_separator.group()
+        position = next_separator.end()
+
+"""
+Returns the bytes of a page, from its skeleton and its messages' JSON bytes.
+"""
+def assemble(skeleton, messages):
+    opening, separator, closing = skeleton
+    return opening.encode() + separator.encode().join(messages) + closing.encode()
+
+"""
+Returns a page's manifest, given its skeleton and (message id, digest, reference) for each of its messages.
+"""
+def format_manifest(skeleton, message_refs):
+    lines = [PAGE_MAGIC + b" " + str(PAGE_VERSION).encode(), json.dumps(skeleton).encode()]
+    lines.extend(f"{message_id} {digest} {ref}".encode() for message_id, digest, ref in message_refs)
+    return b"\n".join(lines) + b"\n"
+
+"""
+Returns (skeleton, [(message id, digest, reference)]) for a manifest.
+"""
+def parse_manifest(manifest):
+    lines = manifest.decode().splitlines()
+    magic, version = lines[0].split()
+    if magic.encode() != PAGE_MAGIC or int(version) != PAGE_VERSION:
+        raise ValueError("not a message page manifest")
+    skeleton = json.loads(lines[1])
+    return skeleton, [tuple(line.split(" ")) for line in lines[2:]]
@@ -0,0 +1,398 @@
+"""
+A SQLite database of the messages, users, members, channels, guilds and attachments in a traffic archive.
+
+The raw archive stays the source of truth; this is a cache of what the exporters would get out of it by replaying
+every message list response and every Gateway. With witm_message_store, Wumpus In The Middle keeps it up to date
+as traffic arrives (on its own thread), and `archive_tool.py ingest-messages` builds it from an existing archive.
+Then `exporter.py dcejson --from-message-store` can read it instead of replaying everything.
+
+Observations are folded in the same way the dcejson exporter folds them while replaying, so exports come out the same:
+ - guilds and channels keep their newest observation.
+ - users and members keep a history of how they changed over time, as rows keyed by when they were seen.
+     A row is only added if it differs from the one before it, like the exporter's observe_eternalistically.
+ - messages keep their newest observation (a deleted message keeps NULL data),
+     and message_revisions every distinct version of each one, for edit history.
+ - attachments has each attachment's metadata, from the newest version of its message.
+Seen timestamps are seconds since the epoch, like in the indexes. Ids are Discord snowflakes, as integers.
+
+Gateway events are timestamped with when their Gateway connected, like the exporters' replay does.
+
+Only one process should write to a database at a time, and a MessageStore should only be used on the thread that opened it.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+
+from . import commands
+from .gateways import DECOMPRESSION_ERRORS, decode_payload, gateway_query, read_payloads
+from .index import read_request_index, open_index, GATEWAY_INDEX
+from .storage import ResponseStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    id INTEGER PRIMARY KEY,
+    seen REAL NOT NULL,
+    name TEXT,
+    icon TEXT,
+    roles TEXT NOT NULL -- JSON list of {id, color}
+);
+CREATE TABLE IF NOT EXISTS channels (
+    id INTEGER PRIMARY KEY,
+    seen REAL NOT NULL,
+    guild_id INTEGER, -- NULL for DMs
+    type INTEGER,
+    name TEXT,
+    topic TEXT,
+    parent_id TEXT,
+    recipient_ids TEXT -- JSON list, for DMs
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER NOT NULL,
+    seen REAL NOT NULL,
+    username TEXT,
+    discriminator TEXT,
+    avatar TEXT,
+    PRIMARY KEY (id, seen)
+);
+CREATE TABLE IF NOT EXISTS bots ( -- whether a user is a bot; Discord only says so sometimes, and it never changes
+    user_id INTEGER PRIMARY KEY,
+    bot INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    user_id INTEGER NOT NULL,
+    guild_id INTEGER NOT NULL,
+    seen REAL NOT NULL,
+    nick TEXT,
+    avatar TEXT,
+    roles TEXT NOT NULL, -- JSON list of role ids
+    PRIMARY KEY (user_id, guild_id, seen)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER,
+    seen REAL NOT NULL,
+    mechanism TEXT NOT NULL, -- REST, MESSAGE_CREATE, MESSAGE_UPDATE or MESSAGE_DELETE
+    data TEXT -- the Discord Message object as JSON, or NULL if it was deleted
+);
+CREATE TABLE IF NOT EXISTS message_revisions (
+    message_id INTEGER NOT NULL,
+    seen REAL NOT NULL,
+    mechanism TEXT NOT NULL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS message_revisions_by_message ON message_revisions (message_id, seen);
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY,
+    message_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    filename TEXT,
+    content_type TEXT,
+    size INTEGER,
+    width INTEGER,
+    height INTEGER,
+    url TEXT,
+    proxy_url TEXT
+);
+"""
+
+def message_store_path(archive_path):
+    return os.path.join(archive_path, "messages.sqlite")
+
+class MessageStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        # Each write transaction is one batch of observations; WAL lets exporters read while the recorder writes.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    #### Writing ####
+
+    """
+    Observe the contents of a message list response, as recorded at seen.
+    """
+    def observe_messages_response(self, seen, content):
+        dmos = json.loads(content)
+        if isinstance(dmos, dict): # if there's only one then Discord fails to encapsulate it in an array??
+            dmos = [dmos]
+        for dmo in dmos:
+            self.observe_dmo(seen, dmo, "REST")
+
+    """
+    Observe a decoded Gateway payload. Events that don't say anything about messages and who sent them are ignored.
+    """
+    def observe_gateway_payload(self, seen, payload):
+        event_name, event = payload.get("t"), payload.get("d")
+        if event_name in ("MESSAGE_CREATE", "MESSAGE_UPDATE"):
+            self.observe_dmo(seen, event, event_name)
+        elif event_name == "MESSAGE_DELETE":
+            self.observe_message_deletion(seen, int(event["channel_id"]), int(event["id"]), event_name)
+        elif event_name == "READY":
+            for user_dao in event["users"] + [event["user"]]:
+                self.observe_user(seen, user_dao)
+            for channel_dao in event["private_channels"]:
+                self.observe_channel(seen, channel_dao, None)
+            for guild_dao in event["guilds"]:
+                self.observe_guild(seen, guild_dao)
+                for channel_dao in guild_dao["channels"]:
+                    self.observe_channel(seen, channel_dao, int(guild_dao["id"]))
+        elif event_name == "GUILD_MEMBER_LIST_UPDATE":
+            # see https://arandomnewaccount.gitlab.io/discord-unofficial-docs/lazy_guilds.html
+            for op in event["ops"]:
+                if op["op"] in ("INSERT", "UPDATE"):
+                    op_items = [op["item"]]
+                elif op["op"] == "SYNC":
+                    op_items = op["items"]
+                else:
+                    continue
+                for op_item in op_items:
+                    if "member" in op_item: # skip member "groups" formed by hoisted roles
+                        self.observe_member(seen, op_item["member"], int(event["guild_id"]))
+
+    def observe_dmo(self, seen, dmo, mechanism):
+        if "author" in dmo:
+            self.observe_user(seen, dmo["author"])
+        if "code" in dmo or "captcha_key" in dmo: # an error, like "Cannot send messages to this user"
+            return
+        message_id, channel_id = int(dmo["id"]), int(dmo["channel_id"])
+        author_id = int(dmo["author"]["id"]) if "author" in dmo else None
+        data = json.dumps(dmo)
+        if self.observe_message(seen, message_id, channel_id, author_id, mechanism, data):
+            self.connection.execute("DELETE FROM attachments WHERE message_id = ?", (message_id,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        int(attachment["id"]), message_id, channel_id, attachment.get("filename"), attachment.get("content_type"),
+                        attachment.get("size"), attachment.get("width"), attachment.get("height"),
+                        attachment.get("url"), attachment.get("proxy_url")
+                    )
+                    for attachment in dmo.get("attachments", ())
+                ]
+            )
+
+    def observe_message_deletion(self, seen, channel_id, message_id, mechanism):
+        self.observe_message(seen, message_id, channel_id, None, mechanism, None)
+
+    """
+    Record a version of a message (data is None for a deletion). Returns whether it's now the newest one.
+    Ties go to the later observation, like in the exporters.
+    """
+    def observe_message(self, seen, message_id, channel_id, author_id, mechanism, data):
+        latest_revision = self.connection.execute(
+            "SELECT data FROM message_revisions WHERE message_id = ? AND seen <= ? ORDER BY seen DESC, rowid DESC LIMIT 1",
+            (message_id, seen)
+        ).fetchone()
+        if latest_revision is None or latest_revision[0] != data:
+            self.connection.execute("INSERT INTO message_revisions VALUES (?, ?, ?, ?)", (message_id, seen, mechanism, data))
+
+        current = self.connection.execute("SELECT seen FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if current is None:
+            self.connection.execute(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", (message_id, channel_id, author_id, seen, mechanism, data)
+            )
+            return True
+        if seen >= current[0]:
+            # Update in place rather than replacing the row, so messages keep the order they were first seen in.
+            self.connection.execute(
+                "UPDATE messages SET author_id = coalesce(?, author_id), seen = ?, mechanism = ?, data = ? WHERE id = ?",
+                (author_id, seen, mechanism, data, message_id)
+            )
+            return True
+        return False
+
+    def observe_user(self, seen, user_dao):
+        user_id = int(user_dao["id"])
+        self.observe_history(
+            "users", ("id",), (user_id,), seen,
+            {"username": user_dao["username"], "discriminator": user_dao["discriminator"], "avatar": user_dao["avatar"]}
+        )
+        if "bot" in user_dao:
+            self.connection.execute("INSERT OR IGNORE INTO bots VALUES (?, ?)", (user_id, user_dao["bot"]))
+
+    def observe_member(self, seen, member_dao, guild_id):
+        self.observe_history(
+            "members", ("user_id", "guild_id"), (int(member_dao["user"]["id"]), guild_id), seen,
+            {"nick": member_dao["nick"], "avatar": member_dao["avatar"], "roles": json.dumps(member_dao["roles"])}
+        )
+        self.observe_user(seen, member_dao["user"])
+
+    """
+    Add a row to a history table, unless the state at that time is already known.
+    Like the dcejson exporter's observe_eternalistically, a row that matches the one before it is redundant,
+    and so is the one after it if it matches the new one.
+    """
+    def observe_history(self, table, key_columns, key, seen, state):
+        key_condition = " AND ".join(f"{column} = ?" for column in key_columns)
+        columns = ", ".join(state)
+        def row_at(comparison, order):
+            return self.connection.execute(
+                f"SELECT seen, {columns} FROM {table} WHERE {key_condition} AND seen {comparison} ? ORDER BY seen {order} LIMIT 1",
+                (*key, seen)
+            ).fetchone()
+
+        if row_at("=", "ASC") is not None:
+            return
+        values = tuple(state.values())
+        previous = row_at("<", "DESC")
+        if previous is not None and previous[1:] == values:
+            return
+        self.connection.execute(
+            f"INSERT INTO {table} ({', '.join(key_columns)}, seen, {columns}) VALUES ({', '.join('?' * (len(key) + 1 + len(values)))})",
+            (*key, seen, *values)
+        )
+        following = row_at(">", "ASC")
+        if following is not None and following[1:] == values:
+            self.connection.execute(f"DELETE FROM {table} WHERE {key_condition} AND seen = ?", (*key, following[0]))
+
+    def observe_guild(self, seen, guild_dao):
+        self.connection.execute(
+            "INSERT INTO guilds VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET"
+            " seen = excluded.seen, name = excluded.name, icon = excluded.icon, roles = excluded.roles"
+            " WHERE excluded.seen > guilds.seen",
+            (
+                int(guild_dao["id"]), seen, guild_dao["properties"]["name"], guild_dao["properties"]["icon"],
+                json.dumps([{k: v for k, v in role_dao.items() if k in ("id", "color")} for role_dao in guild_dao["roles"]])
+            )
+        )
+
+    def observe_channel(self, seen, channel_dao, guild_id):
+        recipient_ids = channel_dao.get("recipient_ids")
+        self.connection.execute(
+            "INSERT INTO channels VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET"
+            " seen = excluded.seen, guild_id = excluded.guild_id, type = excluded.type, name = excluded.name,"
+            " topic = excluded.topic, parent_id = excluded.parent_id, recipient_ids = excluded.recipient_ids"
+            " WHERE excluded.seen > channels.seen",
+            (
+                int(channel_dao["id"]), seen, guild_id, channel_dao.get("type"), channel_dao.get("name"), channel_dao.get("topic"),
+                channel_dao.get("parent_id"), None if recipient_ids is None else json.dumps(recipient_ids)
+            )
+        )
+
+    #### Reading ####
+
+    """
+    Yields (id, seen, guild dao) for each guild, with the properties the exporters use.
+    """
+    def guilds(self):
+        for guild_id, seen, name, icon, roles in self.connection.execute("SELECT id, seen, name, icon, roles FROM guilds"):
+            yield guild_id, seen, {"id": str(guild_id), "properties": {"name": name, "icon": icon}, "roles": json.loads(roles)}
+
+    """
+    Yields (id, seen, guild id, channel dao) for each channel. The dao leaves out properties that were never seen.
+    """
+    def channels(self):
+        for channel_id, seen, guild_id, channel_type, name, topic, parent_id, recipient_ids in self.connection.execute(
+            "SELECT id, seen, guild_id, type, name, topic, parent_id, recipient_ids FROM channels"
+        ):
+            channel_dao = {"id": str(channel_id), "type": channel_type, "name": name, "topic": topic, "parent_id": parent_id}
+            if recipient_ids is not None:
+                channel_dao["recipient_ids"] = json.loads(recipient_ids)
+            yield channel_id, seen, guild_id, {k: v for k, v in channel_dao.items() if v is not None}
+
+    """
+    Yields (user id, seen, partial user dao) for each row of each user's history.
+    """
+    def user_history(self):
+        for user_id, seen, username, discriminator, avatar in self.connection.execute(
+            "SELECT id, seen, username, discriminator, avatar FROM users"
+        ):
+            yield user_id, seen, {"username": username, "discriminator": discriminator, "avatar": avatar}
+
+    """
+    Yields (user id, guild id, seen, partial member dao) for each row of each member's history.
+    """
+    def member_history(self):
+        for user_id, guild_id, seen, nick, avatar, roles in self.connection.execute(
+            "SELECT user_id, guild_id, seen, nick, avatar, roles FROM members"
+        ):
+            yield user_id, guild_id, seen, {"nick": nick, "avatar": avatar, "roles": json.loads(roles)}
+
+    def bots(self):
+        return dict(self.connection.execute("SELECT user_id, bot FROM bots"))
+
+    """
+    Yields (channel id, message id, seen, mechanism, dmo or None if deleted) for the newest version of each message,
+    in the order the messages were first seen.
+    """
+    def messages(self):
+        for channel_id, message_id, seen, mechanism, data in self.connection.execute(
+            "SELECT channel_id, id, seen, mechanism, data FROM messages ORDER BY rowid"
+        ):
+            yield channel_id, message_id, seen, mechanism, None if data is None else json.loads(data)
+
+
+"""
+Feeds a whole traffic archive into a MessageStore: every message list response, then every Gateway,
+in the order the exporters replay them.
+"""
+def ingest_archive(archive_path, store):
+    response_store = ResponseStore(archive_path)
+    response_count = 0
+    for entry in read_request_index(archive_path, route_tags={"channel_messages"}):
+        if not entry.is_success() or not entry.is_json() or not entry.has_content():
+            continue
+        try:
+            store.observe_messages_response(entry.seen_timestamp, response_store.read(entry.filename))
+        except Exception as e: # one odd response shouldn't stop the build, like in Wumpus In The Middle's ingester
+            print(f"Skipping {entry.url}: {e!r}")
+            continue
+        response_count += 1
+    store.commit()
+    print(f"Ingested {response_count} message list responses.")
+
+    gateway_count = 0
+    with open_index(archive_path, GATEWAY_INDEX) as index_file:
+        for line in index_file:
+            try:
+                seen, url, gateway_filename_prefix = line.split()
+                seen = float(seen)
+            except ValueError:
+                continue
+            encoding = gateway_query(url).get("encoding")
+            skipped = 0
+            try:
+                for _timestamp, payload in read_payloads(os.path.join(archive_path, "gateways", gateway_filename_prefix), url):
+                    try:
+                        store.observe_gateway_payload(seen, decode_payload(payload, encoding))
+                    except Exception as e: # nor should one odd event
+                        if not skipped:
+                            print(f"Skipping an event of Gateway {gateway_filename_prefix}: {e!r}")
+                        skipped += 1
+            except (FileNotFoundError, ValueError, RuntimeError, *DECOMPRESSION_ERRORS) as e:
+                print(f"Skipping the rest of Gateway {gateway_filename_prefix}: {e!r}")
+            if skipped > 1:
+                print(f"Skipped {skipped} events of Gateway {gateway_filename_prefix} in all.")
+            store.commit()
+            gateway_count += 1
+    print(f"Ingested {gateway_count} Gateways.")
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory. Per default 'traffic_archive/'", metavar="<dir>")
+
+@commands.register_command("ingest-messages", arg_parser, description="Build the message store (messages.sqlite) from everything in the archive, replacing it if it exists.")
+def ingest_messages_command(args):
+    path = message_store_path(args.traffic_archive)
+    # Build it next to the old one, so a half-built store never replaces a complete one.
+    for leftover in (path + ".new", path + ".new-wal", path + ".new-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    store = MessageStore(path + ".new")
+    ingest_archive(args.traffic_archive, store)
+    store.connection.execute("PRAGMA journal_mode=DELETE") # fold the WAL back in, so the database is one file to move
+    store.close()
+    for stale in (path + "-wal", path + "-shm"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    os.replace(path + ".new", path)
@@ -0,0 +1,82 @@
+"""
+Moves the response files in requests/ into pack files in packs/.
+
+Wumpus In The Middle can append new responses to pack files itself (the witm_packs option);
+this converts what an archive already has, so that requests/ doesn't keep millions of small files around.
+Contents are packed as stored, so compressed responses stay compressed.
+Works best after `dedupe`, since each distinct filename is only packed once.
+
+Don't run this while Wumpus In The Middle is recording to the same archive.
+"""
+
+import argparse
+import os
+
+from . import commands
+from .content import content_extension
+from .index import RequestIndexEntry, open_index, replace_request_index, discard_recorder_state
+from .packs import PackWriter, pack_ref, is_pack_ref
+from .storage import ResponseStore, COMPRESSED_SUFFIX, stored_encoding_suffix_of
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory to convert. Per default 'traffic_archive/'", metavar="<dir>")
+arg_parser.add_argument("--segment-size", type=int, default=256 * 1024 * 1024, help="start a new pack file once the current one has this many bytes. Per default 256 MiB", metavar="<bytes>")
+
+
+@commands.register_command("pack", arg_parser, description="Move the response files in requests/ into pack files in packs/.")
+def pack_command(args):
+    pack_archive(args.traffic_archive, args.segment_size)
+
+
+"""
+Returns the suffix a pack reference to a loose file should keep: its extension,
+its wire encoding or message page suffix if it has one, and .zst if it's compressed.
+"""
+def loose_file_suffix(filename):
+    compressed_suffix = COMPRESSED_SUFFIX if filename.endswith(COMPRESSED_SUFFIX) else ""
+    encoding_suffix = stored_encoding_suffix_of(filename)
+    return content_extension(filename.removesuffix(compressed_suffix).removesuffix(encoding_suffix)) + encoding_suffix + compressed_suffix
+
+
+def pack_archive(archive_path, segment_size):
+    store = ResponseStore(archive_path)
+    pack_writer = PackWriter(os.path.join(archive_path, "packs"), segment_size)
+
+    pack_refs = {} # loose filename : pack reference
+    bytes_packed = 0
+    new_lines = []
+    with open_index(archive_path) as index_file:
+        for line in index_file:
+            try:
+                entry = RequestIndexEntry.parse(line)
+            except ValueError:
+                new_lines.append(line)
+                continue
+            if is_pack_ref(entry.filename) or not entry.has_content():
+                new_lines.append(line)
+                continue
+            filename = entry.filename
+            if filename not in pack_refs:
+                if not os.path.exists(store.path(filename)):
+                    print(f"Missing {filename}; leaving its index entry alone.")
+                    new_lines.append(line)
+                    continue
+                stored = store.read_stored(filename)
+                segment, offset = pack_writer.append(stored)
+                pack_refs[filename] = pack_ref(segment, offset, len(stored), loose_file_suffix(filename))
+                bytes_packed += len(stored)
+            entry.filename = pack_refs[filename]
+            new_lines.append(entry.format())
+
+    # The packs have to be on the disk before the index points into them.
+    pack_writer.sync()
+    pack_writer.close()
+    replace_request_index(archive_path, new_lines)
+
+    # Only remove the loose files once the index no longer points at them.
+    for filename in pack_refs:
+        os.remove(store.path(filename))
+    # The recorder's map of packed contents doesn't know about these yet, and its asset maps point at the loose files;
+    # have them rebuilt on the next start.
+    discard_recorder_state(archive_path, "packed_contents", "asset_locations", "asset_variants", "archive_size")
+    print(f"Packed {len(pack_refs)} files ({bytes_packed} bytes).")
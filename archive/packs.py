@@ -0,0 +1,141 @@
+"""
+Pack files: response contents appended to a few big files instead of one small file each.
+
+A year of recording leaves millions of files in requests/, which makes listing, backing up and opening them slow.
+In pack mode, Wumpus In The Middle appends response contents to segments in packs/ instead,
+named {segment number}.pack, starting a new segment once the current one reaches a size limit.
+Segments are append-only, so a crash can at worst leave some unreferenced bytes at the end of the newest one.
+
+request_index refers to packed contents with a pack reference in place of a filename:
+@{segment}:{offset}:{length}{suffix}
+where suffix is whatever the file in requests/ would have ended with: the url's extension, then .zst if compressed.
+That way, anything that only looks at the end of a filename (like ResponseStore's .zst check) works on both.
+"""
+
+import mmap
+import os
+import re
+
+PACK_REF_PREFIX = "@"
+PACK_REF_PATTERN = re.compile(r"@(\d+):(\d+):(\d+)(.*)")
+
+def is_pack_ref(filename: str) -> bool:
+    return filename.startswith(PACK_REF_PREFIX)
+
+def pack_ref(segment: int, offset: int, length: int, suffix: str = "") -> str:
+    return f"{PACK_REF_PREFIX}{segment}:{offset}:{length}{suffix}"
+
+"""
+Returns (segment, offset, length, suffix) for a pack reference.
+"""
+def parse_pack_ref(ref: str):
+    match = PACK_REF_PATTERN.fullmatch(ref)
+    if match is None:
+        raise ValueError(f"{ref} is not a pack reference")
+    segment, offset, length, suffix = match.groups()
+    return int(segment), int(offset), int(length), suffix
+
+def segment_path(packs_path, segment: int) -> str:
+    return os.path.join(packs_path, f"{segment:06}.pack")
+
+"""
+Appends contents to the newest segment in packs_path, rotating to a new segment once it holds segment_size bytes.
+Only one PackWriter should write to a packs directory at a time, unless they're all shared:
+shared PackWriters (one per recorder instance, see witm_instance) only ever append to segments they created themselves.
+"""
+class PackWriter:
+    def __init__(self, packs_path, segment_size, shared=False):
+        self.packs_path = packs_path
+        self.segment_size = segment_size
+        self.shared = shared
+        os.makedirs(packs_path, exist_ok=True)
+        segments = [int(name.removesuffix(".pack")) for name in os.listdir(packs_path) if name.endswith(".pack")]
+        if shared: # the segment is created on the first append, so writers that never write leave nothing behind
+            self.file = None
+            self.segment = max(segments, default=-1) + 1
+        else:
+            self._open_segment(max(segments, default=0))
+
+    def _open_segment(self, segment):
+        self.segment = segment
+        self.file = open(segment_path(self.packs_path, segment), "ab")
+        self.offset = self.file.tell()
+
+    """
+    Starts the first segment from this one on that no other PackWriter has created yet.
+    """
+    def _create_segment(self, segment):
+        while True:
+            try:
+                self.file = open(segment_path(self.packs_path, segment), "xb")
+                break
+            except FileExistsError:
+                segment += 1
+        self.segment = segment
+        self.offset = 0
+
+    """
+    Appends contents, flushed to the OS by the time this returns. Returns (segment, offset) to reference them by.
+    """
+    def append(self, contents):
+        if self.file is None:
+            self._create_segment(self.segment)
+        elif self.offset and self.offset + len(contents) > self.segment_size:
+            self.file.close()
+            if self.shared:
+                self._create_segment(self.segment + 1)
+            else:
+                self._open_segment(self.segment + 1)
+        segment, offset = self.segment, self.offset
+        self.file.write(contents)
+        self.file.flush()
+        self.offset += len(contents)
+        return segment, offset
+
+    """
+    Makes sure everything appended so far is on the disk, not just in the OS's cache.
+    """
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+"""
+Reads packed contents by memory-mapping segments, so reads don't need a file open or a seek each.
+Segments stay mapped until close(). A segment that has grown since it was mapped is remapped when needed.
+"""
+class PackReader:
+    def __init__(self, packs_path):
+        self.packs_path = packs_path
+        self.mapped = {} # segment : mmap
+
+    def _map(self, segment, end):
+        segment_map = self.mapped.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(segment_path(self.packs_path, segment), "rb") as file:
+                segment_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped[segment] = segment_map
+        if len(segment_map) < end:
+            raise ValueError(f"segment {segment} ends before byte {end}; is the archive truncated?")
+        return segment_map
+
+    def read(self, segment, offset, length) -> bytes:
+        return self._map(segment, offset + length)[offset:offset + length]
+
+    """
+    Writes packed contents to an open file, straight from the mapping.
+    """
+    def write_to(self, file, segment, offset, length):
+        with memoryview(self._map(segment, offset + length))[offset:offset + length] as view:
+            file.write(view)
+
+    def close(self):
+        for segment_map in self.mapped.values():
+            segment_map.close()
+        self.mapped.clear()
@@ -0,0 +1,138 @@
+"""
+Capture policies: which Discord responses Wumpus In The Middle archives.
+
+A policy file has one rule per line, `{action} {method} {host} {path pattern}`; blank lines and lines starting with # are ignored.
+ - action: allow (archive it), deny (don't archive it), or metadata (add it to request_index without storing its contents)
+ - method: an HTTP method like GET, or * for any
+ - host: a host like discord.com, *.discord.com for discord.com and its subdomains, or * for any
+ - path pattern: a regular expression that the url's path (without the query) must match entirely
+The first rule that matches a response decides what happens to it; responses that no rule matches are archived.
+
+Rules are compiled once: a trie of host labels narrows them down to the ones for a host,
+and those are combined into a single regular expression per host and method, built the first time that pair comes up.
+Patterns that would mean something else inside a combined expression (numbered backreferences, named groups,
+conditionals, and flags like (?i) that apply to the whole expression) are matched on their own instead, in their turn.
+"""
+
+import functools
+import re
+
+ACTIONS = ("allow", "deny", "metadata")
+DEFAULT_ACTION = "allow"
+# Finds what can't be combined safely; it may find more than that (like an escaped backslash before a digit), which only costs speed.
+UNCOMBINABLE_PATTERN = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)")
+
+class PolicyRule:
+    def __init__(self, action, method, host, path_pattern):
+        self.action = action
+        self.method = method
+        self.host = host
+        self.path_pattern = path_pattern
+
+"""
+A host label trie node. Walking it from the top-level domain down finds the rules for a host.
+"""
+class HostTrieNode:
+    def __init__(self):
+        self.children = {} # label : HostTrieNode
+        self.exact_rules = [] # indexes of rules for exactly this host
+        self.subdomain_rules = [] # indexes of rules for this host and its subdomains
+
+class CapturePolicy:
+    def __init__(self, rules):
+        self.rules = rules
+        self.any_host_rules = []
+        self.host_trie = HostTrieNode()
+        for index, rule in enumerate(rules):
+            if rule.host == "*":
+                self.any_host_rules.append(index)
+                continue
+            subdomains = rule.host.startswith("*.")
+            node = self.host_trie
+            for label in reversed(rule.host.removeprefix("*.").split(".")):
+                node = node.children.setdefault(label, HostTrieNode())
+            (node.subdomain_rules if subdomains else node.exact_rules).append(index)
+        self.matcher = functools.lru_cache(maxsize=256)(self.compile_matcher)
+
+    """
+    Raises ValueError for lines that aren't rules, naming where they came from.
+    """
+    @classmethod
+    def parse(cls, text, source="policy"):
+        rules = []
+        for line_number, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split(None, 3)
+            if len(fields) != 4:
+                raise ValueError(f"{source}:{line_number}: expected {{action}} {{method}} {{host}} {{path pattern}}")
+            action, method, host, path_pattern = fields
+            if action not in ACTIONS:
+                raise ValueError(f"{source}:{line_number}: unknown action '{action}'; expected one of {', '.join(ACTIONS)}")
+            try:
+                re.compile(path_pattern)
+            except re.error as e:
+                raise ValueError(f"{source}:{line_number}: invalid path pattern: {e}")
+            rules.append(PolicyRule(action, method.upper(), host.lower(), path_pattern))
+        return cls(rules)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls.parse(file.read(), path)
+
+    """
+    Returns a list of (regular expression, [(group number, action)]) for the rules that apply to a method and host,
+    in their order: runs of rules that can be combined share one expression, with a group for each of them,
+    and every other rule gets an expression of its own. None if no rules apply.
+    """
+    def compile_matcher(self, method, host):
+        indexes = list(self.any_host_rules)
+        node = self.host_trie
+        labels = list(reversed(host.split(".")))
+        for depth, label in enumerate(labels):
+            node = node.children.get(label)
+            if node is None:
+                break
+            indexes.extend(node.subdomain_rules)
+            if depth == len(labels) - 1:
+                indexes.extend(node.exact_rules)
+        rules = [self.rules[index] for index in sorted(indexes) if self.rules[index].method in ("*", method)]
+        if not rules:
+            return None
+        matchers = []
+        alternatives = []
+        groups = [] # (group number, action)
+        group = 1
+        def finish_run():
+            nonlocal group
+            if alternatives:
+                matchers.append((re.compile("|".join(alternatives)), list(groups)))
+                alternatives.clear()
+                groups.clear()
+                group = 1
+        for rule in rules:
+            if UNCOMBINABLE_PATTERN.search(rule.path_pattern):
+                finish_run()
+                matchers.append((re.compile(rule.path_pattern), [(0, rule.action)]))
+                continue
+            alternatives.append(f"({rule.path_pattern})")
+            groups.append((group, rule.action))
+            group += 1 + re.compile(rule.path_pattern).groups
+        finish_run()
+        return matchers
+
+    """
+    Returns what to do with a response: "allow", "deny" or "metadata".
+    """
+    def action(self, method, host, path):
+        matchers = self.matcher(method.upper(), host.lower())
+        for pattern, groups in matchers or ():
+            match = pattern.fullmatch(path)
+            if match is None:
+                continue
+            for group, action in groups:
+                if match.group(group) is not None:
+                    return action
+        return DEFAULT_ACTION
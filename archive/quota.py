@@ -0,0 +1,270 @@
+"""
+Keeping a traffic archive under a size limit, by evicting what matters least first.
+
+With witm_quota, Wumpus In The Middle measures the archive once, then keeps a running total of how many bytes
+its contents take up, adding what it writes and taking off what it evicts (saved in state/archive_size,
+so it doesn't have to walk requests/ on every start). Once that passes the limit, it frees space down to QUOTA_TARGET
+of the limit, going through these tiers in order and taking only as much from each as it needs:
+ 1. variant: worse variants of attachments, embeds, avatars, icons and emoji, like supersede-variants does (see variants.py).
+     Nothing is lost; their entries point at the best variant's contents instead.
+ 2. media: images, video and audio of at least some size that haven't been fetched for some days, oldest first.
+ 3. page: message list responses whose messages are all, in the same version, on another archived page too, oldest first.
+     The messages stay; only the record of that page having been fetched then goes.
+Other message pages, Gateways, and everything else are never evicted, and neither are contents in pack files,
+which can't be deleted from the middle of a pack.
+Evicted entries stay in request_index, with - for their filename and evicted={tier} (see index.py),
+so exporters can tell that their contents are gone on purpose.
+
+The recorder plans evictions on a thread of its own, and caches the message keys of the pages it has looked at
+in state/page_keys (see PageKeyCache), so later evictions don't have to read every page again.
+`archive_tool.py evict` does the same to an archive that isn't being recorded to.
+"""
+
+import argparse
+import os
+import time
+
+from . import commands
+from .content import content_digest
+from .fingerprints import fingerprint
+from .index import NO_CONTENT, open_index, parse_index_lines, replace_request_index, discard_recorder_state
+from .message_pages import split_page
+from .packs import is_pack_ref
+from .storage import ResponseStore, stored_encoding_suffix_of
+from .variants import supersede_entries
+
+QUOTA_TARGET = 0.9 # evict down to this fraction of the limit, so eviction doesn't start over with the next response
+CONTENT_DIRECTORIES = ("requests", "packs", "message_packs", "gateways") # what the limit counts
+MEDIA_TYPES = ("image/", "video/", "audio/")
+DAY = 24 * 60 * 60
+
+"""
+Returns how many bytes the archive's contents take up, walking all of CONTENT_DIRECTORIES.
+"""
+def measure_archive(archive_path):
+    total = 0
+    for directory in CONTENT_DIRECTORIES:
+        for dirpath, _dirnames, filenames in os.walk(os.path.join(archive_path, directory)):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except FileNotFoundError: # removed while we were walking
+                    continue
+    return total
+
+def is_media(entry):
+    return entry.content_type is not None and entry.content_type.startswith(MEDIA_TYPES)
+
+"""
+What evicting from some lines of request_index would do.
+"""
+class EvictionPlan:
+    def __init__(self, lines):
+        self.lines = lines # the new lines
+        self.filenames = {} # files in requests/ to delete once the new lines are written : their size
+        self.changed = [] # (filename before, entry) for each entry that was evicted or superseded
+        self.bytes_freed = 0
+        self.counts = {} # tier : index entries changed
+
+    def summary(self):
+        return ", ".join(f"{count} {tier}" for tier, count in self.counts.items()) or "nothing"
+
+"""
+Returns the keys of the messages on a stored message list response: fingerprints of (message id, digest),
+the same keys as the recorder's message_blobs. None if it isn't a list of messages.
+"""
+def read_page_keys(store, filename):
+    page = split_page(store.read(filename))
+    if page is None:
+        return None
+    return frozenset(fingerprint(message_id, content_digest(message)) for message_id, message in page[1])
+
+"""
+read_page_keys, remembered in a file of lines `{filename} {comma-separated hex keys}`, or `{filename} -` for
+contents that aren't a list of messages. Contents are named after their digest, so their keys never change.
+"""
+class PageKeyCache:
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self.keys = None # filename : keys, loaded the first time they're needed
+        self.new_lines = []
+
+    def load(self):
+        self.keys = {}
+        try:
+            with open(self.path) as cache_file:
+                for line in cache_file:
+                    if not line.endswith("\n"): # cut short by a crash
+                        continue
+                    filename, _space, keys = line[:-1].partition(" ")
+                    try:
+                        self.keys[filename] = None if keys == "-" else frozenset(int(key, 16) for key in keys.split(",") if key)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+
+    def get(self, filename):
+        if self.keys is None:
+            self.load()
+        if filename not in self.keys:
+            keys = self.keys[filename] = read_page_keys(self.store, filename)
+            self.new_lines.append(self.format_line(filename, keys))
+        return self.keys[filename]
+
+    def save(self):
+        if self.new_lines:
+            with open(self.path, "a") as cache_file:
+                cache_file.writelines(self.new_lines)
+            self.new_lines = []
+
+    """
+    Forgets the keys of evicted files, rewriting the cache if any of them were in it.
+    """
+    def forget(self, filenames):
+        if self.keys is None:
+            self.load()
+        forgotten = [filename for filename in filenames if self.keys.pop(filename, False) is not False]
+        if not forgotten:
+            return
+        with open(self.path + ".new", "w") as cache_file:
+            cache_file.writelines(self.format_line(filename, keys) for filename, keys in self.keys.items())
+        os.replace(self.path + ".new", self.path)
+        self.new_lines = []
+
+    @staticmethod
+    def format_line(filename, keys):
+        return f"{filename} {'-' if keys is None else ','.join(format(key, 'x') for key in keys)}\n"
+
+"""
+Plans evictions from lines of request_index that free at least bytes_to_free bytes, if that's possible.
+Files in protected are referenced from somewhere other than these lines, so they're never deleted.
+Media is evictable once it hasn't been fetched for media_age seconds, and if its file is at least media_size bytes.
+page_keys returns the keys of a message page (see read_page_keys), like PageKeyCache.get; per default they're read from the page.
+"""
+def plan_evictions(store, lines, bytes_to_free, media_age, media_size, protected=frozenset(), now=None, page_keys=None):
+    now = time.time() if now is None else now
+    page_keys = page_keys or (lambda filename: read_page_keys(store, filename))
+    entries = parse_index_lines(lines)
+    filenames_before = [entry.filename if entry is not None else None for entry in entries]
+    changed = set() # ids of entries to write out again
+    plan = EvictionPlan(lines)
+
+    def references():
+        referencing = {} # filename : entries that reference it
+        for entry in entries:
+            if entry is not None and entry.has_content():
+                referencing.setdefault(entry.filename, []).append(entry)
+        return referencing
+
+    def stored_size(filename):
+        try:
+            return os.path.getsize(store.path(filename))
+        except FileNotFoundError:
+            return None
+
+    def free(filename, size):
+        plan.filenames[filename] = size
+        plan.bytes_freed += size
+
+    def evict(filename, referencing, tier):
+        size = stored_size(filename)
+        if size is None:
+            return
+        for entry in referencing:
+            entry.filename = NO_CONTENT
+            entry.evicted = tier
+            changed.add(id(entry))
+        plan.counts[tier] = plan.counts.get(tier, 0) + len(referencing)
+        free(filename, size)
+
+    def evictable(filename):
+        return not is_pack_ref(filename) and filename not in protected
+
+    # 1. variant
+    referenced_before = set(references())
+    superseded = supersede_entries(entries)
+    if superseded:
+        changed.update(id(entry) for entry in superseded)
+        plan.counts["variant"] = len(superseded)
+        for filename in referenced_before - set(references()):
+            size = stored_size(filename) if evictable(filename) else None
+            if size is not None:
+                free(filename, size)
+
+    # 2. media, least recently fetched first
+    if plan.bytes_freed < bytes_to_free:
+        candidates = []
+        for filename, referencing in references().items():
+            if not evictable(filename) or not all(is_media(entry) for entry in referencing):
+                continue
+            last_fetched = max(entry.seen_timestamp for entry in referencing)
+            size = stored_size(filename)
+            if now - last_fetched >= media_age and size is not None and size >= media_size:
+                candidates.append((last_fetched, filename, referencing))
+        for _last_fetched, filename, referencing in sorted(candidates, key=lambda candidate: candidate[0]):
+            if plan.bytes_freed >= bytes_to_free:
+                break
+            evict(filename, referencing, "media")
+
+    # 3. page, least recently fetched first
+    if plan.bytes_freed < bytes_to_free:
+        pages = [] # (last fetched, filename, referencing entries, message keys)
+        copies = {} # fingerprint(message id, digest) : how many pages it's on
+        for filename, referencing in references().items():
+            if not all(entry.get_route().tag == "channel_messages" and entry.status == 200 for entry in referencing):
+                continue
+            if not evictable(filename) or stored_encoding_suffix_of(filename) or stored_size(filename) is None:
+                continue # wire-encoded pages aren't worth decoding for this, and message page manifests are tiny
+            keys = page_keys(filename)
+            if keys is None:
+                continue
+            for key in keys:
+                copies[key] = copies.get(key, 0) + 1
+            pages.append((max(entry.seen_timestamp for entry in referencing), filename, referencing, keys))
+        for _last_fetched, filename, referencing, keys in sorted(pages, key=lambda page: page[0]):
+            if plan.bytes_freed >= bytes_to_free:
+                break
+            if all(copies[key] > 1 for key in keys):
+                for key in keys:
+                    copies[key] -= 1
+                evict(filename, referencing, "page")
+
+    plan.lines = [entry.format() if entry is not None and id(entry) in changed else line for line, entry in zip(lines, entries)]
+    plan.changed = [(before, entry) for before, entry in zip(filenames_before, entries) if entry is not None and id(entry) in changed]
+    return plan
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory. Per default 'traffic_archive/'", metavar="<dir>")
+arg_parser.add_argument("--limit", type=int, required=True, help="evict until the archive's contents take up no more than this many bytes", metavar="<bytes>")
+arg_parser.add_argument("--media-age", type=float, default=30, help="only evict media that hasn't been fetched for this many days. Per default 30", metavar="<days>")
+arg_parser.add_argument("--media-size", type=int, default=1024 * 1024, help="only evict media files at least this big. Per default 1 MiB", metavar="<bytes>")
+arg_parser.add_argument("-d", "--dry", action="store_true", help="report what would be evicted without changing anything")
+
+@commands.register_command("evict", arg_parser, description="Evict superseded variants, old media and duplicate message pages until the archive fits in a size limit.")
+def evict_command(args):
+    evict(args.traffic_archive, args.limit, args.media_age * DAY, args.media_size, dry_run=args.dry)
+
+
+def evict(archive_path, limit, media_age, media_size, dry_run=False):
+    size = measure_archive(archive_path)
+    if size <= limit:
+        print(f"The archive takes up {size} bytes, which is within the limit.")
+        return
+    store = ResponseStore(archive_path)
+    with open_index(archive_path) as index_file:
+        lines = list(index_file)
+    plan = plan_evictions(store, lines, size - limit, media_age, media_size)
+
+    if dry_run:
+        print(f"Would evict {plan.summary()} and free {plan.bytes_freed} of the {size - limit} bytes over the limit.")
+        return
+
+    replace_request_index(archive_path, plan.lines)
+    # Only remove the files once the index no longer points at them.
+    for filename in plan.filenames:
+        os.remove(store.path(filename))
+    discard_recorder_state(archive_path, "asset_locations", "asset_variants", "immutable_assets", "archive_size")
+    print(f"Evicted {plan.summary()}; freed {plan.bytes_freed} of the {size - limit} bytes over the limit.")
@@ -0,0 +1,110 @@
+"""
+Moves the files of an archive recorded before requests/ and gateways/ were sharded into their subdirectories.
+
+Response files go into the subdirectory of requests/ named after the start of their digest (see content.py),
+and Gateways into the subdirectory of gateways/ for the month they started in (see gateways.py).
+Files are moved (renamed) by several threads at once, which helps most on network filesystems, where every rename
+is a round trip. Then request_index and gateway_index are rewritten to point at the new paths.
+Response files that aren't named after their digest, from before `dedupe`, are left where they are; dedupe moves those.
+
+Readers find response files in either place (see storage.ResponseStore), so an interrupted run leaves a readable archive;
+run it again to finish. Don't run this while Wumpus In The Middle is recording to the same archive.
+"""
+
+import argparse
+import concurrent.futures
+import os
+
+from . import commands
+from .content import sharded_filename, is_digest_filename
+from .gateways import gateway_shard, GATEWAY_FILE_SUFFIXES
+from .index import GATEWAY_INDEX, open_index, parse_index_lines, replace_request_index, replace_index, discard_recorder_state
+from .packs import is_pack_ref
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory to convert. Per default 'traffic_archive/'", metavar="<dir>")
+arg_parser.add_argument("-j", "--jobs", type=int, default=16, help="how many files to move at once. Per default 16", metavar="<int>")
+arg_parser.add_argument("-d", "--dry", action="store_true", help="report what would be moved without changing anything")
+
+@commands.register_command("reshard", arg_parser, description="Move response and Gateway files into the subdirectories of requests/ and gateways/ that newer recordings use.")
+def reshard_command(args):
+    reshard_archive(args.traffic_archive, args.jobs, dry_run=args.dry)
+
+
+"""
+Moves a file, unless an earlier, interrupted run already did. Returns whether it's where it should be now.
+"""
+def move_file(old_path, new_path):
+    try:
+        os.replace(old_path, new_path)
+    except FileNotFoundError:
+        return os.path.exists(new_path)
+    return True
+
+def reshard_archive(archive_path, jobs, dry_run=False):
+    requests_path = os.path.join(archive_path, "requests")
+    gateways_path = os.path.join(archive_path, "gateways")
+
+    with open_index(archive_path) as index_file:
+        lines = list(index_file)
+    entries = parse_index_lines(lines)
+    moved_filenames = {} # old filename : new filename
+    unsharded_filenames = set() # not named after their digest
+    for entry in entries:
+        if entry is None or not entry.has_content() or is_pack_ref(entry.filename) or "/" in entry.filename:
+            continue
+        if is_digest_filename(entry.filename):
+            moved_filenames[entry.filename] = sharded_filename(entry.filename)
+        else:
+            unsharded_filenames.add(entry.filename)
+
+    with open_index(archive_path, GATEWAY_INDEX) as index_file:
+        gateway_lines = list(index_file)
+    moved_gateways = {} # old filename prefix : new filename prefix
+    for line in gateway_lines:
+        try:
+            timestamp, _url, gateway_filename_prefix = line.split()
+            timestamp = float(timestamp)
+        except ValueError:
+            continue
+        if "/" not in gateway_filename_prefix:
+            moved_gateways[gateway_filename_prefix] = gateway_shard(timestamp) + "/" + gateway_filename_prefix
+
+    print(f"{len(moved_filenames)} response files and {len(moved_gateways)} Gateways to move.")
+    if unsharded_filenames:
+        print(f"Leaving {len(unsharded_filenames)} response files that aren't named after their digest; run `archive_tool.py dedupe` to move them.")
+    if dry_run or not (moved_filenames or moved_gateways):
+        return
+
+    moves = [(os.path.join(requests_path, old), os.path.join(requests_path, new)) for old, new in moved_filenames.items()]
+    for old_prefix, new_prefix in moved_gateways.items():
+        for suffix in GATEWAY_FILE_SUFFIXES:
+            old_path = os.path.join(gateways_path, old_prefix + suffix)
+            if os.path.exists(old_path):
+                moves.append((old_path, os.path.join(gateways_path, new_prefix + suffix)))
+    for directory in {os.path.dirname(new_path) for _old_path, new_path in moves}:
+        os.makedirs(directory, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        missing = [old_path for (old_path, _new_path), moved in zip(moves, executor.map(lambda move: move_file(*move), moves)) if not moved]
+    for old_path in missing:
+        print(f"Missing {old_path}; pointing its index entry at where it would have gone anyway.")
+
+    # Only point the indexes at the new paths once the files are there.
+    new_lines = []
+    for line, entry in zip(lines, entries):
+        if entry is not None and entry.has_content() and entry.filename in moved_filenames:
+            entry.filename = moved_filenames[entry.filename]
+            line = entry.format()
+        new_lines.append(line)
+    replace_request_index(archive_path, new_lines)
+    new_gateway_lines = []
+    for line in gateway_lines:
+        fields = line.split()
+        if len(fields) == 3 and fields[2] in moved_gateways:
+            line = f"{fields[0]} {fields[1]} {moved_gateways[fields[2]]}\n"
+        new_gateway_lines.append(line)
+    replace_index(archive_path, GATEWAY_INDEX, new_gateway_lines)
+
+    # The recorder's asset maps know which layout each asset's file is in.
+    discard_recorder_state(archive_path, "asset_locations", "asset_variants")
+    print(f"Moved {len(moves) - len(missing)} files with {jobs} threads.")
@@ -0,0 +1,103 @@
+"""
+What a recorded url is: one compiled route table, shared by Wumpus In The Middle and the exporters.
+
+classify() maps a url to a Route: a tag like "channel_messages" or "avatar", plus the ids in the url.
+Wumpus In The Middle classifies each response as it records it and writes the route into request_index
+(see index.py), so exporters can dispatch on the tag instead of matching every url against their own patterns.
+Entries recorded before that are classified when they're read, with the same table.
+"""
+
+import functools
+import re
+import urllib.parse
+
+# Sniff traffic to these domains and their subdomains.
+DISCORD_DOMAINS = (
+    "discord.com",
+    "discord.net",
+    "discordapp.net",
+    "discordapp.com",
+    "discord.gg",
+    # The rest of these probably aren't used. Including them anyway:
+    "dis.gd",
+    "discord.co",
+    "discord.app",
+    "discord.dev",
+    "discord.new",
+    "discord.gift",
+    "discord.gifts",
+    "discord.media",
+    "discord.store",
+    "discordstatus.com",
+    "bigbeans.solutions",
+    "watchanimeattheoffice.com",
+)
+DISCORD_HOST_PATTERN = re.compile(r"(?:.+\.)?(?:" + "|".join(re.escape(domain) for domain in DISCORD_DOMAINS) + r")")
+
+"""
+Returns whether a hostname is one of Discord's domains or a subdomain of one.
+Cached, since the same handful of hosts come up over and over.
+"""
+@functools.lru_cache(maxsize=1024)
+def is_discord_host(hostname) -> bool:
+    return hostname is not None and DISCORD_HOST_PATTERN.fullmatch(hostname.lower()) is not None
+
+"""
+A url's tag, and the ids extracted from it (as strings, like they are in the url).
+"""
+class Route:
+    def __init__(self, tag, ids=None):
+        self.tag = tag
+        self.ids = ids or {}
+
+    def __repr__(self):
+        return f"Route({self.tag!r}, {self.ids!r})"
+
+OTHER = "other" # the tag for urls that don't match any route
+
+API_HOSTS = ("discord.com", "ptb.discord.com", "canary.discord.com", "discordapp.com")
+CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+
+# host : [(tag, compiled pattern for the path)], tried in order. Named groups become the route's ids.
+ROUTES = {}
+def add_route(tag, hosts, path_pattern):
+    for host in hosts:
+        ROUTES.setdefault(host, []).append((tag, re.compile(path_pattern)))
+
+add_route("channel_messages", API_HOSTS, r"/api/v\d+/channels/(?P<channel_id>\d+)/messages")
+add_route("guild_profile", API_HOSTS, r"/api/v\d+/guilds/(?P<guild_id>\d+)/profile")
+add_route("attachment", CDN_HOSTS, r"/attachments/(?P<channel_id>\d+)/(?P<attachment_id>\d+)/[^/]+")
+add_route("avatar", CDN_HOSTS, r"/avatars/(?P<user_id>\d+)/(?P<avatar_hash>[^/.]+)\.\w+")
+add_route("guild_icon", CDN_HOSTS, r"/icons/(?P<guild_id>\d+)/(?P<icon_hash>[^/.]+)\.\w+")
+add_route("channel_icon", CDN_HOSTS, r"/channel-icons/(?P<channel_id>\d+)/(?P<icon_hash>[^/.]+)\.\w+")
+add_route("emoji", CDN_HOSTS, r"/emojis/(?P<emoji_id>\d+)\.\w+")
+add_route("external_media", [f"images-ext-{i}.discordapp.net" for i in range(1, 5)], r"/external/.+")
+
+# tag : names of its ids, for reading them back out of request_index
+ROUTE_IDS = {OTHER: ()}
+for host_routes in ROUTES.values():
+    for tag, pattern in host_routes:
+        ROUTE_IDS[tag] = tuple(pattern.groupindex)
+
+def classify(url) -> Route:
+    parts = urllib.parse.urlsplit(url)
+    for tag, pattern in ROUTES.get(parts.hostname, ()):
+        match = pattern.fullmatch(parts.path)
+        if match:
+            return Route(tag, match.groupdict())
+    return Route(OTHER)
+
+# Routes whose contents never change for a given url, ignoring the signature parameters Discord adds to attachment urls.
+IMMUTABLE_TAGS = ("attachment", "avatar", "guild_icon", "channel_icon", "emoji")
+SIGNATURE_PARAMS = ("ex", "is", "hm") # expiry, issue time and HMAC; they change whenever Discord re-signs a url
+
+"""
+Returns a key that identifies an immutable asset's contents, or None if the url isn't one.
+The key is the url without its signature parameters, so re-signed urls for the same asset share it.
+"""
+def immutable_asset_key(url):
+    if classify(url).tag not in IMMUTABLE_TAGS:
+        return None
+    parts = urllib.parse.urlsplit(url)
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if key not in SIGNATURE_PARAMS]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query), fragment=""))
@@ -0,0 +1,275 @@
+"""
+Reads archived response contents, whichever way they were stored.
+
+The filename column of request_index names a file in requests/, or contents in packs/ (see packs.py).
+Files ending in .zst are zstd-compressed, possibly with a dictionary from dictionaries/.
+Files ending in +gzip, +deflate, +br or +zstd (before any .zst) are responses stored as they came over the wire,
+still in that Content-Encoding (see witm_raw_content).
+Files ending in +messages (before any .zst) are message list responses stored as manifests of their messages,
+which are in message_packs/ (see message_pages.py).
+Readers get the original contents back either way, so they should go through ResponseStore
+instead of opening files in requests/ themselves.
+"""
+
+import gzip
+import os
+import shutil
+import zlib
+
+from .content import sharded_filename, flat_filename
+from .message_pages import MESSAGE_PAGE_SUFFIX, MESSAGE_PACKS_DIRECTORY, assemble, parse_manifest
+from .packs import PackReader, is_pack_ref, parse_pack_ref
+
+try:
+    import pyzstd
+except ImportError: # mitmproxy's bundled Python usually lacks pyzstd; compression is optional there.
+    pyzstd = None
+
+try:
+    import brotli
+except ImportError: # only needed for responses stored with Content-Encoding br; mitmproxy always has it.
+    brotli = None
+
+COMPRESSED_SUFFIX = ".zst"
+
+# Content-Encoding : suffix of responses stored in that encoding.
+# A url's extension can't contain "+" (see content.py), so these can't be mistaken for one.
+WIRE_ENCODING_SUFFIXES = {"gzip": "+gzip", "x-gzip": "+gzip", "deflate": "+deflate", "br": "+br", "zstd": "+zstd"}
+
+"""
+Returns the suffix for a response stored in this Content-Encoding, or None if it can't be stored encoded
+(because it isn't encoded, or we wouldn't know how to decode it).
+"""
+def wire_encoding_suffix(content_encoding):
+    return WIRE_ENCODING_SUFFIXES.get((content_encoding or "").strip().lower())
+
+"""
+Returns the wire encoding suffix a filename or pack reference ends with (before any .zst), or "" if it has none.
+"""
+def wire_encoding_suffix_of(filename):
+    filename = filename.removesuffix(COMPRESSED_SUFFIX)
+    for suffix in WIRE_ENCODING_SUFFIXES.values():
+        if filename.endswith(suffix):
+            return suffix
+    return ""
+
+"""
+Returns the suffix a filename or pack reference ends with (before any .zst) that says its contents are stored in some form
+that has to be decoded to get the response back: a wire encoding suffix, or MESSAGE_PAGE_SUFFIX. "" if it has none.
+Either way, the file can't be renamed or rewritten without keeping the suffix.
+"""
+def stored_encoding_suffix_of(filename):
+    if filename.removesuffix(COMPRESSED_SUFFIX).endswith(MESSAGE_PAGE_SUFFIX):
+        return MESSAGE_PAGE_SUFFIX
+    return wire_encoding_suffix_of(filename)
+
+"""
+Returns the extension (like ".png") of a stored filename's response, leaving out the suffixes that say how it's stored,
+so exporters can name their copies after it.
+"""
+def stored_extension(filename):
+    filename = filename.removesuffix(COMPRESSED_SUFFIX)
+    filename = filename.removesuffix(stored_encoding_suffix_of(filename))
+    return os.path.splitext(filename)[1]
+
+"""
+Decodes a response stored in the wire encoding with this suffix.
+"""
+def decode_wire(stored, suffix):
+    if suffix == "+gzip":
+        return gzip.decompress(stored)
+    if suffix == "+deflate":
+        try:
+            return zlib.decompress(stored)
+        except zlib.error: # some servers send raw deflate streams, without the zlib header
+            return zlib.decompress(stored, -zlib.MAX_WBITS)
+    if suffix == "+br":
+        if brotli is None:
+            raise RuntimeError("This archive contains brotli-encoded responses; install Brotli to read them.")
+        return brotli.decompress(stored)
+    if suffix == "+zstd":
+        require_pyzstd()
+        return pyzstd.decompress(stored)
+    raise ValueError(f"unknown wire encoding suffix '{suffix}'")
+
+"""
+Returns whether a response with this content type is worth compressing.
+Images, video and audio are already compressed, so they're left alone.
+"""
+def is_compressible_content_type(content_type: str) -> bool:
+    media_type = content_type.split(";")[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type in ("application/json", "application/javascript", "application/xml", "image/svg+xml")
+        or media_type.endswith("+json")
+    )
+
+def require_pyzstd():
+    if pyzstd is None:
+        raise RuntimeError("This archive contains zstd-compressed responses; install pyzstd to read them.")
+
+"""
+Loads zstd dictionaries from an archive's dictionaries/ directory.
+Each dictionary is saved as {dictionary id}.zdict, so a compressed file's frame header tells us which one it needs.
+"""
+class DictionaryDirectory:
+    def __init__(self, dictionaries_path):
+        self.dictionaries_path = dictionaries_path
+        self.loaded = {} # dictionary id : ZstdDict
+
+    def get(self, dict_id):
+        if dict_id not in self.loaded:
+            with open(os.path.join(self.dictionaries_path, f"{dict_id}.zdict"), "rb") as file:
+                self.loaded[dict_id] = pyzstd.ZstdDict(file.read())
+        return self.loaded[dict_id]
+
+    """
+    Returns the most recently trained dictionary, or None if there aren't any.
+    """
+    def newest(self):
+        if not os.path.isdir(self.dictionaries_path):
+            return None
+        names = [name for name in os.listdir(self.dictionaries_path) if name.endswith(".zdict")]
+        if not names:
+            return None
+        newest_name = max(names, key=lambda name: os.path.getmtime(os.path.join(self.dictionaries_path, name)))
+        return self.get(int(newest_name.removesuffix(".zdict")))
+
+    def save(self, zstd_dict):
+        os.makedirs(self.dictionaries_path, exist_ok=True)
+        path = os.path.join(self.dictionaries_path, f"{zstd_dict.dict_id}.zdict")
+        with open(path + ".new", "wb") as file:
+            file.write(zstd_dict.dict_content)
+        os.replace(path + ".new", path)
+        return path
+
+"""
+Compress response contents for storage, with the dictionary if there is one.
+"""
+def compress(content, zstd_dict=None, level=3):
+    require_pyzstd()
+    return pyzstd.compress(content, level, zstd_dict)
+
+"""
+Access to the response contents in an archive's requests/ and packs/ directories, by their request_index filename.
+"""
+class ResponseStore:
+    def __init__(self, archive_path):
+        self.requests_path = os.path.join(archive_path, "requests")
+        self.packs = PackReader(os.path.join(archive_path, "packs"))
+        self.message_packs = PackReader(os.path.join(archive_path, MESSAGE_PACKS_DIRECTORY))
+        self.dictionaries = DictionaryDirectory(os.path.join(archive_path, "dictionaries"))
+
+    """
+    Returns the path of a file in requests/. Packed contents don't have one.
+    Files that aren't where their filename says, because `archive_tool.py reshard` moved them in or out of
+    a subdirectory since the filename was read, are found in the other layout (see content.py).
+    """
+    def path(self, filename):
+        path = os.path.join(self.requests_path, filename)
+        if not os.path.exists(path):
+            other_path = os.path.join(self.requests_path, flat_filename(filename) if "/" in filename else sharded_filename(filename))
+            if os.path.exists(other_path):
+                return other_path
+        return path
+
+    """
+    Returns the contents as stored, so still compressed if they were.
+    """
+    def read_stored(self, filename) -> bytes:
+        if is_pack_ref(filename):
+            segment, offset, length, _suffix = parse_pack_ref(filename)
+            return self.packs.read(segment, offset, length)
+        with open(self.path(filename), "rb") as file:
+            return file.read()
+
+    """
+    Returns the first bytes of the contents as stored.
+    """
+    def read_stored_head(self, filename, size) -> bytes:
+        if is_pack_ref(filename):
+            segment, offset, length, _suffix = parse_pack_ref(filename)
+            return self.packs.read(segment, offset, min(length, size))
+        with open(self.path(filename), "rb") as file:
+            return file.read(size)
+
+    def read(self, filename) -> bytes:
+        contents = self.read_stored(filename)
+        if filename.endswith(COMPRESSED_SUFFIX):
+            contents = self.decompress(contents)
+        encoding_suffix = stored_encoding_suffix_of(filename)
+        if encoding_suffix == MESSAGE_PAGE_SUFFIX:
+            contents = self.read_message_page(contents)
+        elif encoding_suffix:
+            contents = decode_wire(contents, encoding_suffix)
+        return contents
+
+    """
+    Reassembles a message list response from its manifest.
+    """
+    def read_message_page(self, manifest):
+        skeleton, message_refs = parse_manifest(manifest)
+        return assemble(skeleton, [self.read_message(ref) for _message_id, _digest, ref in message_refs])
+
+    """
+    Returns one message's JSON, given its reference into message_packs/.
+    """
+    def read_message(self, ref):
+        segment, offset, length, suffix = parse_pack_ref(ref)
+        message = self.message_packs.read(segment, offset, length)
+        if suffix.endswith(COMPRESSED_SUFFIX):
+            message = self.decompress(message)
+        return message
+
+    """
+    Returns whether the contents are stored in some encoding, so reading them means decoding them.
+    """
+    def is_encoded(self, filename):
+        return filename.endswith(COMPRESSED_SUFFIX) or stored_encoding_suffix_of(filename) != ""
+
+    def decompress(self, stored):
+        require_pyzstd()
+        dict_id = pyzstd.get_frame_info(stored).dictionary_id
+        return pyzstd.decompress(stored, self.dictionaries.get(dict_id) if dict_id else None)
+
+    """
+    Returns the first bytes of a response, for sniffing its file type.
+    """
+    def head(self, filename, size=8192) -> bytes:
+        if self.is_encoded(filename):
+            return self.read(filename)[:size]
+        return self.read_stored_head(filename, size)
+
+    """
+    Returns the size of a response's original contents.
+    """
+    def size(self, filename) -> int:
+        if stored_encoding_suffix_of(filename):
+            return len(self.read(filename))
+        if filename.endswith(COMPRESSED_SUFFIX):
+            require_pyzstd()
+            decompressed_size = pyzstd.get_frame_info(self.read_stored_head(filename, 18)).decompressed_size # 18 bytes is a zstd frame header's max size
+            if decompressed_size is not None:
+                return decompressed_size
+            return len(self.read(filename))
+        if is_pack_ref(filename):
+            return parse_pack_ref(filename)[2]
+        return os.path.getsize(self.path(filename))
+
+    """
+    Copies a response's original contents to destination, a path outside the archive.
+    """
+    def copy(self, filename, destination):
+        if self.is_encoded(filename):
+            with open(destination, "wb") as file:
+                file.write(self.read(filename))
+        elif is_pack_ref(filename):
+            segment, offset, length, _suffix = parse_pack_ref(filename)
+            with open(destination, "wb") as file:
+                self.packs.write_to(file, segment, offset, length)
+        else:
+            shutil.copyfile(self.path(filename), destination)
+
+    def close(self):
+        self.packs.close()
+        self.message_packs.close()
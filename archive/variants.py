@@ -0,0 +1,124 @@
+"""
+Variants of one asset: the sizes Discord serves an attachment, embed, avatar, icon or emoji in.
+
+The client fetches lots of them: media proxy thumbnails of an attachment (?width=&height=) as well as the original,
+avatars at ?size=64 and ?size=128, and so on. The exporters only ever use the best one (see observe_biggest in dcejson),
+so there's no need to keep the rest. Variants of an asset share its url's path; originals, without a size, beat any resized
+variant, and otherwise bigger beats smaller, like observe_biggest decides.
+
+The supersede-variants command points the index entries of worse variants at the best one's contents, marking them
+superseded=1 (see index.py), and deletes the files in requests/ that nothing points to anymore.
+Contents in packs/ can't be deleted from the middle of a pack, so those stay.
+Wumpus In The Middle does the same as it goes with witm_supersede_variants,
+for variants that come in after a better one has already been archived.
+
+Don't run the command while Wumpus In The Middle is recording to the same archive.
+"""
+
+import argparse
+import os
+import urllib.parse
+
+from . import commands
+from .index import open_index, parse_index_lines, replace_request_index, discard_recorder_state
+from .packs import is_pack_ref
+from .storage import ResponseStore
+
+VARIANT_TAGS = ("attachment", "external_media", "avatar", "guild_icon", "channel_icon", "emoji")
+ORIGINAL_SIZE = (1 << 64) - 1 # the score of originals; it fits in a FingerprintTable value
+
+"""
+Returns (asset identity, score) for a url whose response is one variant of an asset, or None for other urls.
+A variant with a higher score is better.
+"""
+def asset_variant(url, route_tag):
+    if route_tag not in VARIANT_TAGS:
+        return None
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(parts.query)
+    if route_tag in ("attachment", "external_media"):
+        size_params = [query[name][0] for name in ("width", "height") if name in query]
+    else:
+        size_params = [query["size"][0]] if "size" in query else []
+    if not all(param.isdigit() for param in size_params):
+        return None
+    score = ORIGINAL_SIZE
+    if size_params:
+        score = 1
+        for param in size_params:
+            score *= int(param)
+    return parts.path, score
+
+"""
+Returns (asset identity, score) for an index entry of a complete response that's a variant of an asset, or None.
+"""
+def entry_variant(entry):
+    if entry.status != 200 or not entry.has_content():
+        return None
+    return asset_variant(entry.url, entry.get_route().tag)
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-t", "--traffic-archive", default="traffic_archive/", help="The traffic archive directory. Per default 'traffic_archive/'", metavar="<dir>")
+arg_parser.add_argument("-d", "--dry", action="store_true", help="report what would be superseded without changing anything")
+
+@commands.register_command("supersede-variants", arg_parser, description="Keep only the best variant (size) of each attachment, avatar, icon and emoji.")
+def supersede_variants_command(args):
+    supersede_variants(args.traffic_archive, dry_run=args.dry)
+
+
+"""
+Points the entries of worse variants of each asset at the contents of its best variant, marking them superseded.
+entries are RequestIndexEntry objects, or None for lines that aren't entries. Returns the entries it changed.
+"""
+def supersede_entries(entries):
+    best = {} # asset identity : (score, filename) of its best variant; the first one archived wins ties
+    for entry in entries:
+        variant = entry_variant(entry) if entry is not None else None
+        if variant is None or entry.superseded: # superseded entries don't hold their own contents
+            continue
+        identity, score = variant
+        if identity not in best or score > best[identity][0]:
+            best[identity] = (score, entry.filename)
+
+    superseded = []
+    for entry in entries:
+        variant = entry_variant(entry) if entry is not None else None
+        if variant is None:
+            continue
+        identity, score = variant
+        best_score, best_filename = best.get(identity, (score, entry.filename))
+        # Entries superseded before follow their asset's best variant, in case a better one has come in since.
+        if (entry.superseded or best_score > score) and best_filename != entry.filename:
+            entry.filename = best_filename
+            entry.superseded = True
+            superseded.append(entry)
+    return superseded
+
+def supersede_variants(archive_path, dry_run=False):
+    store = ResponseStore(archive_path)
+    with open_index(archive_path) as index_file:
+        lines = list(index_file)
+    entries = parse_index_lines(lines)
+    old_filenames = {entry.filename for entry in entries if entry is not None}
+    superseded = {id(entry) for entry in supersede_entries(entries)}
+    superseded_count = len(superseded)
+    new_lines = [entry.format() if entry is not None and id(entry) in superseded else line for line, entry in zip(lines, entries)]
+    referenced = {entry.filename for entry in entries if entry is not None}
+
+    unreferenced = [
+        filename for filename in old_filenames - referenced
+        if not is_pack_ref(filename) and os.path.exists(store.path(filename))
+    ]
+    bytes_freed = sum(os.path.getsize(store.path(filename)) for filename in unreferenced)
+
+    if dry_run:
+        print(f"Would supersede {superseded_count} index entries and free {bytes_freed} bytes.")
+        return
+
+    replace_request_index(archive_path, new_lines)
+    # Only remove the files once the index no longer points at them.
+    for filename in unreferenced:
+        os.remove(store.path(filename))
+    discard_recorder_state(archive_path, "asset_locations", "asset_variants", "archive_size")
+    print(f"Superseded {superseded_count} index entries; freed {bytes_freed} bytes.")
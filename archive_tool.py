@@ -0,0 +1,14 @@
+"""
+Maintenance commands for traffic archives recorded by Wumpus In The Middle.
+
+Run `python3 archive_tool.py -h` to list the available commands.
+Commands are registered in the archive package, similar to how exporter.py works.
+"""
+
+# noinspection PyUnusedImports
+import archive.dedupe, archive.compression, archive.packing, archive.gateways, archive.message_store, archive.variants, archive.quota, archive.resharding
+
+import archive.commands as archive_commands
+
+if __name__ == "__main__":
+    archive_commands.parse_args_and_run()
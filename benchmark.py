@@ -0,0 +1,434 @@
+"""
+Replays synthetic Discord traffic through Wumpus In The Middle, to measure how much it slows the client down.
+
+Drives a DiscordArchiver with mitmproxy's test flows, shaped like what the client fetches:
+gzipped message list responses (with revisits of the newest page of a channel, mostly unchanged),
+CDN attachments, avatars and media proxy thumbnails of various sizes (with repeat downloads),
+and long zlib-stream Gateways with a READY followed by a stream of dispatches.
+Each hook is called the way mitmproxy would call it, and timed: the time spent in hooks is what the proxy adds
+to every response's latency, since mitmproxy's event loop can't do anything else meanwhile.
+
+Reports, and writes to a JSON file so runs can be compared (see --compare):
+ - latency percentiles of each hook, and of all hooks of an HTTP flow together
+ - responses per second and bytes per second, from the first flow until the writer has finished writing everything
+ - the peak resident set size of the process, which includes the synthetic traffic itself
+
+Run it from the repository root, with mitmproxy importable:
+    python3 benchmark.py --set witm_background_writer=true -o writer.json
+    python3 benchmark.py --compare writer.json
+Options are passed to the addon like mitmproxy's --set. The archive goes to a temporary directory unless -t is given.
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from mitmproxy import hooks, websocket
+from mitmproxy.test import taddons, tflow
+from mitmproxy.version import VERSION as MITMPROXY_VERSION
+
+import wumpus_in_the_middle
+
+DISCORD_EPOCH = 1420070400000 # milliseconds
+TRAFFIC_START = 1704067200000 # when the synthetic traffic's snowflakes start, in milliseconds
+GATEWAY_URL = "wss://gateway.discord.gg/?encoding=json&v=9&compress=zlib-stream"
+STREAM_CHUNK_SIZE = 64 * 1024 # how much of a streamed body mitmproxy hands over at once, roughly
+PERCENTILES = (50, 90, 99)
+
+"""
+Synthetic, but plausibly shaped, Discord traffic. Deterministic for a given seed.
+"""
+class Traffic:
+    def __init__(self, seed, channels, users):
+        self.random = random.Random(seed)
+        self.clock = TRAFFIC_START # milliseconds; every snowflake moves it forward a little
+        self.channels = [self.snowflake() for _ in range(channels)]
+        self.users = [(self.snowflake(), f"user{i}", f"{self.random.getrandbits(128):032x}") for i in range(users)]
+        self.newest_pages = {} # channel id : ids of the messages on its newest page, newest first
+        self.fetched_assets = [] # (url, content type, size, content seed), to download again
+
+    def snowflake(self):
+        self.clock += self.random.randint(1, 5000)
+        return ((self.clock - DISCORD_EPOCH) << 22) | self.random.getrandbits(22)
+
+    def user_object(self, user):
+        user_id, username, avatar = user
+        return {"id": user_id, "username": username, "avatar": avatar, "discriminator": "0", "public_flags": 0, "flags": 0, "global_name": username.title()}
+
+    def message(self, message_id, channel_id):
+        words = self.random.randint(1, 60)
+        message = {
+            "type": 0, "content": " ".join(self.random.choice(("wumpus", "hello", "lol", "the", "discord", "ok", "archive")) for _ in range(words)),
+            "mentions": [], "mention_roles": [], "attachments": [], "embeds": [], "components": [],
+            "id": message_id, "channel_id": channel_id,
+            "author": self.user_object(self.random.choice(self.users)),
+            "pinned": False, "mention_everyone": False, "tts": False,
+            "timestamp": "2024-01-01T00:00:00.000000+00:00", "edited_timestamp": None, "flags": 0,
+        }
+        if self.random.random() < 0.1:
+            attachment_id = str(int(message_id) + 1)
+            message["attachments"].append({
+                "id": attachment_id, "filename": "image.png", "size": self.random.randint(10000, 4000000),
+                "url": f"https://cdn.discordapp.com/attachments/{channel_id}/{attachment_id}/image.png",
+                "proxy_url": f"https://media.discordapp.net/attachments/{channel_id}/{attachment_id}/image.png",
+                "width": 1920, "height": 1080, "content_type": "image/png",
+            })
+        return message
+
+    """
+    Returns (url, JSON body) of a page of 50 messages: older messages in a channel, the newest page of a channel
+    the client hasn't opened yet, or, for a channel it has, the newest page again with a few new messages.
+    """
+    def message_page(self, revisit_fraction):
+        channel_id = self.random.choice(self.channels)
+        newest = self.newest_pages.get(channel_id)
+        if newest is not None and self.random.random() < revisit_fraction:
+            ids = ([str(self.snowflake()) for _ in range(self.random.randint(0, 3))] + newest)[:50]
+            url = f"https://discord.com/api/v9/channels/{channel_id}/messages?limit=50"
+            self.newest_pages[channel_id] = ids
+        elif newest is not None:
+            before = int(newest[-1]) - self.random.getrandbits(30)
+            ids = [str(before - 1000 * i) for i in range(1, 51)]
+            url = f"https://discord.com/api/v9/channels/{channel_id}/messages?before={before}&limit=50"
+        else:
+            ids = sorted((str(self.snowflake()) for _ in range(50)), reverse=True)
+            url = f"https://discord.com/api/v9/channels/{channel_id}/messages?limit=50"
+            self.newest_pages[channel_id] = ids
+        # Seeding by message id keeps unchanged messages the same when a page is fetched again.
+        messages = []
+        for message_id in ids:
+            state = self.random.getstate()
+            self.random.seed(message_id)
+            messages.append(self.message(message_id, str(channel_id)))
+            self.random.setstate(state)
+        return url, json.dumps(messages).encode()
+
+    """
+    Returns (url, content type, size, content seed) of a CDN download: an attachment, its media proxy thumbnail,
+    or an avatar. Some are downloads of something already fetched.
+    """
+    def asset(self, repeat_fraction, max_size):
+        if self.fetched_assets and self.random.random() < repeat_fraction:
+            return self.random.choice(self.fetched_assets)
+        kind = self.random.random()
+        if kind < 0.5:
+            user_id, _username, avatar = self.random.choice(self.users)
+            asset = (f"https://cdn.discordapp.com/avatars/{user_id}/{avatar}.webp?size={self.random.choice((32, 80, 128))}", "image/webp", self.random.randint(1000, 20000))
+        elif kind < 0.8:
+            channel_id, attachment_id = self.random.choice(self.channels), self.snowflake()
+            asset = (
+                f"https://media.discordapp.net/attachments/{channel_id}/{attachment_id}/image.png?ex=65a1b2c3&is=659f3d43&hm={self.random.getrandbits(256):064x}&width=400&height=225",
+                "image/webp", self.random.randint(10000, 100000)
+            )
+        else:
+            channel_id, attachment_id = self.random.choice(self.channels), self.snowflake()
+            # Log-uniform, so most attachments are small and a few are big.
+            size = int(10000 * (max_size / 10000) ** self.random.random())
+            asset = (f"https://cdn.discordapp.com/attachments/{channel_id}/{attachment_id}/image.png?ex=65a1b2c3&is=659f3d43&hm={self.random.getrandbits(256):064x}", "image/png", size)
+        asset += (self.random.getrandbits(32),)
+        self.fetched_assets.append(asset)
+        return asset
+
+    """
+    Returns the READY payload a user account gets: itself, its guilds with their channels, its DMs and group DMs,
+    and the users in those DMs.
+    """
+    def ready(self):
+        guilds = []
+        for i in range(5):
+            guild_id = str(self.snowflake())
+            guilds.append({
+                "id": guild_id, "data_mode": "full", "member_count": len(self.users),
+                "properties": {"id": guild_id, "name": f"guild {i}", "icon": f"{self.random.getrandbits(128):032x}", "owner_id": self.users[0][0]},
+                "roles": [{"id": guild_id, "name": "@everyone", "color": 0, "position": 0, "permissions": "104324673"}],
+                "channels": [
+                    {"id": str(channel_id), "type": 0, "name": f"channel {j}", "position": j, "topic": None, "parent_id": None}
+                    for j, channel_id in enumerate(self.channels) if j % 5 == i
+                ],
+            })
+        recipients = self.random.sample(self.users[1:], min(10, len(self.users) - 1))
+        private_channels = [
+            {"id": str(self.snowflake()), "type": 1, "recipient_ids": [user[0]], "last_message_id": str(self.snowflake()), "flags": 0}
+            for user in recipients[:8]
+        ]
+        if len(recipients) > 8:
+            private_channels.append({
+                "id": str(self.snowflake()), "type": 3, "name": "group chat", "icon": None, "owner_id": self.users[0][0],
+                "recipient_ids": [user[0] for user in recipients[8:]], "last_message_id": str(self.snowflake()), "flags": 0,
+            })
+        return {
+            "v": 9, "user": self.user_object(self.users[0]), "users": [self.user_object(user) for user in recipients],
+            "guilds": guilds, "private_channels": private_channels, "session_id": "0" * 32,
+        }
+
+    """
+    Returns the JSON payloads of a Gateway: READY, then dispatches like the ones a busy server sends.
+    """
+    def gateway_payloads(self, count):
+        yield json.dumps({"op": 0, "s": 1, "t": "READY", "d": self.ready()}).encode()
+        for sequence in range(2, count + 1):
+            kind = self.random.random()
+            channel_id = str(self.random.choice(self.channels))
+            user_id = self.random.choice(self.users)[0]
+            if kind < 0.4:
+                payload = {"op": 0, "t": "MESSAGE_CREATE", "d": self.message(str(self.snowflake()), channel_id)}
+            elif kind < 0.7:
+                payload = {"op": 0, "t": "TYPING_START", "d": {"user_id": user_id, "channel_id": channel_id, "timestamp": int(time.time())}}
+            elif kind < 0.95:
+                payload = {"op": 0, "t": "PRESENCE_UPDATE", "d": {"user": {"id": user_id}, "status": self.random.choice(("online", "idle", "dnd")), "activities": []}}
+            else:
+                payload = {"t": None, "s": None, "op": 11, "d": None} # heartbeat ACK
+            if payload["op"] == 0:
+                payload["s"] = sequence
+            yield json.dumps(payload).encode()
+
+    def content(self, size, seed):
+        return b"\x89PNG\r\n\x1a\n" + random.Random(seed).randbytes(max(size - 8, 0))
+
+"""
+Hook timings, in seconds.
+"""
+class Timings:
+    def __init__(self):
+        self.hooks = {} # hook name : [durations]
+        self.flows = [] # total time in hooks for each HTTP flow
+
+    def record(self, hook_name, duration):
+        self.hooks.setdefault(hook_name, []).append(duration)
+
+def summarize(durations):
+    durations = sorted(durations)
+    summary = {"count": len(durations), "mean_ms": sum(durations) / len(durations) * 1000 if durations else 0}
+    for percentile in PERCENTILES:
+        index = min(len(durations) - 1, int(len(durations) * percentile / 100))
+        summary[f"p{percentile}_ms"] = durations[index] * 1000 if durations else 0
+    summary["max_ms"] = durations[-1] * 1000 if durations else 0
+    return summary
+
+"""
+Returns the peak resident set size of this process in bytes, or None where the resource module isn't available.
+"""
+def peak_rss():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # kibibytes on Linux
+
+class Benchmark:
+    def __init__(self, archiver, traffic, timings, args):
+        self.archiver = archiver
+        self.traffic = traffic
+        self.timings = timings
+        self.args = args
+        self.responses = 0
+        self.gateway_messages = 0
+        self.bytes = 0
+
+    async def call(self, hook_name, flow, *hook_args):
+        start = time.perf_counter()
+        result = getattr(self.archiver, hook_name)(flow, *hook_args)
+        if asyncio.iscoroutine(result):
+            await result
+        duration = time.perf_counter() - start
+        self.timings.record(hook_name, duration)
+        return duration
+
+    """
+    Passes an HTTP flow through the hooks like mitmproxy does: the body only exists after responseheaders,
+    and a body that responseheaders decided to stream goes through the stream function in chunks instead.
+    """
+    async def http_flow(self, url, content_type, body, content_encoding=None):
+        flow = tflow.tflow(resp=True)
+        flow.request.url = url
+        flow.request.timestamp_start = flow.response.timestamp_start = time.time()
+        flow.response.headers.clear()
+        flow.response.headers["content-type"] = content_type
+        flow.response.headers["content-length"] = str(len(body))
+        if content_encoding:
+            flow.response.headers["content-encoding"] = content_encoding
+        flow.response.raw_content = None
+        response = flow.response
+        flow.response = None
+        hooks_duration = await self.call("requestheaders", flow)
+        hooks_duration += await self.call("request", flow)
+        if flow.response is not None: # served from the archive
+            hooks_duration += await self.call("response", flow)
+            self.timings.flows.append(hooks_duration)
+            self.responses += 1
+            return
+        flow.response = response
+        hooks_duration += await self.call("responseheaders", flow)
+        stream = flow.response.stream
+        if callable(stream):
+            stream_duration = 0
+            for offset in range(0, len(body) + 1, STREAM_CHUNK_SIZE):
+                chunk = body[offset:offset + STREAM_CHUNK_SIZE] # ends with b"", for the end of the body
+                start = time.perf_counter()
+                stream(chunk)
+                stream_duration += time.perf_counter() - start
+            if len(body) % STREAM_CHUNK_SIZE:
+                start = time.perf_counter()
+                stream(b"")
+                stream_duration += time.perf_counter() - start
+            self.timings.record("response_stream", stream_duration)
+            hooks_duration += stream_duration
+        elif not stream:
+            flow.response.raw_content = body
+        flow.response.timestamp_end = time.time()
+        hooks_duration += await self.call("response", flow)
+        self.timings.flows.append(hooks_duration)
+        self.responses += 1
+        self.bytes += len(body)
+
+    async def message_page(self):
+        url, body = self.traffic.message_page(self.args.revisits)
+        await self.http_flow(url, "application/json", gzip.compress(body, 6), "gzip")
+
+    async def asset(self):
+        url, content_type, size, seed = self.traffic.asset(self.args.repeats, self.args.max_image_size)
+        await self.http_flow(url, content_type, self.traffic.content(size, seed))
+
+    def open_gateway(self):
+        flow = tflow.twebsocketflow()
+        flow.request.url = GATEWAY_URL
+        flow.response.timestamp_start = time.time()
+        flow.websocket.messages.clear()
+        return flow, zlib.compressobj(), self.traffic.gateway_payloads(self.args.gateway_messages)
+
+    async def gateway_message(self, gateway):
+        flow, compressor, payloads = gateway
+        payload = next(payloads, None)
+        if payload is None:
+            await self.call("websocket_end", flow)
+            return False
+        # Discord's zlib-stream: one compression context per Gateway, flushed after each payload.
+        content = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        flow.websocket.messages.append(websocket.WebSocketMessage(2, False, content, time.time()))
+        await self.call("websocket_message", flow)
+        self.gateway_messages += 1
+        self.bytes += len(content)
+        return True
+
+    """
+    Interleaves message pages, CDN downloads and the Gateways' messages at random, like a client that's being used.
+    """
+    async def run(self):
+        remaining = {"page": self.args.pages, "asset": self.args.assets}
+        gateways = [self.open_gateway() for _ in range(self.args.gateways)]
+        while remaining["page"] or remaining["asset"] or gateways:
+            kinds = [kind for kind, count in remaining.items() if count] + (["gateway"] if gateways else [])
+            weights = [remaining[kind] if kind != "gateway" else len(gateways) * self.args.gateway_messages for kind in kinds]
+            kind = self.traffic.random.choices(kinds, weights)[0]
+            if kind == "page":
+                await self.message_page()
+            elif kind == "asset":
+                await self.asset()
+            else:
+                gateway = self.traffic.random.choice(gateways)
+                if not await self.gateway_message(gateway):
+                    gateways.remove(gateway)
+            if kind != "gateway":
+                remaining[kind] -= 1
+
+async def benchmark(args, archive_path):
+    traffic = Traffic(args.seed, args.channels, args.users)
+    timings = Timings()
+    archiver = wumpus_in_the_middle.DiscordArchiver()
+    archiver.archive_path = archive_path
+    with taddons.context() as tctx:
+        tctx.master.addons.add(archiver)
+        # Like mitmproxy: options from the command line first, then a configure with everything.
+        if args.set:
+            tctx.options.set(*args.set)
+        tctx.master.addons.invoke_addon_sync(archiver, hooks.ConfigureHook(set(tctx.options.keys())))
+        bench = Benchmark(archiver, traffic, timings, args)
+        start = time.perf_counter()
+        await bench.run()
+        archiver.done() # waits for the writer to finish
+        elapsed = time.perf_counter() - start
+
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "mitmproxy": MITMPROXY_VERSION,
+        "options": args.set,
+        "workload": {
+            "seed": args.seed, "pages": args.pages, "assets": args.assets, "gateways": args.gateways,
+            "gateway_messages": args.gateway_messages, "channels": args.channels, "users": args.users,
+            "revisits": args.revisits, "repeats": args.repeats, "max_image_size": args.max_image_size,
+        },
+        "elapsed_seconds": elapsed,
+        "responses": bench.responses,
+        "gateway_messages": bench.gateway_messages,
+        "bytes": bench.bytes,
+        "responses_per_second": bench.responses / elapsed,
+        "gateway_messages_per_second": bench.gateway_messages / elapsed,
+        "bytes_per_second": bench.bytes / elapsed,
+        "peak_rss_bytes": peak_rss(),
+        "flow_latency": summarize(timings.flows),
+        "hook_latency": {hook_name: summarize(durations) for hook_name, durations in sorted(timings.hooks.items())},
+    }
+
+def print_results(results, baseline=None):
+    def row(name, value, baseline_value, unit=""):
+        line = f"{name:<40} {value:>14.3f}{unit}"
+        if baseline_value:
+            line += f" {baseline_value:>14.3f}{unit} {(value - baseline_value) / baseline_value:>+8.1%}"
+        print(line)
+
+    baseline = baseline or {}
+    print(f"{results['responses']} responses and {results['gateway_messages']} Gateway messages in {results['elapsed_seconds']:.2f}s")
+    for key in ("responses_per_second", "gateway_messages_per_second", "bytes_per_second"):
+        row(key, results[key], baseline.get(key))
+    if results["peak_rss_bytes"] is not None:
+        row("peak_rss_mib", results["peak_rss_bytes"] / 2**20, (baseline.get("peak_rss_bytes") or 0) / 2**20)
+    latencies = {"flow": results["flow_latency"], **results["hook_latency"]}
+    baseline_latencies = {"flow": baseline.get("flow_latency", {}), **baseline.get("hook_latency", {})}
+    for name, summary in latencies.items():
+        for key in [f"p{percentile}_ms" for percentile in PERCENTILES] + ["max_ms"]:
+            row(f"{name} {key}", summary[key], baseline_latencies.get(name, {}).get(key), "ms")
+
+
+arg_parser = argparse.ArgumentParser(description="Measure the latency and throughput Wumpus In The Middle adds, with synthetic Discord traffic.")
+arg_parser.add_argument("--set", action="append", default=[], help="set an addon option, like witm_background_writer=true. Can be given more than once", metavar="<option>=<value>")
+arg_parser.add_argument("-o", "--output", help="write the results to this JSON file", metavar="<file>")
+arg_parser.add_argument("--compare", help="compare the results with an earlier run's JSON file", metavar="<file>")
+arg_parser.add_argument("-t", "--traffic-archive", help="record to this directory, and keep it. Per default a temporary directory that's deleted afterwards", metavar="<dir>")
+arg_parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic traffic. Per default 0")
+arg_parser.add_argument("--pages", type=int, default=500, help="message list responses. Per default 500")
+arg_parser.add_argument("--assets", type=int, default=2000, help="CDN downloads. Per default 2000")
+arg_parser.add_argument("--gateways", type=int, default=2, help="Gateway connections. Per default 2")
+arg_parser.add_argument("--gateway-messages", type=int, default=5000, help="messages per Gateway. Per default 5000")
+arg_parser.add_argument("--channels", type=int, default=20, help="channels the pages come from. Per default 20")
+arg_parser.add_argument("--users", type=int, default=200, help="message authors. Per default 200")
+arg_parser.add_argument("--revisits", type=float, default=0.5, help="fraction of pages that are a channel's newest page again. Per default 0.5")
+arg_parser.add_argument("--repeats", type=float, default=0.3, help="fraction of CDN downloads of something already downloaded. Per default 0.3")
+arg_parser.add_argument("--max-image-size", type=int, default=8 * 1024 * 1024, help="biggest attachment, in bytes. Per default 8 MiB", metavar="<bytes>")
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    archive_path = args.traffic_archive or tempfile.mkdtemp(prefix="witm-benchmark-")
+    try:
+        results = asyncio.run(benchmark(args, archive_path))
+    finally:
+        if not args.traffic_archive:
+            shutil.rmtree(archive_path, ignore_errors=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Wrote the results to {args.output}.")
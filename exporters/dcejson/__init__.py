@@ -20,17 +20,18 @@ todo: make these names more consistent.
 """
 
 import os
-import re
 import json
 import time
 import datetime
 from dateutil import parser
-from shutil import copyfile
 import urllib.parse
 import argparse
 
 from .. import parse_gateway
 from .. import registry
+from archive.storage import ResponseStore, stored_extension
+from archive.index import RequestIndexEntry, open_index, GATEWAY_INDEX
+from archive.message_store import MessageStore, message_store_path
 
 # Arguments specific to the dcejson exporter
 arg_parser = argparse.ArgumentParser()
@@ -39,6 +40,7 @@ arg_parser.add_argument("-t","--traffic-archive", default="traffic_archive/", he
 arg_parser.add_argument("-o","--output", default="dcejson_exports/", help="The directory to export the output into. Per default 'dcejson_exports/'", metavar="<dir>")
 arg_parser.add_argument("--consistent-naming-mode",action='store_true', help="enable consistent naming mode")
 arg_parser.add_argument("--max-filename-length",type=int,default=60, help="the maximum filename length for exported files", metavar="<int>")
+arg_parser.add_argument("--from-message-store",action='store_true', help="read messages, users and channels from the archive's messages.sqlite instead of replaying every response and Gateway")
 # register the dcejson exporter
 @registry.register_exporter("dcejson",arg_parser, description="Convert discordless traffic archives to DiscordChatExporter JSON files.")
 def dcejson_exporter_backend(args):
@@ -53,10 +55,11 @@ def dcesjon_exporter_main(options):
     INCLUDE_DELETED_MESSAGES = False # todo
     HOTLINK_MISSING_ASSETS = True # according to comments below, disabling this is pointless. Therefore, this is not available as a flag
     MAX_FILENAME_LENGTH = options.max_filename_length
+    FROM_MESSAGE_STORE = options.from_message_store
     CHANNELS_TO_EXPORT_IDS = None
 
     ARCHIVE_PATH = options.traffic_archive
-    REQUESTS_PATH = os.path.join(ARCHIVE_PATH, "requests/")
+    RESPONSE_STORE = ResponseStore(ARCHIVE_PATH)
     GATEWAYS_PATH = os.path.join(ARCHIVE_PATH, "gateways/")
 
     def get_dmo_time(dmo):
@@ -402,89 +405,110 @@ def dcesjon_exporter_main(options):
     print("\n 🧿 Initializing export 🧿 \n") # If this crashes, your terminal lacks sufficient Unicode support.
 
     print("Analyzing REST traffic.") # todo: report progress percentage
-    with open(os.path.join(ARCHIVE_PATH, "request_index")) as file:
+    with open_index(ARCHIVE_PATH) as file:
         for line in file:
-            seen_timestamp, method, url, response_hash, filename = line.split()
-            seen_timestamp = datetime.datetime.fromtimestamp(float(seen_timestamp), tz=datetime.timezone.utc)
-            path = os.path.join(REQUESTS_PATH, filename)
+            entry = RequestIndexEntry.parse(line)
+            url, filename = entry.url, entry.filename
+            # Skip error pages (like from a Discord outage) without opening them, if the index knows the status code.
+            if not entry.is_success() or not entry.has_content():
+                continue
+            seen_timestamp = datetime.datetime.fromtimestamp(entry.seen_timestamp, tz=datetime.timezone.utc)
+            route = entry.get_route()
 
             # Messages
-            match = re.match(r"https://discord.com/api/v9/channels/(\d*)/messages(\?|$)", url)
-            if match:
-                with open(path) as request_file:
-                    try:
-                        dmos = json.load(request_file)
-                    except:
-                        # Invalid JSON.
-                        # This can happen due to a Discord outage where we got some error page served instead of the JSON response.
-                        # We might want to change Wumpus In The Middle to account for that - maybe track response codes?
-                        # But for now, it seems easy to just filter out invalid JSON.
-                        print("skipping invalid json") # todo: clean this up?
-                        continue
+            if route.tag == "channel_messages":
+                if FROM_MESSAGE_STORE:
+                    continue
+                if not entry.is_json():
+                    continue
+                try:
+                    dmos = json.loads(RESPONSE_STORE.read(filename))
+                except:
+                    # Invalid JSON.
+                    # This can happen due to a Discord outage where we got some error page served instead of the JSON response.
+                    # Newer archives record status codes, so those are skipped above, but older ones don't.
+                    print("skipping invalid json") # todo: clean this up?
+                    continue
                 if isinstance(dmos, dict): # if there's only one then Discord fails to encapsulate it in an array??
                     dmos = [dmos]
                 for dmo in dmos:
                     observe_dmo(seen_timestamp, dmo, "REST")
 
             # Attachments
-            elif (
-                url.startswith("https://cdn.discordapp.com/attachments/") or
-                url.startswith("https://media.discordapp.net/attachments/") or
-                url.startswith("https://images-ext-1.discordapp.net/external/") or
-                url.startswith("https://images-ext-2.discordapp.net/external/") or
-                url.startswith("https://images-ext-3.discordapp.net/external/") or
-                url.startswith("https://images-ext-4.discordapp.net/external/")
-            ):
-                observe_attachmentoid(url, path)
+            elif route.tag in ("attachment", "external_media"):
+                observe_attachmentoid(url, filename)
 
             # Avatars, guild icons, and emojos (custom emoji)
-            elif any(url.startswith("https://cdn.discordapp.com/" + i) for i in ("avatars","icons","emojis","channel-icons")):
-                observe_cdnimage(url, path)
-
-
-    print("Analyzing websocket traffic.")
-    with open(os.path.join(ARCHIVE_PATH, "gateway_index")) as file:
-        for line in file:
-            seen_timestamp, url, gateway_path_base = line.rstrip().split(" ", maxsplit=2)
-            try:
-                seen_timestamp = datetime.datetime.fromtimestamp(float(seen_timestamp), tz=datetime.timezone.utc)
-            except ValueError:
-                print(f"Incorrect seen timestamp: {seen_timestamp}")
-                continue
-            for payload in parse_gateway.parse_gateway(os.path.join(ARCHIVE_PATH, "gateways", gateway_path_base), url):
-                # Discord calls payload["d"] both "inner payload" and "event data", which are both bad names.
-                # Here, I'll just call it the "event".
-                event_name, event = payload["t"], payload["d"]
-                if event_name in ("MESSAGE_CREATE", "MESSAGE_UPDATE"): # MESSAGE_UPDATE only has ambiguously partial dmo. might cause issues
-                    observe_dmo(seen_timestamp, event, event_name)
-                elif event_name == "MESSAGE_DELETE":
-                    observe_dmo(seen_timestamp, None, event_name, int(event["channel_id"]), int(event["id"]))
-                elif event_name=="READY":
-                    for user_dao in event["users"] + [event["user"]]:
-                        observe_user(seen_timestamp, user_dao)
-                    for channel_dao in event["private_channels"]:
-                        observe_channel(seen_timestamp, channel_dao, None)
-                        #assert "women, online" not in str(channel_dao)
-                    for guild_dao in event["guilds"]:
-                        assert guild_dao["data_mode"] == "full", "data mode {}. i don't know what that means sowwy >.<".format(dgo["data_mode"])
-                        observe_guild(seen_timestamp, guild_dao)
-                        for channel_dao in guild_dao["channels"]:
-                            observe_channel(seen_timestamp, channel_dao, int(guild_dao["id"]))
-                elif event_name=="GUILD_MEMBER_LIST_UPDATE":
-                    # see https://arandomnewaccount.gitlab.io/discord-unofficial-docs/lazy_guilds.html
-                    for op in event["ops"]:
-                        assert op["op"] in ("DELETE","INSERT","SYNC","UPDATE","INVALIDATE")
-                        if op["op"] in ("INSERT", "UPDATE"):
-                            op_items = [op["item"]]
-                        elif op["op"] == "SYNC":
-                            op_items = op["items"]
-                        else:
-                            continue
-                        for op_item in op_items:
-                            if "group" in op_item:
-                                continue # skip member "groups" formed by hoisted roles
-                            assert "member" in op_item
-                            observe_member(seen_timestamp, op_item["member"], int(event["guild_id"]))
+            elif route.tag in ("avatar", "guild_icon", "emoji", "channel_icon"):
+                observe_cdnimage(url, filename)
+
+
+    if FROM_MESSAGE_STORE:
+        print("Reading messages from the message store.")
+        message_store = MessageStore(message_store_path(ARCHIVE_PATH))
+        def to_datetime(timestamp):
+            return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+        # The store has already folded every observation the way the observe_* functions would,
+        # so its rows go straight into the same structures.
+        for guild_id, seen, guild_dao in message_store.guilds():
+            guild_impressions[guild_id] = (to_datetime(seen), guild_dao)
+        for channel_id, seen, guild_id, channel_dao in message_store.channels():
+            channel_impressions[channel_id] = (to_datetime(seen), channel_dao)
+            channel_id_to_guild_id[channel_id] = guild_id
+        for user_id, seen, user_observation in message_store.user_history():
+            user_histories.setdefault(user_id, {})[to_datetime(seen)] = user_observation
+        for user_id, guild_id, seen, member_observation in message_store.member_history():
+            member_histories.setdefault((user_id, guild_id), {})[to_datetime(seen)] = member_observation
+        user_id_to_isbot.update(message_store.bots())
+        for channel_id, message_id, seen, mechanism, dmo in message_store.messages():
+            observation = MessageObservation(to_datetime(seen), dmo or message_id, mechanism)
+            channel_messages.setdefault(channel_id, {})[message_id] = MessageProvenance(observation)
+        message_store.close()
+
+    else:
+        print("Analyzing websocket traffic.")
+        with open_index(ARCHIVE_PATH, GATEWAY_INDEX) as file:
+            for line in file:
+                seen_timestamp, url, gateway_path_base = line.rstrip().split(" ", maxsplit=2)
+                try:
+                    seen_timestamp = datetime.datetime.fromtimestamp(float(seen_timestamp), tz=datetime.timezone.utc)
+                except ValueError:
+                    print(f"Incorrect seen timestamp: {seen_timestamp}")
+                    continue
+                for payload in parse_gateway.parse_gateway(os.path.join(ARCHIVE_PATH, "gateways", gateway_path_base), url):
+                    # Discord calls payload["d"] both "inner payload" and "event data", which are both bad names.
+                    # Here, I'll just call it the "event".
+                    event_name, event = payload["t"], payload["d"]
+                    if event_name in ("MESSAGE_CREATE", "MESSAGE_UPDATE"): # MESSAGE_UPDATE only has ambiguously partial dmo. might cause issues
+                        observe_dmo(seen_timestamp, event, event_name)
+                    elif event_name == "MESSAGE_DELETE":
+                        observe_dmo(seen_timestamp, None, event_name, int(event["channel_id"]), int(event["id"]))
+                    elif event_name=="READY":
+                        for user_dao in event["users"] + [event["user"]]:
+                            observe_user(seen_timestamp, user_dao)
+                        for channel_dao in event["private_channels"]:
+                            observe_channel(seen_timestamp, channel_dao, None)
+                            #assert "women, online" not in str(channel_dao)
+                        for guild_dao in event["guilds"]:
+                            assert guild_dao["data_mode"] == "full", "data mode {}. i don't know what that means sowwy >.<".format(dgo["data_mode"])
+                            observe_guild(seen_timestamp, guild_dao)
+                            for channel_dao in guild_dao["channels"]:
+                                observe_channel(seen_timestamp, channel_dao, int(guild_dao["id"]))
+                    elif event_name=="GUILD_MEMBER_LIST_UPDATE":
+                        # see https://arandomnewaccount.gitlab.io/discord-unofficial-docs/lazy_guilds.html
+                        for op in event["ops"]:
+                            assert op["op"] in ("DELETE","INSERT","SYNC","UPDATE","INVALIDATE")
+                            if op["op"] in ("INSERT", "UPDATE"):
+                                op_items = [op["item"]]
+                            elif op["op"] == "SYNC":
+                                op_items = op["items"]
+                            else:
+                                continue
+                            for op_item in op_items:
+                                if "group" in op_item:
+                                    continue # skip member "groups" formed by hoisted roles
+                                assert "member" in op_item
+                                observe_member(seen_timestamp, op_item["member"], int(event["guild_id"]))
 
     print("Collected {} messages, {} attachmentoids, and {} CDN images.".format(
         sum(len(messages) for messages in channel_messages.values()),
@@ -658,7 +682,7 @@ def dcesjon_exporter_main(options):
         if guildicon_downloaded_path is not None:
             dce_guildicon_url = mirror_asset(
                 guildicon_downloaded_path,
-                name_suggestion=guildicon_name_suggestion + os.path.splitext(guildicon_downloaded_path)[1],
+                name_suggestion=guildicon_name_suggestion + stored_extension(guildicon_downloaded_path),
                 preserve_ext=True,
                 target_dir=EXPORTED_GUILDICONS_DIR,
                 relate_to=EXPORT_DIR
@@ -861,7 +885,7 @@ def dcesjon_exporter_main(options):
     if not DRY_RUN:
         print("\nExporting " + str(len(mirrored_assets)) + " assets... >.<'") #todo: report progress
         for source, dest in mirrored_assets.items():
-            copyfile(source, dest)
+            RESPONSE_STORE.copy(source, dest)
 
         print("Export saved to " + EXPORT_DIR)
         print(str(len(mirrored_assets)) + " assets saved to " + EXPORTED_ASSETS_DIR)
@@ -1,12 +1,13 @@
 import logging
 import os.path
-import re
 import json
 import os.path
 from typing import Any
 import datetime
-from . import gateway
+from .. import parse_gateway
 from .metrics import MetricsReport
+from archive.storage import ResponseStore
+from archive.index import RequestIndexEntry, open_index, GATEWAY_INDEX
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +24,7 @@ def snowflake_to_unix_timestamp(snowflake: int) -> float:
 class ChannelMessageFile:
     def __init__(self, request_time: float, channel_id: int, file: str):
         self.channel_id: int = channel_id
-        self.file: str = file
+        self.file: str = file  # filename in requests/, read through ResponseStore
         self.request_time: float = request_time
 
 
@@ -31,12 +32,12 @@ class AttachmentFile:
     def __init__(self, channel_id: int, attachment_id: int):
         self.channel_id: int = channel_id
         self.attachment_id: int = attachment_id
-        self.files: list[str] = []
+        self.files: list[str] = []  # filenames in requests/
 
-    def get_best_version(self) -> str:
+    def get_best_version(self, store: ResponseStore) -> str:
         # heuristic to get the attachment in its best quality: sort by file size
         if len(self.files) > 1:
-            self.files.sort(key=lambda file: os.path.getsize(file))
+            self.files.sort(key=lambda file: store.size(file))
         return self.files[0]
 
 
@@ -118,6 +119,7 @@ class GuildMetadata:
 class TrafficArchive:
     def __init__(self, traffic_archive_directory: str):
         self.traffic_archive_directory: str = traffic_archive_directory
+        self.store: ResponseStore = ResponseStore(traffic_archive_directory)
         self.attachment_files: dict[int, AttachmentFile] = {}
         self._channel_metadata: dict[int, ChannelMetadata] = {}
         self._guild_metadata: dict[int, GuildMetadata] = {}
@@ -160,50 +162,54 @@ class TrafficArchive:
         return os.path.join(self.traffic_archive_directory, *relative_parts)
 
 
-def parse_guild_profile_file(guild_profile_request_file: str):
-    with open(guild_profile_request_file, "r") as f:
-        content = json.load(f)
-        if "name" in content:
-            return content["name"]
-        print(f"error: guild profile doesn't contain name: {content}")
-        return None
+def parse_guild_profile_file(guild_profile_request_file: str, store: ResponseStore):
+    content = json.loads(store.read(guild_profile_request_file))
+    if "name" in content:
+        return content["name"]
+    print(f"error: guild profile doesn't contain name: {content}")
+    return None
 
 
-def parse_request_index_file(file: str, traffic_archive: TrafficArchive, metrics: MetricsReport):
+def parse_request_index_file(traffic_archive: TrafficArchive, metrics: MetricsReport):
     latest_timestamp = 0
-    with open(file, "r") as request_index:
+    with open_index(traffic_archive.traffic_archive_directory) as request_index:
         for index_entry in request_index:
-            seen_timestamp, method, url, response_hash, filename = index_entry.split()
+            entry = RequestIndexEntry.parse(index_entry)
+            url, filename = entry.url, entry.filename
 
-            seen_timestamp = float(seen_timestamp)
+            seen_timestamp = entry.seen_timestamp
             if seen_timestamp > latest_timestamp:
                 latest_timestamp = seen_timestamp
 
+            # skip error responses without opening them, when the index records status codes
+            if not entry.is_success() or not entry.has_content():
+                continue
+
+            route = entry.get_route()
 
             # message files
-            match = re.match(r"https://discord.com/api/v9/channels/(\d*)/messages(\?|$)", url)
-            if match:
-                channel_id = int(match.group(1))
+            if route.tag == "channel_messages":
+                if not entry.is_json():
+                    continue
+                channel_id = int(route.ids["channel_id"])
 
                 channel_metadata = traffic_archive.get_channel_metadata(channel_id)
-                channel_metadata.add_message_file(ChannelMessageFile(seen_timestamp, channel_id, traffic_archive.file_path("requests", filename)))
+                channel_metadata.add_message_file(ChannelMessageFile(seen_timestamp, channel_id, filename))
                 continue
 
             # guild info
-            match = re.match(r"https://discord.com/api/v9/guilds/(\d*)/profile(\?|$)", url)
-            if match:
-                guild_id = int(match.group(1))
-                guild_name = parse_guild_profile_file(traffic_archive.file_path("requests", filename))
+            if route.tag == "guild_profile" and entry.is_json():
+                guild_id = int(route.ids["guild_id"])
+                guild_name = parse_guild_profile_file(filename, traffic_archive.store)
 
                 if guild_name is not None:
                     guild = traffic_archive.get_guild_metadata(guild_id)
                     guild.name = guild_name  # TODO: determine if this is actually a newer name
 
             # attachments
-            match = re.match(r"https://(?:media|cdn).discordapp.(?:com|net)/attachments/(\d+)/(\d+)/.*", url)
-            if match:
-                channel_id = int(match.group(1))
-                attachment_id = int(match.group(2))
+            if route.tag == "attachment":
+                channel_id = int(route.ids["channel_id"])
+                attachment_id = int(route.ids["attachment_id"])
                 # we just assume attachment ids are unique across channels
                 if attachment_id in traffic_archive.attachment_files:
                     # but to be sure, let's check for collisions
@@ -213,47 +219,46 @@ def parse_request_index_file(file: str, traffic_archive: TrafficArchive, metrics
                 # save attachment. there might be multiple versions
                 if attachment_id not in traffic_archive.attachment_files:
                     traffic_archive.attachment_files[attachment_id] = AttachmentFile(channel_id, attachment_id)
-                traffic_archive.attachment_files[attachment_id].files.append(traffic_archive.file_path("requests", filename))
+                traffic_archive.attachment_files[attachment_id].files.append(filename)
 
     metrics.latest_request_timestamp = latest_timestamp
 
 
-def parse_channel_message_file(channel_file: ChannelMessageFile, history: ChannelMessageHistory):
-    with open(channel_file.file, "r") as message_file:
-        data = json.load(message_file)
+def parse_channel_message_file(channel_file: ChannelMessageFile, history: ChannelMessageHistory, store: ResponseStore):
+    data = json.loads(store.read(channel_file.file))
 
-        # discordless unfortunately doesn't record http status codes. We have to detect errors by the content
-        if isinstance(data, dict) and "code" in data and "message" in data:
-            logger.error(f"skipping channel message file {channel_file.file} due to discord-side errors")
-            return
+    # older archives don't record http status codes, so we still have to detect errors by the content
+    if isinstance(data, dict) and "code" in data and "message" in data:
+        logger.error(f"skipping channel message file {channel_file.file} due to discord-side errors")
+        return
 
-        # discord fails to encapsulate messages in an array if there is just one message
-        if isinstance(data, dict):
-            data = [data]
+    # discord fails to encapsulate messages in an array if there is just one message
+    if isinstance(data, dict):
+        data = [data]
 
-        for message_observation in data:
-            message = Message(channel_file.request_time, message_observation)
+    for message_observation in data:
+        message = Message(channel_file.request_time, message_observation)
 
-            if message.message_id in history.messages:
-                # determine which message is newer
-                other_message = history.messages[message.message_id]
-                if message.observation_time > other_message.observation_time:  # these are unix timestamps
-                    history.messages[message.message_id] = message
-            else:
+        if message.message_id in history.messages:
+            # determine which message is newer
+            other_message = history.messages[message.message_id]
+            if message.observation_time > other_message.observation_time:  # these are unix timestamps
                 history.messages[message.message_id] = message
+        else:
+            history.messages[message.message_id] = message
 
 
-def parse_channel_history(channel_files: list[ChannelMessageFile]) -> ChannelMessageHistory:
+def parse_channel_history(channel_files: list[ChannelMessageFile], store: ResponseStore) -> ChannelMessageHistory:
     history = ChannelMessageHistory()
 
     for channel_file in channel_files:
-        parse_channel_message_file(channel_file, history)
+        parse_channel_message_file(channel_file, history, store)
 
     return history
 
 
-def parse_gateway_recording(gateway_timeline: str, gateway_data: str, url: str, traffic_archive: TrafficArchive):
-    for message in gateway.parse_gateway_recording(gateway_timeline, gateway_data, url):
+def parse_gateway_recording(gateway_path_prefix: str, url: str, traffic_archive: TrafficArchive):
+    for message in parse_gateway.parse_gateway(gateway_path_prefix, url, report=logger.error):
         message_type = message["t"]
         data = message["d"]
 
@@ -281,9 +286,9 @@ def parse_gateway_recording(gateway_timeline: str, gateway_data: str, url: str,
                         guild_meta.channels.add(channel_meta)
 
 
-def parse_gateway_messages(gateway_index: str, traffic_archive: TrafficArchive, metrics: MetricsReport):
+def parse_gateway_messages(traffic_archive: TrafficArchive, metrics: MetricsReport):
     latest_timestamp = 0
-    with open(gateway_index, "r") as f:
+    with open_index(traffic_archive.traffic_archive_directory, GATEWAY_INDEX) as f:
         for index_entry in f:
             timestamp, url, name = index_entry.split()
 
@@ -291,9 +296,6 @@ def parse_gateway_messages(gateway_index: str, traffic_archive: TrafficArchive,
             if timestamp > latest_timestamp:
                 latest_timestamp = timestamp
 
-            timeline_file = traffic_archive.file_path("gateways", f"{name}_timeline")
-            data_file = traffic_archive.file_path("gateways", f"{name}_data")
-
-            parse_gateway_recording(timeline_file, data_file, url, traffic_archive)
+            parse_gateway_recording(traffic_archive.file_path("gateways", name), url, traffic_archive)
 
     metrics.latest_gateway_timestamp = latest_timestamp
@@ -1,6 +1,5 @@
 import mimetypes
 import resource
-import shutil
 import os.path
 import os
 import time
@@ -68,13 +67,13 @@ def export_channel(channel: ChannelMetadata, history: ChannelMessageHistory, exp
             for attachment in message.attachments:
                 if attachment.attachment_id in traffic_archive.attachment_files:
                     attachment_file_info = traffic_archive.attachment_files[attachment.attachment_id]
-                    src = attachment_file_info.get_best_version()
+                    src = attachment_file_info.get_best_version(traffic_archive.store)
 
                     # gather file info
                     is_image = False
                     is_audio = False
                     mime: str = attachment.reported_mime or "application/octet-stream"
-                    kind = filetype.guess(src)
+                    kind = filetype.guess(traffic_archive.store.head(src))
                     if kind is not None:
                         mime = kind.mime
                     if mime in IMAGE_MIME_TYPES:
@@ -92,7 +91,7 @@ def export_channel(channel: ChannelMetadata, history: ChannelMessageHistory, exp
                         export_filename = f"attachment_{attachment.attachment_id}{extension}"
 
                     dst = os.path.join(channel_directory, "attachments", export_filename)
-                    shutil.copyfile(src, dst)
+                    traffic_archive.store.copy(src, dst)
 
                     attachment_view_models[attachment.attachment_id] = AttachmentViewModel(export_filename,is_image,is_audio)
                 else:
@@ -137,10 +136,10 @@ def htmeml_exporter_main(args):
     start_time = time.time()
 
     logger.info("analyzing gateways...")
-    parse_gateway_messages(archive.file_path("gateway_index"), archive, metrics)
+    parse_gateway_messages(archive, metrics)
 
     logger.info("parsing requests...")
-    parse_request_index_file(archive.file_path("request_index"), archive, metrics)
+    parse_request_index_file(archive, metrics)
 
     logger.info("exporting channels...")
     for channel in archive.get_channels():
@@ -149,7 +148,7 @@ def htmeml_exporter_main(args):
         if (allowed_guilds is not None) and ((guild_id is None) or (guild_id not in allowed_guilds)):
             continue
 
-        history = parse_channel_history(channel.get_message_files())
+        history = parse_channel_history(channel.get_message_files(), archive.store)
         export_channel(channel, history, export_dir, archive)
 
         if channel.get_guild_id() is None or not archive.has_guild_information(channel.get_guild_id()):
@@ -16,12 +16,13 @@ import datetime
 
 import filetype
 from dateutil import parser
-from shutil import copyfile
 import jinja2
 import argparse
 
 from .. import parse_gateway
 from .. import registry
+from archive.storage import ResponseStore
+from archive.index import RequestIndexEntry, open_index, GATEWAY_INDEX
 
 # Arguments specific to the HTML exporter
 arg_parser = argparse.ArgumentParser()
@@ -252,13 +253,13 @@ def reasonable_filename(filename: str) -> str:
 def html_exporter_main(options):
     DRY_RUN = options.dry
     archive_path = options.traffic_archive
-    requests_path = os.path.join(archive_path, "requests/")
+    response_store = ResponseStore(archive_path)
     gateways_path = os.path.join(archive_path, "gateways/")
     chatlogs_path = os.path.join(options.output, "export_" + str(int(time.time())))
 
     channel_messages = {}  # channel_id : {message_id: MessageProvenance}
 
-    all_attachments = {}  # url : filepath
+    all_attachments = {}  # url : filename in requests/
     all_authors = {}  # author_id : author info, from message["author"]
     all_avatars = {}  # author_id : avatar bytes
 
@@ -266,38 +267,36 @@ def html_exporter_main(options):
     # Replace this with Channel stuff once we care more about channels.
     channel_titles = {}  # message_id : title (guild name concatenated with channel name)
 
-    with open(os.path.join(archive_path, "request_index")) as file:
+    with open_index(archive_path) as file:
         for line in file:
-            seen_timestamp, method, url, response_hash, filename = line.split()
-            seen_timestamp = datetime.datetime.utcfromtimestamp(float(seen_timestamp))
-            path = os.path.join(requests_path, filename)
+            entry = RequestIndexEntry.parse(line)
+            url, filename = entry.url, entry.filename
+            if not entry.is_success() or not entry.has_content():
+                continue # an error page, like from a Discord outage, or a response recorded without its contents
+            seen_timestamp = datetime.datetime.utcfromtimestamp(entry.seen_timestamp)
+            route = entry.get_route()
 
             # messages
-            match = re.match(r"https://discord.com/api/v9/channels/(\d*)/messages(\?|$)", url)
-            if match:
-                with open(path) as request_file:
-                    try:
-                        dmos = json.load(request_file)
-                    except:
-                        print("ignoring invalid json")
+            if route.tag == "channel_messages":
+                if not entry.is_json():
+                    continue
+                try:
+                    dmos = json.loads(response_store.read(filename))
+                except:
+                    print("ignoring invalid json")
                 if isinstance(dmos, dict):  # if there's only one then they erroenously fail to encapsulate it in an array??
                     dmos = [dmos]
                 for dmo in dmos:
                     observe_dmo(seen_timestamp, dmo, "REST", channel_messages)
 
             # attachments
-            elif (
-                    url.startswith("https://cdn.discordapp.com/attachments/") or
-                    url.startswith("https://media.discordapp.net/attachments/")
-                    # url.startswith("https://images-ext-1.discordapp.net/external/") or # todo
-                    # url.startswith("https://images-ext-1.discordapp.net/external/")
-            ):
+            elif route.tag == "attachment": # todo: external_media
                 attachment_id = attachment_url_to_id(url)
                 # if we haven't yet collected this attachment, or this is a bigger version of a collected attachment, then collect it
-                if attachment_id not in all_attachments or os.path.getsize(all_attachments[attachment_id]) < os.path.getsize(path):
-                    all_attachments[attachment_id] = path
+                if attachment_id not in all_attachments or response_store.size(all_attachments[attachment_id]) < response_store.size(filename):
+                    all_attachments[attachment_id] = filename
 
-    with open(os.path.join(archive_path, "gateway_index")) as file:
+    with open_index(archive_path, GATEWAY_INDEX) as file:
         for line in file:
             seen_timestamp, url, gateway_path_base = line.rstrip().split(" ", maxsplit=2)
             seen_timestamp = datetime.datetime.utcfromtimestamp(float(seen_timestamp))
@@ -445,13 +444,13 @@ def html_exporter_main(options):
                                     # discord sometimes converts the image format. Check what kind of image it really is and add the correct suffix
                                     filename = attachment_id
                                     if is_image:
-                                        extension = filetype.guess_extension(all_attachments[attachment_id])
+                                        extension = filetype.guess_extension(response_store.head(all_attachments[attachment_id]))
                                         if extension is not None:
                                             filename = f"{filename}.{extension}"
 
                                     chatlog_attachment_path = os.path.join(chatlog_attachments_path, reasonable_filename(filename))
                                     chatlog_attachment_rel_path = os.path.relpath(chatlog_attachment_path, chatlog_path) # used for img src in chatlog.html
-                                    copyfile(all_attachments[attachment_id], chatlog_attachment_path) # Make copy of the attachment for the chatlog
+                                    response_store.copy(all_attachments[attachment_id], chatlog_attachment_path) # Make copy of the attachment for the chatlog
                                     chatlog_attachments.add(attachment_id)
                                 # todo: support videos
                                 if is_image:
@@ -1,5 +1,6 @@
 """
-Parses Discord's zlib-encoded Gateway/websocket messages.
+Decodes archived Discord Gateway/websocket connections for the exporters.
+The decompressing is done by archive/gateways.py, which the dcejson, html and htmeml exporters all go through.
 Currently only recognizes two URLs because those are the only ones I've seen in practice.
 Let me know if you see others.
 
@@ -7,126 +8,34 @@ todo: https://gateway-us-east1-d.discord.gg/?encoding=json&v=9&compress=zlib-str
 
 """
 
-import zlib
-import pyzstd
-import json
-import erlpack
 import urllib.parse
 
-"""
-Decodes the query part of a url and converts it to a dict
-"""
-def decode_querystring(querystring: str) -> dict[str, str]:
-    data = urllib.parse.parse_qs(querystring, keep_blank_values=True)
-    result = {}
-    for key, value in data.items():
-        if len(value) != 1:
-            print(f"query parameter '{key}' has been specified multiple times")
-            continue
-        result[key] = value[0]
-    return result
-
-"""
-Recursively convert the bytes and Atom objects in a Gateway payload to strings.
-"""
-def deserialize_erlpackage(payload):
-    if isinstance(payload, bytes):
-        return payload.decode()
-    elif isinstance(payload, erlpack.Atom):
-        return str(payload)
-    elif isinstance(payload, list):
-        return [deserialize_erlpackage(i) for i in payload]
-    elif isinstance(payload, dict):
-        deserialized = {}
-        for k, v in payload.items():
-            deserialized[deserialize_erlpackage(k)] = deserialize_erlpackage(v)
-        return deserialized
-    else:
-        return payload
+from archive import gateways
+from archive.index import open_index, GATEWAY_INDEX
 
 """
 Yields deserialized Gateway payloads for a single archived Gateway connection.
+Uses the Gateway's frames if `archive_tool.py repack-gateways` has made them; then since (a timestamp) can skip ahead cheaply.
+Problems with the Gateway are passed to report, and skip the rest of it.
 """
-def parse_gateway(gateway_path_prefix, url):
-    # parse query string for parameters
+def parse_gateway(gateway_path_prefix, url, since=None, report=print):
     querystring = urllib.parse.urlparse(url).query
-    query = decode_querystring(querystring)
-
-    # buffer to store the data
-    buffer = bytearray()
-
-    # get compression scheme from query
-    if "compress" not in query:
-        print(f"discord websocket querystring doesn't contain a compression scheme: {querystring}")
+    query = gateways.gateway_query(url)
+    if "encoding" not in query:
+        report(f"discord websocket querystring doesn't contain a encoding scheme: {querystring}")
         return
-    compression_scheme = query["compress"]
-    is_zlib = compression_scheme == "zlib-stream"
-    is_zstd = compression_scheme == "zstd-stream"
-    decompressor = None
-    if is_zlib:
-        decompressor = zlib.decompressobj()
-    elif is_zstd:
-        decompressor = pyzstd.ZstdDecompressor()
-    if decompressor is None:
-        print(f"discord websocket traffic is encoded in an unsupported compression scheme: '{compression_scheme}'")
+    if query.get("compress") not in gateways.COMPRESSION_SCHEMES:
+        report(f"discord websocket traffic is encoded in an unsupported compression scheme: '{query.get('compress')}'")
         return
 
-    with open(gateway_path_prefix + "_data", "rb") as data_file, open(gateway_path_prefix + "_timeline") as timeline_file:
-        for line in timeline_file:
-            try:
-                timestamp, length = line.split(" ")
-            except ValueError:
-                print(f"Improper line in timeline:\n{line}")
-                continue
-            timestamp, length = float(timestamp), int(length)
-
-            chunk = data_file.read(length)
-            buffer.extend(chunk)
-
-            if not chunk:
-                print("Incomplete gateway.")
-                return
-
-            # some form of zlib integrity checking
-            if is_zlib and not buffer.endswith(b'\x00\x00\xff\xff'):
-                continue
+    for _timestamp, payload in gateways.read_payloads(gateway_path_prefix, url, since=since, report=report):
+        yield gateways.decode_payload(payload, query["encoding"])
 
-            try:
-                payload = decompressor.decompress(buffer)
-            except:
-                print(
-                    "Error decompressing message for Gateway {}.".format(gateway_path_prefix)
-                    + " This can happen if WitM restarts in the middle of a Gateway connection."
-                    + " Skipping the rest of this Gateway."
-                )
-                return
-            
-            buffer = bytearray()
-
-            if "encoding" not in query:
-                print(f"discord websocket querystring doesn't contain a encoding scheme: {querystring}")
-                return
-
-            if query["encoding"] == "json":
-                payload = json.loads(payload.decode())
-            elif query["encoding"] == "etf":
-                payload = deserialize_erlpackage(erlpack.unpack(payload))
-            else:
-                assert 0, "Unrecognized encoding " + query["encoding"] + ", did Discord upgrade its API version?"
-
-            yield payload
-            
 if __name__ == "__main__":
-    with open("traffic_archive/gateway_index") as file:
+    with open_index("traffic_archive", GATEWAY_INDEX) as file:
         for line in file:
             url, gateway_name_prefix = line.strip().split(" ")[1:]
             print("reading", "traffic_archive/gateways/" + gateway_name_prefix, url)
-            
+
             for i in parse_gateway("traffic_archive/gateways/" + gateway_name_prefix, url):
                 print("Payload of type {} and length {}.".format(i["t"], len(str(i))))
-
-
-
-
-
-
@@ -0,0 +1,89 @@
+"""
+Checks Wumpus In The Middle's witm_serve_archived_assets, by driving a DiscordArchiver with mitmproxy's test flows
+the way benchmark.py does: everything happens in-process, without a proxy or any sockets.
+
+Run it from the repository root, with mitmproxy importable:
+    python3 -m unittest test_wumpus_in_the_middle
+"""
+
+import asyncio
+import tempfile
+import unittest
+
+from mitmproxy import hooks
+from mitmproxy.test import taddons, tflow
+
+import wumpus_in_the_middle
+
+ATTACHMENT_URL = "https://cdn.discordapp.com/attachments/1/2/clip.mov"
+# A QuickTime file starts like an MP4 one, so sniffing it would say video/mp4.
+ATTACHMENT = b"\0\0\0\x14ftypqt  \0\0\0\0qt  " + bytes(range(256)) * 64
+ICON_URL = "https://cdn.discordapp.com/icons/3/a1b2c3.png?size=64"
+ICON = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+
+class TestServeArchivedAssets(unittest.TestCase):
+    def setUp(self):
+        archive_path = self.enterContext(tempfile.TemporaryDirectory())
+        tctx = self.enterContext(taddons.context())
+        self.archiver = wumpus_in_the_middle.DiscordArchiver()
+        self.archiver.archive_path = archive_path
+        tctx.master.addons.add(self.archiver)
+        # Like mitmproxy: options from the command line first, then a configure with everything.
+        tctx.options.set("witm_serve_archived_assets=true")
+        tctx.master.addons.invoke_addon_sync(self.archiver, hooks.ConfigureHook(set(tctx.options.keys())))
+        self.addCleanup(self.archiver.done)
+
+    """
+    Passes a complete 200 response through the hooks, so it's archived.
+    """
+    def archive(self, url, content, content_type=None):
+        flow = tflow.tflow(resp=True)
+        flow.request.url = url
+        flow.response.headers.clear()
+        if content_type:
+            flow.response.headers["content-type"] = content_type
+        flow.response.headers["content-length"] = str(len(content))
+        flow.response.content = content
+        self.archiver.requestheaders(flow)
+        self.archiver.responseheaders(flow)
+        self.archiver.response(flow)
+
+    """
+    Returns a GET flow for url after the request hook has seen it; its response is set if it was served from the archive.
+    """
+    def request(self, url, headers=None):
+        flow = tflow.tflow()
+        flow.request.url = url
+        flow.request.headers.update(headers or {})
+        self.archiver.requestheaders(flow)
+        asyncio.run(self.archiver.request(flow))
+        return flow
+
+    def test_serves_archived_asset(self):
+        self.archive(ATTACHMENT_URL, ATTACHMENT, "video/quicktime")
+        flow = self.request(ATTACHMENT_URL)
+        self.assertIsNotNone(flow.response)
+        self.assertEqual(flow.response.status_code, 200)
+        self.assertEqual(flow.response.content, ATTACHMENT)
+        self.assertEqual(flow.response.headers["content-type"], "video/quicktime")
+        self.assertEqual(flow.response.headers["content-length"], str(len(ATTACHMENT)))
+        self.assertTrue(flow.metadata["witm_served_from_archive"])
+
+    def test_sniffs_media_type_only_when_none_was_recorded(self):
+        self.archive(ICON_URL, ICON)
+        flow = self.request(ICON_URL)
+        self.assertEqual(flow.response.content, ICON)
+        self.assertEqual(flow.response.headers["content-type"], "image/png")
+
+    def test_unarchived_url_goes_to_discord(self):
+        self.archive(ATTACHMENT_URL, ATTACHMENT, "video/quicktime")
+        flow = self.request("https://cdn.discordapp.com/attachments/1/3/other.mov")
+        self.assertIsNone(flow.response)
+
+    def test_range_request_goes_to_discord(self):
+        self.archive(ATTACHMENT_URL, ATTACHMENT, "video/quicktime")
+        flow = self.request(ATTACHMENT_URL, {"range": "bytes=0-99"})
+        self.assertIsNone(flow.response)
+
+if __name__ == "__main__":
+    unittest.main()
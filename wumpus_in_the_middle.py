@@ -5,22 +5,139 @@ from both Discord's REST API and "Gateway" (Websocket) API.
 Saves the following to traffic_archive/:
  - request_index
      Keeps track of metadata for each recorded HTTPS response.
-     Each line is {timestamp} {method (GET or POST)} {url} {response hash} {filename}
+     Each line is {timestamp} {method (GET or POST)} {url} {response hash} {filename} v=2 status={status code}
+     type={media type} size={body length} encoding={content encoding} route={route tag} {ids from the url}.
+     Older lines stop after the filename. Responses recorded without their contents (see witm_capture_policy)
+     have - for their response hash and filename.
+     See archive/index.py for details.
+     The response hash is a BLAKE2b digest of the response contents. (Older archives have unstable hash() values here;
+     run `archive_tool.py dedupe` to migrate them.)
      The filename points to a file in traffic_archive/requests which contains the response contents.
      These responses are pretty readable; images should even be saved with the right extensions.
      However, this directory will get big over time.
  - requests/
-     Stores response contents. Contents tracked in request_index.
+     Stores response contents, named after their digest, so identical contents are only stored once
+     even if they were fetched from different URLs. Contents tracked in request_index.
+     The files are in 256 subdirectories named after the first two hex digits of their digest, like requests/3f/3f9a...png,
+     and request_index has that path within requests/ as their filename; older archives have them straight in requests/
+     until `archive_tool.py reshard`. See archive/content.py.
+     With witm_zstd, compressible responses are stored zstd-compressed, with a .zst suffix.
+     With witm_raw_content, compressed responses are stored as they came over the wire, with a suffix like +br or +gzip.
+ - packs/
+     With witm_packs, response contents are appended to rotating segment files here instead of getting a file each
+     in requests/, and request_index references them as @{segment}:{offset}:{length}{extension}. See archive/packs.py.
+     Streamed downloads (witm_tee_stream_size) are still stored in requests/, since they're big anyway.
+ - message_packs/
+     With witm_message_deltas, the individual messages of message list responses, appended to segment files like packs/.
+     The responses themselves are stored as manifests listing their messages, with a +messages suffix. See archive/message_pages.py.
+ - dictionaries/
+     zstd dictionaries for compressed responses, made by `archive_tool.py train-dictionary`.
  - gateway_index
      Keeps track of metadata for each recorded Gateway connection.
      Each line is {timestamp} {url} {filename prefix}.
      The filename prefix points to a pair of files in traffic_archive/gateways, which end in _data and _timeline.
+     It's {month the Gateway started, like 2024-05}/{gateway id}, or just the id in older archives.
  - gateways/
-     Stores compressed Gateway "message" contents and timing information, in pairs of files ending in _data and _timeline respectively.
+     Stores compressed Gateway "message" contents and timing information, in pairs of files ending in _data and _timeline respectively,
+     in a subdirectory per month.
      Each Gateway lasts a long time (like, until the client disconnects), and is tranport compressed via zlib.
      The _data file contains the entire Gateway "response"/"stream" (every "message" concatenated together)
      while the _timeline file keeps track of when each compressed "chunk"/"message" of the response was received.
      Each line of the _timeline file is {timestamp} {chunk length}.
+ - messages.sqlite
+     With witm_message_store, the messages, users, members, channels, guilds and attachments seen so far,
+     kept up to date as responses and Gateway events come in. A cache for the exporters; see archive/message_store.py.
+ - state/
+     Recorder bookkeeping, so startup doesn't have to scan the indexes: a memory-mapped dedup index of
+     (url, response hash) fingerprints with a saved Bloom filter for it, and the next unused gateway id.
+     With witm_packs, also a map from content digests to where they are in packs/.
+     Also maps of the immutable CDN assets (attachments, avatars, icons, emoji) already archived,
+     to their sizes and ETags and to where their contents and recorded media types are (the media types numbered in
+     asset_media_types), and of the best variant (size) of each asset archived so far.
+     Also the older message pages (fetched with ?before=) already archived, for witm_shed_backlog and witm_shed_latency.
+     With witm_message_deltas, also a map from (message id, digest) to where that version of the message is in message_packs/.
+     With witm_quota, also archive_size, how many bytes the archive's contents took up when it was last saved,
+     and page_keys, the message keys of message pages that eviction has looked at (see archive/quota.py).
+     Everything here can be rebuilt from the indexes; delete it if it ever gets out of sync.
+     state/partial/ holds responses that are still being written; they're moved into requests/ once complete.
+ - instances/
+     With witm_instance, each recorder instance's own request_index, gateway_index and state/, in instances/{instance}/.
+     Everything else is shared between instances. Readers merge the indexes; see archive/index.py.
+
+Options (set with --set name=value):
+ - witm_instance: a name for this recorder, when several (say, one mitmdump per CPU core) record to the same archive at once.
+     Each instance appends to its own index segments and keeps its own state, and names its Gateways {instance}-{id};
+     contents are named after their digest, and pack files are never shared, so instances can't overwrite each other's.
+     Give every instance a name, and only change it while mitmproxy is stopped.
+ - witm_capture_policy: a file of rules saying which responses to archive, which to skip,
+     and which to only note in request_index without storing their contents; see archive/policy.py for the format.
+     Empty (the default) uses capture_policy.txt next to this script, which skips telemetry and experiments
+     and keeps everything the exporters read. The file is reloaded when it changes.
+     Denying a Gateway's url skips archiving that Gateway.
+ - witm_background_writer: hash and write responses and Gateway messages on a dedicated writer thread,
+     so that slow disks don't hold up mitmproxy's event loop (and thus the Discord client).
+ - witm_writer_queue_size: how many pending writes the writer thread may queue up.
+ - witm_writer_overflow: what to do with a response when the writer's queue is full.
+     "block" waits for room, "drop" skips archiving it, "inline" writes it on the event loop instead.
+     Gateway messages always wait for room, since skipping or reordering one would corrupt the rest of the Gateway.
+ - witm_shed_backlog, witm_shed_latency: shed low-priority responses when the writer can't keep up,
+     passing them through to the client without archiving them, once this many archiving jobs are waiting for the writer,
+     or once archiving jobs take this many milliseconds on average from being submitted to being done.
+     The further past its threshold either one is, the more gets shed, in this order:
+     avatars at less than their biggest size, then embeds and media proxy images, then message pages from before a message
+     that were already archived. Gateway messages and everything else are never shed. 0 (the default) disables either one.
+ - witm_metrics_port: serve Prometheus metrics on http://127.0.0.1:{port}/metrics. 0 (the default) disables this.
+ - witm_metrics_file: periodically write Prometheus metrics to this file, for node_exporter's textfile collector.
+ - witm_metrics_interval: how many seconds to wait between writes of witm_metrics_file.
+ - witm_zstd: store compressible responses (JSON, text) zstd-compressed, using the newest dictionary in dictionaries/.
+     Readers in the archive package decompress them transparently.
+ - witm_zstd_level: zstd compression level for witm_zstd.
+ - witm_raw_content: store response bodies as they came over the wire, still in their Content-Encoding (gzip, br, ...),
+     instead of decoding them. Saves decoding every response in the proxy, and the space of the decoded bodies;
+     readers in the archive package decode them when they're read. Their hashes are of the encoded bodies,
+     and their size isn't recorded in request_index.
+ - witm_pass_archived_assets: when the client downloads an attachment, avatar, icon or emoji that's already archived
+     (same url apart from its signature, and the same Content-Length or ETag), stream it straight through
+     without buffering or hashing it. On by default.
+ - witm_serve_archived_assets: answer the client's requests for attachments, avatars, icons and emoji that are already archived
+     straight from the archive, without asking Discord. Requests for anything else, or for parts of a file, go to Discord as usual.
+     Off by default, since the client then only ever sees the first version of an asset that we archived.
+ - witm_supersede_variants: don't store a variant of an attachment, embed, avatar, icon or emoji (like a thumbnail or a smaller size)
+     when a better one is already archived; its request_index entry points at the better one's contents instead,
+     with superseded=1. `archive_tool.py supersede-variants` does the same for what's already archived. See archive/variants.py.
+ - witm_tee_stream_size: stream Discord CDN downloads at least this big (like "4m") to the client
+     while copying them to disk, rather than holding the whole body in memory first. Empty (the default) disables this.
+ - witm_gateway_commit_interval: how many milliseconds Gateway messages may be batched in memory before they're written out
+     together. 0 writes each one right away.
+ - witm_gateway_commit_size: write a Gateway's batch out as soon as it's this big (like "256k"), however young it is.
+ - witm_gateway_durability: how hard to push each batch towards the disk. "none" leaves some of it in mitmproxy's buffers,
+     "flush" (the default) hands it all to the OS, which survives mitmproxy crashing,
+     and "fsync" waits until it's on the disk, which survives power loss but is much slower.
+     Either way, a batch's _data is written before its _timeline lines, so a crash can't leave the timeline ahead of the data.
+ - witm_packs: append response contents to pack files in packs/ instead of creating a file per response in requests/.
+     `archive_tool.py pack` converts existing archives.
+ - witm_pack_segment_size: start a new pack file once the current one is this big (like "256m").
+     Also used for the segments in message_packs/.
+ - witm_message_deltas: store message list responses as manifests of their messages, and each message only once
+     per version of it, rather than a full copy of every page the client fetches. Pages stored as they came over the wire
+     (witm_raw_content) are stored whole.
+ - witm_max_open_gateways: how many Gateways may have their files open at once. The least recently active ones
+     beyond that have their files closed until their next message; a Gateway's files are closed for good when it ends.
+ - witm_trim_websocket_messages: forget Gateway messages that have been handed to the writer, rather than letting mitmproxy
+     keep every message of every Gateway in memory for as long as it's connected. Turn it off to see them in mitmweb.
+ - witm_message_store: decode message list responses and Gateway events as they're archived, and fold them into
+     messages.sqlite on a thread of their own. If that thread falls behind, responses are left out of the store
+     (never out of the archive), and so is the rest of a Gateway that it missed part of;
+     `archive_tool.py ingest-messages` rebuilds the store from the archive.
+ - witm_quota: keep the archive's contents under this size (like "20g"), by evicting superseded variants of assets,
+     then media that hasn't been fetched for witm_quota_media_age days and is at least witm_quota_media_size big,
+     then message pages whose messages are all on other pages too. Message JSON and Gateways are never evicted.
+     Evicted entries stay in request_index with evicted={tier}; see archive/quota.py. Contents evicted once
+     aren't archived again when they're fetched again. The archive is measured once, then kept count of as it's written to
+     and evicted from, so what other instances write isn't counted; `archive_tool.py evict` measures it properly.
+     Gateways and pack files count toward the limit, but if they alone outgrow it, the archive stays over it:
+     after a plan that leaves it over, the next waits for another percent of the limit to be archived to requests/,
+     or a day. With witm_instance, each instance only evicts from its own index segment. Empty (the default) disables this.
 
 Invoke like: mitmdump -s wumpus_in_the_middle.py --listen-port=8181 --allow-hosts '^(((.+\.)?discord\.com)|((.+\.)?discordapp\.com)|((.+\.)?discord\.net)|((.+\.)?discordapp\.net)|((.+\.)?discord\.gg))$'
 
@@ -32,49 +149,53 @@ todo:
 
 """
 
-from mitmproxy import http, ctx
-from urllib.parse import urlparse
+from mitmproxy import http, ctx, exceptions
+from mitmproxy.utils import human
+from urllib.parse import urlparse, parse_qs
 import time
 import os
 import json
 import zlib
+import queue
+import threading
+import functools
+import asyncio
+import hashlib
+import tempfile
+import re
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from base64 import b64encode
 
-# Sniff traffic to these domains and their subdomains.
+from archive.content import content_digest, content_extension, content_filename, sharded_filename, flat_filename, sniff_media_type, DIGEST_SIZE, SHARD_LENGTH
+from archive.fingerprints import FingerprintSet, FingerprintTable, fingerprint
+from archive import storage, routes, gateways
+from archive.index import RequestIndexEntry, media_type, read_request_index, instance_path, index_segment_paths, parse_index_lines, read_index_lines, NO_CONTENT, REQUEST_INDEX, GATEWAY_INDEX
+from archive.policy import CapturePolicy
+from archive.variants import VARIANT_TAGS, asset_variant, entry_variant
+from archive.packs import PackWriter, pack_ref, parse_pack_ref, is_pack_ref
+from archive.message_pages import MESSAGE_PAGE_SUFFIX, MESSAGE_PACKS_DIRECTORY, split_page, format_manifest, parse_manifest
+from archive.message_store import MessageStore, message_store_path
+from archive.quota import QUOTA_TARGET, DAY, PageKeyCache, measure_archive, plan_evictions
+
+# Sniffs traffic to Discord's domains and their subdomains; see archive/routes.py for the list.
 # Sorta redundant when mitmproxy is invoked with --allow-hosts [big long discord domain regex],
 # but not fully redundant since allow-hosts doesn't filter http requests, only https.
-# Maybe instead of keeping track of domains here, we could just ignore all http,
+# Maybe instead of keeping track of domains, we could just ignore all http,
 # but redundancy is nice to ensure we don't archive non-Discord traffic.
-DISCORD_DOMAINS = set(( 
-    "discord.com",
-    "discord.net",
-    "discordapp.net",
-    "discordapp.com",
-    "discord.gg",
-    # The rest of these probably aren't used. Including them anyway:
-    "dis.gd",
-    "discord.co",
-    "discord.app",
-    "discord.dev",
-    "discord.new",
-    "discord.gift",
-    "discord.gifts",
-    "discord.media",
-    "discord.store",
-    "discordstatus.com",
-    "bigbeans.solutions",
-    "watchanimeattheoffice.com"
-))
-
-def url_has_discord_root_domain(url):
-    hostname = urlparse(url).hostname
-    return (
-        hostname is not None and
-        any(hostname.endswith(domain) for domain in DISCORD_DOMAINS)
-    )
-
-def url_is_gateway(url):
-    return url_has_discord_root_domain(url) and "gateway" in url
+def request_is_discord(request):
+    return routes.is_discord_host(request.pretty_host)
+
+def request_is_gateway(request):
+    return request_is_discord(request) and "gateway" in request.pretty_url
+
+def request_is_discord_cdn(request):
+    return request.pretty_host in routes.CDN_HOSTS
+
+DEFAULT_CAPTURE_POLICY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "capture_policy.txt")
+CAPTURE_POLICY_CHECK_INTERVAL = 2 # seconds between checks for changes to the capture policy file
+INSTANCE_NAME_PATTERN = re.compile(r"[\w-]+", re.ASCII) # witm_instance names; they end up in paths and Gateway names
+ARCHIVE_SIZE_SAVE_INTERVAL = 64 * 1024 * 1024 # save state/archive_size after the archive grows by this many bytes
 
 """
 Lossily turn a string into a reasonable/safe filename, possibly truncating it.
@@ -86,118 +207,1923 @@ def safe_filename(filename):
 def log_info(message):
     ctx.log.info("☎️  Wumpus In The Middle: " + message)
 
+"""
+Coarse category of a url, used to break down metrics.
+"""
+def url_category(url):
+    parsed_url = urlparse(url)
+    hostname = parsed_url.hostname or ""
+    if hostname == "cdn.discordapp.com":
+        return "cdn"
+    if hostname == "media.discordapp.net":
+        return "media_proxy"
+    if hostname.startswith("images-ext-"):
+        return "external_media"
+    if parsed_url.path.startswith("/api/"):
+        return "api"
+    return "other"
+
+"""
+Counters, gauges and histograms describing what the recorder is doing,
+rendered in Prometheus' text exposition format.
+Updated from both mitmproxy's event loop and the writer thread, so every update takes a lock.
+"""
+class RecorderMetrics:
+    METRICS = { # name : (type, description)
+        "discordless_witm_responses_archived_total": ("counter", "responses added to request_index, by category"),
+        "discordless_witm_responses_skipped_total": ("counter", "responses not archived because they were already archived, by category"),
+        "discordless_witm_responses_dropped_total": ("counter", "responses not archived because the writer queue was full"),
+        "discordless_witm_responses_filtered_total": ("counter", "responses not stored because of the capture policy, by action and category"),
+        "discordless_witm_responses_shed_total": ("counter", "responses not archived because the writer was behind, by reason"),
+        "discordless_witm_responses_superseded_total": ("counter", "responses not stored because a better variant of them is archived, by category"),
+        "discordless_witm_responses_served_total": ("counter", "requests answered from the archive, by category"),
+        "discordless_witm_responses_passed_through_total": ("counter", "already-archived CDN assets streamed through without being buffered, by category"),
+        "discordless_witm_bytes_written_total": ("counter", "bytes of archived traffic written to disk, by category"),
+        "discordless_witm_archive_size_bytes": ("gauge", "bytes the archive's contents take up, as far as the recorder knows; only kept track of with witm_quota"),
+        "discordless_witm_entries_evicted_total": ("counter", "request_index entries whose contents were evicted to stay under witm_quota, by tier"),
+        "discordless_witm_page_messages_total": ("counter", "messages in message pages stored as deltas, by whether they were new (or changed) or unchanged"),
+        "discordless_witm_gateway_messages_total": ("counter", "Gateway messages archived, by open gateway"),
+        "discordless_witm_gateway_bytes_total": ("counter", "Gateway bytes archived, by open gateway"),
+        "discordless_witm_open_gateways": ("gauge", "number of Gateway connections currently being archived"),
+        "discordless_witm_writer_queue_length": ("gauge", "archiving jobs waiting for the background writer"),
+        "discordless_witm_writer_latency_seconds": ("gauge", "moving average of how long archiving jobs take from being submitted to being done"),
+        "discordless_witm_shed_level": ("gauge", "how much low-priority archiving is being shed; 0 is none"),
+        "discordless_witm_ingest_dropped_total": ("counter", "responses and Gateway messages left out of the message store because it fell behind"),
+        "discordless_witm_hook_duration_seconds": ("histogram", "time spent inside each mitmproxy hook"),
+        "discordless_witm_write_duration_seconds": ("histogram", "time spent archiving a response or Gateway message, by kind"),
+    }
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {} # (name, sorted label items) : value, or [bucket counts..., sum, count] for histograms
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [0] * (len(self.BUCKETS) + 2)
+            histogram = self.values[key]
+            for i, bucket in enumerate(self.BUCKETS):
+                if value <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    """
+    Stop reporting a labelled series, like the counters for a Gateway that has closed.
+    """
+    def remove(self, name, **labels):
+        with self.lock:
+            self.values.pop((name, tuple(sorted(labels.items()))), None)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (metric_type, description) in self.METRICS.items():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for (series_name, labels), value in self.values.items():
+                    if series_name != name:
+                        continue
+                    if metric_type == "histogram":
+                        for bucket, bucket_count in zip(self.BUCKETS + ("+Inf",), value[:-2] + [value[-1]]):
+                            lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bucket),))} {bucket_count}")
+                        lines.append(f"{name}_sum{self.format_labels(labels)} {value[-2]}")
+                        lines.append(f"{name}_count{self.format_labels(labels)} {value[-1]}")
+                    else:
+                        lines.append(f"{name}{self.format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    """
+    Write metrics for node_exporter's textfile collector. Written atomically, as the collector expects.
+    """
+    def write(self, path):
+        with open(path + ".new", "w") as file:
+            file.write(self.render())
+        os.replace(path + ".new", path)
+
+"""
+Serves RecorderMetrics over http for Prometheus to scrape, on a background thread.
+"""
+class MetricsServer:
+    def __init__(self, port, metrics, collect):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                collect()
+                body = metrics.render().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass # don't spam mitmproxy's output with every scrape
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="witm-metrics", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+"""
+Periodically writes RecorderMetrics to a file, on a background thread.
+"""
+class MetricsFileWriter:
+    def __init__(self, path, interval, metrics, collect):
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self.collect = collect
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="witm-metrics-file", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        self.collect()
+        self.metrics.write(self.path)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write() # one last time, so the file reflects everything up to shutdown
+
+"""
+Decorator that records how long a hook takes in the hook duration histogram. Works on async hooks too.
+"""
+def timed_hook(hook_name):
+    def decorator(hook):
+        if asyncio.iscoroutinefunction(hook):
+            @functools.wraps(hook)
+            async def timed_async(self, flow):
+                start = time.perf_counter()
+                try:
+                    return await hook(self, flow)
+                finally:
+                    self.metrics.observe("discordless_witm_hook_duration_seconds", time.perf_counter() - start, hook=hook_name)
+            return timed_async
+
+        @functools.wraps(hook)
+        def timed(self, flow):
+            start = time.perf_counter()
+            try:
+                return hook(self, flow)
+            finally:
+                self.metrics.observe("discordless_witm_hook_duration_seconds", time.perf_counter() - start, hook=hook_name)
+        return timed
+    return decorator
+
+"""
+Encodes where an archived asset's contents are, from its request_index filename, as four integers for a FingerprintTable:
+(segment + 1, offset, length, flags) for packed contents,
+or (0, first half of the digest, second half of the digest, flags) for a file in requests/,
+where flags has LOCATION_COMPRESSED set if the contents are compressed,
+and LOCATION_SHARDED if the file is in a subdirectory of requests/ (see archive/content.py).
+Returns None for contents that can't be found again that way:
+files not named after their digest (from before `archive_tool.py dedupe`), wire-encoded contents and message pages.
+"""
+LOCATION_COMPRESSED = 1
+LOCATION_SHARDED = 2 # locations saved before requests/ was sharded don't have this, and so point straight into requests/
+NO_LOCATION = (0, 0, 0, 0) # stands in for contents that were evicted, since FingerprintTable can't delete
+
+def asset_location(filename):
+    if storage.stored_encoding_suffix_of(filename):
+        return None
+    flags = LOCATION_COMPRESSED if filename.endswith(storage.COMPRESSED_SUFFIX) else 0
+    if is_pack_ref(filename):
+        segment, offset, length, _suffix = parse_pack_ref(filename)
+        return segment + 1, offset, length, flags
+    if "/" in filename:
+        flags |= LOCATION_SHARDED
+    digest, _dot, _extension = flat_filename(filename).partition(".")
+    if len(digest) != DIGEST_SIZE * 2:
+        return None
+    try:
+        return 0, int(digest[:DIGEST_SIZE], 16), int(digest[DIGEST_SIZE:], 16), flags
+    except ValueError:
+        return None
+
+"""
+Numbers the media types that request_index records, so asset_locations (which only holds integers) can keep
+an asset's media type alongside where it is. Kept in a file of one media type per line; a media type's number
+is its line number counting from 1, so 0 stands for none recorded.
+"""
+class MediaTypeNumbers:
+    def __init__(self, path):
+        self.path = path
+        self.media_types = []
+        if os.path.exists(path):
+            with open(path) as media_types_file:
+                self.media_types = media_types_file.read().splitlines()
+        self.numbers = {media_type: number for number, media_type in enumerate(self.media_types, 1)}
+
+    def number(self, media_type):
+        if not media_type:
+            return 0
+        if media_type not in self.numbers:
+            with open(self.path, "a") as media_types_file:
+                media_types_file.write(media_type + "\n")
+            self.media_types.append(media_type)
+            self.numbers[media_type] = len(self.media_types)
+        return self.numbers[media_type]
+
+    def media_type(self, number):
+        return self.media_types[number - 1] if 0 < number <= len(self.media_types) else None
+
+"""
+The packed_contents key for contents with this digest, stored with this suffix (see storage.stored_encoding_suffix_of).
+A message page's manifest has the digest of the page it stands for, so it needs a key of its own.
+"""
+def packed_contents_key(response_hash, encoding_suffix=""):
+    if encoding_suffix == MESSAGE_PAGE_SUFFIX:
+        return fingerprint(response_hash, encoding_suffix)
+    return fingerprint(response_hash)
+
+"""
+Turns what asset_location returned back into a filename that ResponseStore can read.
+"""
+def asset_filename(location, url):
+    segment_plus_one, first, second, flags = location
+    suffix = content_extension(url) + (storage.COMPRESSED_SUFFIX if flags & LOCATION_COMPRESSED else "")
+    if segment_plus_one:
+        return pack_ref(segment_plus_one - 1, first, second, suffix)
+    filename = format(first, f"0{DIGEST_SIZE}x") + format(second, f"0{DIGEST_SIZE}x") + suffix
+    return sharded_filename(filename) if flags & LOCATION_SHARDED else filename
+
 """
 Archives Gateway payloads for a single Gateway connection.
+Payloads are group-committed: they're buffered in memory and written out together once the batch is old enough
+or big enough (see commit_interval and commit_bytes), rather than with a couple of small writes each.
+Each commit writes (and per durability, flushes or fsyncs) the payloads to _data before their lines go to _timeline,
+so the timeline never refers to data that isn't there; after a crash, _data can at worst have some extra bytes at the end.
+The files can be closed with suspend() while the Gateway is quiet; they're reopened for the next payload.
 """
 class Gatekeeper:
-    def __init__(self, data_path, timeline_path):
+    def __init__(self, name, data_path, timeline_path, durability="flush", commit_interval=0, commit_bytes=0):
+        self.name = name # the filename prefix, also used as its gateway id
+        self.data_path = data_path
+        self.timeline_path = timeline_path
         self.data_file = open(data_path, "xb") # Every payload we get from the Gateway, concatenated.
         self.timeline_file = open(timeline_path, "x") # Tracks when we got the Gateway payloads. Each line: {timestamp} {number of bytes received at that time}
+        self.durability = durability # "none": leave the timeline in Python's buffer, "flush": hand everything to the OS, "fsync": make it to the disk
+        self.commit_interval = commit_interval # seconds a payload may wait in the batch
+        self.commit_bytes = commit_bytes # batch size that triggers a commit right away
+        self.pending_data = bytearray()
+        self.pending_timeline = []
+        self.oldest_pending = None # time.monotonic() of the first payload in the batch
+        self.lock = threading.Lock() # commits also happen on the GroupCommitter's thread
 
     """
     Save Gateway payload.
     """
     def save(self, message):
-        payload_length = self.data_file.write(message.content)
-        self.timeline_file.write("{} {}\n".format(message.timestamp, payload_length))
-    
+        with self.lock:
+            if self.data_file is None:
+                self.data_file = open(self.data_path, "ab")
+                self.timeline_file = open(self.timeline_path, "a")
+            if self.oldest_pending is None:
+                self.oldest_pending = time.monotonic()
+            self.pending_data += message.content
+            self.pending_timeline.append("{} {}\n".format(message.timestamp, len(message.content)))
+            if len(self.pending_data) >= self.commit_bytes or time.monotonic() - self.oldest_pending >= self.commit_interval:
+                self._commit()
+
+    """
+    Commits the batch if it's been waiting for commit_interval.
+    """
+    def commit_if_due(self):
+        with self.lock:
+            if self.oldest_pending is not None and time.monotonic() - self.oldest_pending >= self.commit_interval:
+                self._commit()
+
+    def _commit(self):
+        if self.oldest_pending is None:
+            return
+        self.data_file.write(self.pending_data)
+        self.data_file.flush() # always, even with durability "none": the timeline must not reach the OS before its data
+        if self.durability == "fsync":
+            os.fsync(self.data_file.fileno())
+        self.timeline_file.write("".join(self.pending_timeline))
+        if self.durability != "none":
+            self.timeline_file.flush()
+        if self.durability == "fsync":
+            os.fsync(self.timeline_file.fileno())
+        self.pending_data = bytearray()
+        self.pending_timeline = []
+        self.oldest_pending = None
+
+    """
+    Commit the batch and close the files, until the next payload.
+    """
+    def suspend(self):
+        with self.lock:
+            if self.data_file is None:
+                return
+            self._commit()
+            self.data_file.close()
+            self.timeline_file.close()
+            self.data_file = self.timeline_file = None
+
     def done(self):
-        self.data_file.close()
-        self.timeline_file.close()
-        
+        self.suspend()
+
+"""
+Periodically commits Gateway batches that have waited long enough, on a background thread,
+so that a quiet Gateway's last payloads don't sit in memory until the next one arrives.
+"""
+class GroupCommitter:
+    def __init__(self, interval, commit):
+        self.interval = interval
+        self.commit = commit
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="witm-group-commit", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.commit()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+"""
+Passes a streamed response body through to the client, chunk by chunk, while spooling a copy of it to disk.
+mitmproxy calls this with each chunk as it arrives, and with b"" once the body is complete;
+at that point the copy is archived like any other response.
+The writes happen through the archiver's writer, so they don't block the event loop when the background writer is on.
+"""
+class TeeStream:
+    def __init__(self, archiver, timestamp, method, url, content_type, immutable_asset=None):
+        self.archiver = archiver
+        self.timestamp = timestamp
+        self.method = method
+        self.url = url
+        self.content_type = content_type
+        self.immutable_asset = immutable_asset
+        self.file = None
+        self.partial_path = None
+        self.hasher = hashlib.blake2b(digest_size=16)
+        self.size = 0
+        archiver.writer.submit(self.open, droppable=False)
+
+    def __call__(self, data):
+        if data:
+            self.archiver.writer.submit(self.write, data, droppable=False)
+        else:
+            self.archiver.writer.submit(self.finish, droppable=False)
+        return data
+
+    def open(self):
+        fd, self.partial_path = tempfile.mkstemp(dir=self.archiver.partial_path)
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        self.file.close()
+        partial_path, self.partial_path = self.partial_path, None
+        self.archiver.archive_streamed_response(
+            self.timestamp, self.method, self.url, self.content_type, self.hasher.hexdigest(), partial_path, self.size,
+            self.immutable_asset
+        )
+
+    """
+    Throw away the copy, like when the connection dies before the body is complete.
+    """
+    def abort(self):
+        self.archiver.writer.submit(self.discard, droppable=False)
+
+    def discard(self):
+        if self.partial_path is not None: # otherwise, it's already been archived
+            self.file.close()
+            os.remove(self.partial_path)
+            self.partial_path = None
+
+"""
+Bits of recorder bookkeeping that persist across restarts,
+so they don't have to be recomputed by scanning the indexes every time the recorder starts.
+Saved as a small JSON file, replaced atomically whenever it changes.
+"""
+class RecorderState:
+    def __init__(self, path, gateway_index_path, gateway_name_prefix=""):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as file:
+                self.next_gateway_id = json.load(file)["next_gateway_id"]
+        else: # first start with this archive; find the first unused gateway id the slow way, once
+            with open(gateway_index_path) as file:
+                self.next_gateway_id = max((int(flat_filename(line.split(" ")[-1]).removeprefix(gateway_name_prefix))+1 for line in file), default=0)
+            self.save()
+
+    """
+    Returns an unused gateway id. Saved before it's returned, so a crash can't hand out the same id twice.
+    """
+    def allocate_gateway_id(self):
+        gateway_id = self.next_gateway_id
+        self.next_gateway_id += 1
+        self.save()
+        return gateway_id
+
+    def save(self):
+        with open(self.path + ".new", "w") as file:
+            json.dump({"next_gateway_id": self.next_gateway_id}, file)
+        os.replace(self.path + ".new", self.path)
+
+"""
+Folds message list responses and Gateway messages into a MessageStore, on a thread of its own,
+so that decoding and SQLite never hold up the writer or the event loop.
+Jobs are committed in batches of whatever has queued up. When the queue is full, jobs are dropped rather than waited for:
+the store is only a cache of the archive. A Gateway that loses a message can't be decompressed past it,
+so the rest of that Gateway is left out.
+"""
+class MessageIngester:
+    QUEUE_SIZE = 10000
+    BATCH_SIZE = 500 # jobs per transaction, at most
+
+    def __init__(self, path, metrics):
+        self.path = path
+        self.metrics = metrics
+        self.jobs = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.streams = {} # gateway name : (seen timestamp, encoding, PayloadStream), only touched by the thread
+        self.lost_gateways = set() # names of Gateways that lost a message
+        self.thread = threading.Thread(target=self.run, name="witm-ingester", daemon=True)
+        self.thread.start()
+
+    """
+    wire_suffix is the response's wire encoding suffix if it's still encoded; it's decoded on the ingester's thread.
+    """
+    def submit_response(self, timestamp, content, wire_suffix=""):
+        self.submit(("response", timestamp, content, wire_suffix))
+
+    def submit_gateway_message(self, name, seen, url, content):
+        if name in self.lost_gateways:
+            return
+        if not self.submit(("gateway", name, seen, url, content)):
+            self.lost_gateways.add(name)
+            log_info(f"Message store fell behind; leaving the rest of Gateway {name} out of it.")
+
+    """
+    Forget a Gateway that has ended. Waits for room rather than being dropped, so its decompressor can't linger.
+    """
+    def submit_gateway_end(self, name):
+        self.jobs.put(("gateway_end", name))
+
+    def submit(self, job):
+        try:
+            self.jobs.put_nowait(job)
+            return True
+        except queue.Full:
+            self.metrics.count("discordless_witm_ingest_dropped_total")
+            return False
+
+    def run(self):
+        store = MessageStore(self.path) # SQLite connections belong to the thread that opens them
+        stopping = False
+        while not stopping:
+            batch = [self.jobs.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            for job in batch:
+                if job is None:
+                    stopping = True
+                    continue
+                try:
+                    self.ingest(store, *job)
+                except Exception as e: # one odd response shouldn't stop the store
+                    log_info(f"Error while adding to the message store: {e!r}")
+            store.commit()
+        store.close()
+
+    def ingest(self, store, kind, *args):
+        if kind == "response":
+            timestamp, content, wire_suffix = args
+            if wire_suffix:
+                content = storage.decode_wire(content, wire_suffix)
+            store.observe_messages_response(timestamp, content)
+            return
+        if kind == "gateway_end":
+            name, = args
+            self.streams.pop(name, None)
+            self.lost_gateways.discard(name)
+            return
+        name, seen, url, content = args
+        if name in self.lost_gateways:
+            self.streams.pop(name, None)
+            return
+        if name not in self.streams:
+            self.streams[name] = (seen, gateways.gateway_query(url).get("encoding"), gateways.PayloadStream(url))
+        seen, encoding, stream = self.streams[name]
+        try:
+            payload = stream.feed(content)
+        except gateways.DECOMPRESSION_ERRORS:
+            self.lost_gateways.add(name)
+            self.streams.pop(name)
+            raise
+        if payload is not None:
+            store.observe_gateway_payload(seen, gateways.decode_payload(payload, encoding))
+
+    """
+    Wait for every queued job to be stored, then stop the thread.
+    """
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+"""
+Plans evictions for witm_quota on a thread of its own, since that means reading this recorder's whole
+request_index segment, every other segment, and the message keys of pages (cached in state/page_keys).
+The writer goes on archiving meanwhile, and picks the plan up to apply it after the next thing it archives
+(see DiscordArchiver.check_quota); it can't be handed to the writer directly, since InlineWriter runs jobs on the caller.
+"""
+class EvictionPlanner:
+    def __init__(self, archiver):
+        self.archiver = archiver
+        self.jobs = queue.Queue()
+        self.plans = queue.Queue() # (plan or None, indexed_size)
+        self.thread = threading.Thread(target=self.run, name="witm-quota", daemon=True)
+        self.thread.start()
+
+    """
+    Plan evictions from the first indexed_size bytes of index_path, which is as far as the writer had written it.
+    """
+    def submit_plan(self, index_path, indexed_size, bytes_to_free, media_age, media_size):
+        self.jobs.put(("plan", index_path, indexed_size, bytes_to_free, media_age, media_size))
+
+    def submit_forget(self, filenames):
+        self.jobs.put(("forget", filenames))
+
+    def run(self):
+        store = storage.ResponseStore(self.archiver.archive_path) # the writer's is for the writer
+        page_keys = PageKeyCache(os.path.join(self.archiver.state_path, "page_keys"), store)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            kind, *args = job
+            if kind == "forget":
+                page_keys.forget(*args)
+                continue
+            try:
+                plan = self.plan(store, page_keys, *args)
+            except Exception as e: # the writer still needs to hear back, or it never plans again
+                log_info(f"Couldn't plan evictions: {e!r}")
+                plan = None
+            self.plans.put((plan, args[1]))
+        store.close()
+
+    """
+    Returns (plan, indexed_size) for a plan that's done, or None if there isn't one yet.
+    """
+    def finished_plan(self):
+        try:
+            return self.plans.get_nowait()
+        except queue.Empty:
+            return None
+
+    def plan(self, store, page_keys, index_path, indexed_size, bytes_to_free, media_age, media_size):
+        lines = read_index_lines(index_path, end=indexed_size)
+        # Contents that other instances' index segments point at stay, whatever this one's entries say.
+        protected = set()
+        for path in index_segment_paths(self.archiver.archive_path):
+            if os.path.normpath(path) == os.path.normpath(index_path):
+                continue
+            with open(path) as index_file:
+                protected.update(entry.filename for entry in parse_index_lines(index_file) if entry is not None and entry.has_content())
+        plan = plan_evictions(store, lines, bytes_to_free, media_age, media_size, protected, page_keys=page_keys.get)
+        page_keys.save()
+        if plan.counts:
+            with open(index_path + ".new", "w") as new_index_file:
+                new_index_file.writelines(plan.lines)
+        return plan
+
+    """
+    Stop the thread without waiting for a plan it's in the middle of; that plan is dropped,
+    and the archive is checked against witm_quota again on the next start.
+    """
+    def close(self):
+        self.jobs.put(None)
+
+"""
+Exponentially weighted moving average of how long archiving jobs take, from being submitted to being done.
+"""
+class WriterLatency:
+    SMOOTHING = 0.1 # weight of the newest job
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def observe(self, seconds):
+        self.seconds += self.SMOOTHING * (seconds - self.seconds)
+
+"""
+Runs archiving jobs right away, on mitmproxy's event loop.
+This is the default; see ThreadedWriter for the alternative.
+"""
+class InlineWriter:
+    def __init__(self):
+        self.latency = WriterLatency()
+
+    def submit(self, job, *args, droppable=True):
+        submitted = time.perf_counter()
+        job(*args)
+        self.latency.observe(time.perf_counter() - submitted)
+
+    def pending_jobs(self):
+        return 0
+
+    def close(self):
+        pass
+
+"""
+Runs archiving jobs on a dedicated thread, so that hashing and disk I/O don't block proxied traffic.
+Jobs run one at a time in the order they were submitted.
+droppable jobs are subject to the overflow policy when the queue is full; other jobs always wait for room.
+"""
+class ThreadedWriter:
+    def __init__(self, queue_size, overflow_policy, metrics):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.overflow_policy = overflow_policy
+        self.metrics = metrics
+        self.lock = threading.Lock() # held while a job runs, so that "inline" overflow jobs don't race the thread
+        self.dropped_jobs_count = 0
+        self.latency = WriterLatency()
+        self.thread = threading.Thread(target=self.run, name="witm-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, job, *args, droppable=True):
+        submitted = time.perf_counter()
+        try:
+            self.jobs.put_nowait((job, args, submitted))
+            return
+        except queue.Full:
+            pass
+        if droppable and self.overflow_policy == "drop":
+            self.dropped_jobs_count += 1
+            self.metrics.count("discordless_witm_responses_dropped_total")
+            log_info(f"Writer queue is full; dropped a response. ({self.dropped_jobs_count} dropped so far)")
+        elif droppable and self.overflow_policy == "inline":
+            with self.lock:
+                self.run_job(job, args, submitted)
+        else:
+            self.jobs.put((job, args, submitted))
+
+    def pending_jobs(self):
+        return self.jobs.qsize()
+
+    def run(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            with self.lock:
+                self.run_job(*item)
+
+    def run_job(self, job, args, submitted):
+        try:
+            job(*args)
+        except Exception as e: # keep the writer alive; one bad response shouldn't stop the archive
+            log_info(f"Error while archiving: {e!r}")
+        self.latency.observe(time.perf_counter() - submitted)
+
+    """
+    Wait for every queued job to finish, then stop the thread.
+    """
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+"""
+Decides how much low-priority archiving to shed while the writer can't keep up, going by its backlog and latency.
+The pressure is how far the worse of the two is past its threshold; each level in SHED_REASONS kicks in
+at its pressure in LEVEL_PRESSURES, and sheds what the levels before it do too.
+"""
+class LoadShedder:
+    SHED_REASONS = ("small_avatar", "media", "duplicate_page") # what each level starts shedding, in order
+    LEVEL_PRESSURES = (1, 2, 4)
+    MAX_AVATAR_SIZE = 4096 # the biggest ?size= Discord's CDN serves
+
+    def __init__(self, backlog_threshold=0, latency_threshold=0):
+        self.backlog_threshold = backlog_threshold # pending jobs; 0 ignores the backlog
+        self.latency_threshold = latency_threshold # seconds; 0 ignores the latency
+
+    def enabled(self):
+        return bool(self.backlog_threshold or self.latency_threshold)
+
+    def level(self, writer):
+        pressure = 0
+        if self.backlog_threshold:
+            pressure = max(pressure, writer.pending_jobs() / self.backlog_threshold)
+        if self.latency_threshold:
+            pressure = max(pressure, writer.latency.seconds / self.latency_threshold)
+        return sum(pressure >= level_pressure for level_pressure in self.LEVEL_PRESSURES)
+
+    """
+    Returns why a response should be shed at this level, or None if it shouldn't be.
+    is_archived_page tells whether a message page's url is already archived.
+    """
+    def shed_reason(self, level, url, is_archived_page):
+        route = routes.classify(url)
+        query = parse_qs(urlparse(url).query)
+        if level >= 1 and route.tag == "avatar":
+            size = query.get("size", [""])[0]
+            if size.isdigit() and int(size) < self.MAX_AVATAR_SIZE:
+                return "small_avatar"
+        if level >= 2 and url_category(url) in ("media_proxy", "external_media"):
+            return "media"
+        # Only pages of older messages: the newest page, or one after a message, can have messages we haven't seen yet.
+        if level >= 3 and route.tag == "channel_messages" and "before" in query and is_archived_page(url):
+            return "duplicate_page"
+        return None
+
 class DiscordArchiver:
     def __init__(self):
         self.archive_path = "traffic_archive/"
         
+        self.instance = "" # see witm_instance; the archive is opened once it's known
+        self.request_index_file = None
+        self.gatekeepers = {} # flow id : Gatekeeper, for Gateways that haven't ended
+        self.open_gatekeepers = OrderedDict() # flow id : Gatekeeper with open files, least recently active first
+        self.max_open_gateways = 32
+        self.trim_websocket_messages = True
+        self.metrics = RecorderMetrics()
+        self.metrics_server = None
+        self.metrics_file_writer = None
+        self.writer = InlineWriter()
+        self.tee_stream_size = 0
+        self.raw_content = False
+        self.pass_archived_assets = True
+        self.serve_archived_assets = False
+        self.supersede_variants = False
+        self.load_shedder = LoadShedder()
+        self.capture_policy = CapturePolicy([]) # archives everything, until the policy file is loaded
+        self.capture_policy_path = None
+        self.capture_policy_mtime = None
+        self.capture_policy_checked = 0 # time.monotonic() of the last check for changes
+        self.shed_level = 0
+        self.zstd_dict = None # used when compress_level is set
+        self.compress_level = None
+        self.gatekeeper_options = {} # Gatekeeper's settings for new Gateways
+        self.group_committer = None
+        self.pack_writer = None # set in pack mode
+        self.packed_contents = None # content digest fingerprint : (segment, offset, length, compressed), once pack mode has been on
+        self.message_ingester = None # set with witm_message_store
+        self.message_pack_writer = None # set with witm_message_deltas
+        self.message_blobs = None # (message id, message digest) fingerprint : (segment, offset, length, compressed), once witm_message_deltas has been on
+        self.quota = 0 # bytes; 0 if there's no witm_quota
+        self.quota_media_age = 30 * DAY
+        self.quota_media_size = 1024 * 1024
+        self.quota_next_check = 0 # archive size past which evictions are planned again
+        self.archive_size = None # bytes the archive's contents take up, kept up to date on the writer once it's been measured
+        self.archive_size_saved = None # archive_size when it was last saved to state/archive_size
+        self.eviction_planner = None # set with witm_quota
+        self.evicting = False # whether the eviction planner is planning, so the writer doesn't ask again meanwhile
+        self.evictable_written = 0 # bytes written to requests/, which eviction can free, since evictions were last planned
+        self.quota_stuck_since = None # time.monotonic() when a plan last left the archive over witm_quota, if it did
+
+    """
+    Opens the archive's files, building whatever bookkeeping in state/ is missing.
+    With an instance name, this recorder appends to index segments of its own and keeps its own state/,
+    both in instances/{instance}/ (see archive/index.py), and names its Gateways {instance}-{id},
+    so other instances can record to the same archive at the same time.
+    """
+    def open_archive(self, instance):
+        self.instance = instance
         self.requests_path = os.path.join(self.archive_path, "requests/")
         self.gateways_path = os.path.join(self.archive_path, "gateways/")
 
+        own_path = instance_path(self.archive_path, instance) if instance else self.archive_path
+        self.state_path = os.path.join(own_path, "state/")
+
         os.makedirs(self.requests_path, exist_ok=True)
         os.makedirs(self.gateways_path, exist_ok=True)
+        for shard in range(16 ** SHARD_LENGTH):
+            os.makedirs(os.path.join(self.requests_path, format(shard, f"0{SHARD_LENGTH}x")), exist_ok=True)
+        # Archives from before requests/ was sharded have their files straight in it, until `archive_tool.py reshard`.
+        with os.scandir(self.requests_path) as requests_entries:
+            self.flat_requests = any(requests_entry.is_file() for requests_entry in requests_entries)
+        os.makedirs(self.state_path, exist_ok=True)
+
+        self.archive_size_path = os.path.join(self.state_path, "archive_size")
+        if os.path.exists(self.archive_size_path):
+            with open(self.archive_size_path) as archive_size_file:
+                self.archive_size = self.archive_size_saved = int(archive_size_file.read())
+
+        # Anything left over in here is from a write that never finished.
+        self.partial_path = os.path.join(self.state_path, "partial/")
+        os.makedirs(self.partial_path, exist_ok=True)
+        for leftover in os.listdir(self.partial_path):
+            os.remove(os.path.join(self.partial_path, leftover))
 
         # open the index files in line buffering mode: after a line is written, changes are flushed to the disk
-        self.request_index_file = open(os.path.join(self.archive_path, "request_index"), "a+", buffering=1) # each line: {timestamp} {method} {url} {response hash} {filename}
-        self.gateway_index_file = open(os.path.join(self.archive_path, "gateway_index"), "a+", buffering=1) # each line: {timestamp} {url} {gateway filename w/o _data or _timeline}
-        self.request_index_file.seek(0)
-        self.gateway_index_file.seek(0)
-        
-        self.recorded_response_hashes = set() # {(url, hash),...}
-        for line in self.request_index_file:
-            _timestamp, _method, url, response_hash, _filename = line.rstrip().split(maxsplit=4)
-            self.recorded_response_hashes.add((url, response_hash))
+        self.request_index_file = open(os.path.join(own_path, REQUEST_INDEX), "a", buffering=1) # each line: {timestamp} {method} {url} {response hash} {filename} {key=value attributes}
+        self.gateway_index_file = open(os.path.join(own_path, GATEWAY_INDEX), "a", buffering=1) # each line: {timestamp} {url} {gateway filename w/o _data or _timeline}
+
+        # Remember which (url, content digest) pairs we've archived with a compact on-disk index,
+        # rather than reading all of request_index into memory on every start.
+        dedup_index_path = os.path.join(self.state_path, "dedup_index")
+        dedup_index_is_new = not os.path.exists(dedup_index_path)
+        self.recorded_responses = FingerprintSet(dedup_index_path, os.path.join(self.state_path, "dedup_bloom"))
+        if dedup_index_is_new:
+            log_info("Building dedup index from request_index. This only happens once.")
+            for entry in read_request_index(self.archive_path):
+                self.recorded_responses.add(fingerprint(entry.url, entry.response_hash))
+
+        self.assets_lock = threading.Lock() # for the asset maps; they're looked up on the event loop and added to on the writer
+        self.build_asset_maps(*self.open_asset_maps())
+
+        # Remember which pages of older messages we've archived, so they can be shed when the writer is behind.
+        archived_pages_path = os.path.join(self.state_path, "archived_pages")
+        archived_pages_is_new = not os.path.exists(archived_pages_path)
+        self.archived_pages = FingerprintTable(archived_pages_path) # url fingerprints
+        self.archived_pages_lock = threading.Lock() # looked up on the event loop, added to on the writer
+        if archived_pages_is_new:
+            log_info("Building archived message page map from request_index. This only happens once.")
+            for entry in read_request_index(self.archive_path, route_tags=("channel_messages",)):
+                self.remember_archived_page(entry)
+
+        self.gateway_name_prefix = f"{instance}-" if instance else ""
+        self.state = RecorderState(os.path.join(self.state_path, "recorder_state"), os.path.join(own_path, GATEWAY_INDEX), self.gateway_name_prefix)
+        log_info(f"first unused gateway flow id is {self.state.next_gateway_id}")
+
+    def load(self, loader):
+        loader.add_option(
+            "witm_instance", str, "",
+            "Name of this recorder instance, for running several against one archive. Empty if it's the only one."
+        )
+        loader.add_option(
+            "witm_capture_policy", str, "",
+            "File of rules for which responses to archive, skip, or only index. Empty uses the capture_policy.txt next to this script."
+        )
+        loader.add_option(
+            "witm_background_writer", bool, False,
+            "Hash and write archived traffic on a dedicated thread instead of mitmproxy's event loop."
+        )
+        loader.add_option(
+            "witm_writer_queue_size", int, 1000,
+            "How many pending writes the background writer may queue up."
+        )
+        loader.add_option(
+            "witm_writer_overflow", str, "block",
+            "What to do with a response when the background writer's queue is full. Gateway messages always block.",
+            choices=["block", "drop", "inline"]
+        )
+        loader.add_option(
+            "witm_shed_backlog", int, 0,
+            "Shed low-priority responses once this many archiving jobs are waiting for the writer. 0 disables this."
+        )
+        loader.add_option(
+            "witm_shed_latency", int, 0,
+            "Shed low-priority responses once archiving jobs take this many milliseconds on average. 0 disables this."
+        )
+        loader.add_option(
+            "witm_metrics_port", int, 0,
+            "Serve Prometheus metrics on this port on localhost. 0 disables this."
+        )
+        loader.add_option(
+            "witm_metrics_file", str, "",
+            "Periodically write Prometheus metrics to this file. Empty disables this."
+        )
+        loader.add_option(
+            "witm_metrics_interval", int, 15,
+            "Seconds between writes of witm_metrics_file."
+        )
+        loader.add_option(
+            "witm_zstd", bool, False,
+            "Store compressible responses zstd-compressed, using the newest trained dictionary in the archive. Needs pyzstd."
+        )
+        loader.add_option(
+            "witm_zstd_level", int, 3,
+            "zstd compression level for witm_zstd."
+        )
+        loader.add_option(
+            "witm_raw_content", bool, False,
+            "Store response bodies as they came over the wire, still compressed, instead of decoding them."
+        )
+        loader.add_option(
+            "witm_pass_archived_assets", bool, True,
+            "Stream already-archived attachments, avatars, icons and emoji straight through instead of buffering them again."
+        )
+        loader.add_option(
+            "witm_serve_archived_assets", bool, False,
+            "Answer requests for already-archived attachments, avatars, icons and emoji from the archive instead of asking Discord."
+        )
+        loader.add_option(
+            "witm_supersede_variants", bool, False,
+            "Don't store smaller variants of attachments, embeds, avatars, icons and emoji that are already archived in a better one."
+        )
+        loader.add_option(
+            "witm_tee_stream_size", str, "",
+            "Stream Discord CDN downloads at least this big (like 4m) to the client while copying them to disk. Empty disables this."
+        )
+        loader.add_option(
+            "witm_gateway_commit_interval", int, 200,
+            "Milliseconds Gateway messages may be batched in memory before they're written out together. 0 writes each one right away."
+        )
+        loader.add_option(
+            "witm_gateway_commit_size", str, "256k",
+            "Write a Gateway's batch of messages out as soon as it's this big."
+        )
+        loader.add_option(
+            "witm_gateway_durability", str, "flush",
+            "How hard to push each batch of Gateway messages towards the disk.",
+            choices=["none", "flush", "fsync"]
+        )
+        loader.add_option(
+            "witm_packs", bool, False,
+            "Append response contents to rotating pack files in packs/ instead of creating a file per response."
+        )
+        loader.add_option(
+            "witm_pack_segment_size", str, "256m",
+            "Start a new pack file (or message pack file) once the current one is this big."
+        )
+        loader.add_option(
+            "witm_message_deltas", bool, False,
+            "Store message list responses as lists of their messages, storing each version of a message only once."
+        )
+        loader.add_option(
+            "witm_max_open_gateways", int, 32,
+            "How many Gateways may have their files open at once. The least recently active ones are closed until their next message."
+        )
+        loader.add_option(
+            "witm_trim_websocket_messages", bool, True,
+            "Forget Gateway messages once they're handed to the writer, instead of keeping them in the flow until it ends."
+        )
+        loader.add_option(
+            "witm_message_store", bool, False,
+            "Keep messages.sqlite up to date with the messages, users and channels in archived traffic, on a thread of its own."
+        )
+        loader.add_option(
+            "witm_quota", str, "",
+            "Evict superseded variants, old media and duplicate message pages to keep the archive under this size (like 20g). Empty disables this."
+        )
+        loader.add_option(
+            "witm_quota_media_age", int, 30,
+            "Days media must go unfetched before witm_quota may evict it."
+        )
+        loader.add_option(
+            "witm_quota_media_size", str, "1m",
+            "Smallest media file witm_quota may evict."
+        )
+
+    def configure(self, updated):
+        # Options set on the command line can come in before the rest, so open the archive on whichever call comes first.
+        if self.request_index_file is None:
+            instance = ctx.options.witm_instance
+            if instance and not INSTANCE_NAME_PATTERN.fullmatch(instance):
+                raise exceptions.OptionsError(f"witm_instance may only contain letters, digits, - and _, not {instance!r}")
+            self.open_archive(instance)
+        elif "witm_instance" in updated and ctx.options.witm_instance != self.instance:
+            log_info("witm_instance only takes effect when mitmproxy starts. Still recording as before.")
 
-        self.recorded_gateways_count = max((int(line.split(" ")[-1])+1 for line in self.gateway_index_file),default=0) # find first unused gateway id
-        self.gatekeepers = {}
+        if "witm_capture_policy" in updated:
+            self.capture_policy_path = ctx.options.witm_capture_policy or DEFAULT_CAPTURE_POLICY_PATH
+            self.capture_policy_mtime = None
+            self.reload_capture_policy()
 
-        log_info(f"first unused gateway flow id is {self.recorded_gateways_count}")
+        if updated & {"witm_background_writer", "witm_writer_queue_size", "witm_writer_overflow"}:
+            self.writer.close() # drain the old writer first, so jobs stay in order
+            if ctx.options.witm_background_writer:
+                log_info(f"Using background writer with queue size {ctx.options.witm_writer_queue_size}.")
+                self.writer = ThreadedWriter(ctx.options.witm_writer_queue_size, ctx.options.witm_writer_overflow, self.metrics)
+            else:
+                self.writer = InlineWriter()
 
+        if updated & {"witm_shed_backlog", "witm_shed_latency"}:
+            self.load_shedder = LoadShedder(ctx.options.witm_shed_backlog, ctx.options.witm_shed_latency / 1000)
+
+        if "witm_metrics_port" in updated:
+            if self.metrics_server:
+                self.metrics_server.close()
+                self.metrics_server = None
+            if ctx.options.witm_metrics_port:
+                log_info(f"Serving metrics on http://127.0.0.1:{ctx.options.witm_metrics_port}/metrics")
+                self.metrics_server = MetricsServer(ctx.options.witm_metrics_port, self.metrics, self.collect_metrics)
+
+        if updated & {"witm_metrics_file", "witm_metrics_interval"}:
+            if self.metrics_file_writer:
+                self.metrics_file_writer.close()
+                self.metrics_file_writer = None
+            if ctx.options.witm_metrics_file:
+                self.metrics_file_writer = MetricsFileWriter(
+                    ctx.options.witm_metrics_file, ctx.options.witm_metrics_interval, self.metrics, self.collect_metrics
+                )
+
+        if updated & {"witm_zstd", "witm_zstd_level"}:
+            self.compress_level = None
+            if ctx.options.witm_zstd and storage.pyzstd is None:
+                log_info("witm_zstd needs pyzstd, which isn't installed in mitmproxy's Python. Storing responses uncompressed.")
+            elif ctx.options.witm_zstd:
+                self.zstd_dict = storage.DictionaryDirectory(os.path.join(self.archive_path, "dictionaries")).newest()
+                if self.zstd_dict is None:
+                    log_info("No zstd dictionary yet; run `archive_tool.py train-dictionary` for better compression.")
+                self.compress_level = ctx.options.witm_zstd_level
+
+        if "witm_raw_content" in updated:
+            self.raw_content = ctx.options.witm_raw_content
+
+        if "witm_pass_archived_assets" in updated:
+            self.pass_archived_assets = ctx.options.witm_pass_archived_assets
+
+        if "witm_serve_archived_assets" in updated:
+            self.serve_archived_assets = ctx.options.witm_serve_archived_assets
+
+        if "witm_supersede_variants" in updated:
+            self.supersede_variants = ctx.options.witm_supersede_variants
+
+        if "witm_tee_stream_size" in updated:
+            self.tee_stream_size = human.parse_size(ctx.options.witm_tee_stream_size) if ctx.options.witm_tee_stream_size else 0
+
+        if updated & {"witm_gateway_commit_interval", "witm_gateway_commit_size", "witm_gateway_durability"}:
+            self.gatekeeper_options = dict(
+                durability=ctx.options.witm_gateway_durability,
+                commit_interval=ctx.options.witm_gateway_commit_interval / 1000,
+                commit_bytes=human.parse_size(ctx.options.witm_gateway_commit_size) or 0,
+            )
+
+        if "witm_gateway_commit_interval" in updated:
+            if self.group_committer:
+                self.group_committer.close()
+                self.group_committer = None
+            if ctx.options.witm_gateway_commit_interval:
+                self.group_committer = GroupCommitter(ctx.options.witm_gateway_commit_interval / 1000, self.commit_gateways)
+
+        if updated & {"witm_packs", "witm_pack_segment_size"}:
+            self.writer.submit(self.set_pack_mode, ctx.options.witm_packs, human.parse_size(ctx.options.witm_pack_segment_size), droppable=False)
+
+        if updated & {"witm_message_deltas", "witm_pack_segment_size"}:
+            self.writer.submit(self.set_message_deltas, ctx.options.witm_message_deltas, human.parse_size(ctx.options.witm_pack_segment_size), droppable=False)
+
+        if "witm_max_open_gateways" in updated:
+            self.max_open_gateways = max(ctx.options.witm_max_open_gateways, 1)
+
+        if "witm_trim_websocket_messages" in updated:
+            self.trim_websocket_messages = ctx.options.witm_trim_websocket_messages
+
+        if "witm_message_store" in updated:
+            self.writer.submit(self.set_message_store, ctx.options.witm_message_store, droppable=False)
+
+        if updated & {"witm_quota", "witm_quota_media_age", "witm_quota_media_size"}:
+            self.writer.submit(
+                self.set_quota,
+                human.parse_size(ctx.options.witm_quota) if ctx.options.witm_quota else 0,
+                ctx.options.witm_quota_media_age * DAY,
+                human.parse_size(ctx.options.witm_quota_media_size) if ctx.options.witm_quota_media_size else 0,
+                droppable=False
+            )
+
+    """
+    Load the capture policy file if it changed since it was last loaded.
+    A policy that doesn't load leaves the current one in place.
+    """
+    def reload_capture_policy(self):
+        self.capture_policy_checked = time.monotonic()
+        try:
+            mtime = os.stat(self.capture_policy_path).st_mtime_ns
+            if mtime == self.capture_policy_mtime:
+                return
+            self.capture_policy = CapturePolicy.load(self.capture_policy_path)
+        except (OSError, ValueError) as e:
+            log_info(f"Couldn't load capture policy: {e}. Keeping the current one.")
+            return
+        self.capture_policy_mtime = mtime
+        log_info(f"Loaded capture policy {self.capture_policy_path} with {len(self.capture_policy.rules)} rules.")
+
+    """
+    Opens the maps of archived immutable CDN assets and asset variants. Returns which of them are new, and need building.
+    """
+    def open_asset_maps(self):
+        # Remember the immutable CDN assets we've archived, so responseheaders can let repeat downloads of them stream through.
+        immutable_assets_path = os.path.join(self.state_path, "immutable_assets")
+        immutable_assets_is_new = not os.path.exists(immutable_assets_path)
+        self.immutable_assets = FingerprintTable(immutable_assets_path, value_count=2) # asset key fingerprint : (size, ETag fingerprint or 0)
+        asset_locations_path = os.path.join(self.state_path, "asset_locations")
+        asset_media_types_path = os.path.join(self.state_path, "asset_media_types")
+        # The map's media type numbers mean nothing without their file, and maps from before it have no media types.
+        if os.path.exists(asset_locations_path) and not os.path.exists(asset_media_types_path):
+            os.remove(asset_locations_path)
+        asset_locations_is_new = not os.path.exists(asset_locations_path)
+        self.asset_media_types = MediaTypeNumbers(asset_media_types_path)
+        self.asset_locations = FingerprintTable(asset_locations_path, value_count=5) # asset key fingerprint : (*asset_location(), media type number)
+        # Remember the best variant of each asset we've archived, for witm_supersede_variants.
+        asset_variants_path = os.path.join(self.state_path, "asset_variants")
+        asset_variants_is_new = not os.path.exists(asset_variants_path)
+        self.asset_variants = FingerprintTable(asset_variants_path, value_count=5) # asset identity fingerprint : (score, *asset_location())
+        return immutable_assets_is_new, asset_locations_is_new, asset_variants_is_new
+
+    def build_asset_maps(self, immutable_assets_is_new, asset_locations_is_new, asset_variants_is_new):
+        if immutable_assets_is_new or asset_locations_is_new:
+            log_info("Building immutable asset maps from request_index. This only happens once.")
+            for entry in read_request_index(self.archive_path, route_tags=routes.IMMUTABLE_TAGS):
+                # Only entries that know they were complete, unencoded responses; the size is then the Content-Length.
+                if immutable_assets_is_new and entry.status == 200 and entry.size is not None and entry.encoding is None and entry.has_content():
+                    self.remember_immutable_asset((fingerprint(routes.immutable_asset_key(entry.url)), entry.size, 0))
+                if asset_locations_is_new:
+                    self.remember_asset_location(entry)
+        if asset_variants_is_new:
+            log_info("Building asset variant map from request_index. This only happens once.")
+            for entry in read_request_index(self.archive_path, route_tags=VARIANT_TAGS):
+                self.remember_asset_variant(entry)
+
+    """
+    Forgets where evicted contents were, so they're neither served nor superseded to. Runs on the writer, which adds to the maps.
+    changed is (filename before, entry) for each entry an eviction changed (see EvictionPlan).
+    The immutable asset map keeps evicted assets: they aren't archived again anyway, so they may as well stream through.
+    """
+    def forget_evicted_assets(self, changed):
+        with self.assets_lock:
+            for filename, entry in changed:
+                location = asset_location(filename)
+                if location is None or entry.status != 200:
+                    continue
+                route_tag = entry.get_route().tag
+                if route_tag in routes.IMMUTABLE_TAGS:
+                    asset_fingerprint = fingerprint(routes.immutable_asset_key(entry.url))
+                    archived = self.asset_locations.get(asset_fingerprint)
+                    if archived is not None and archived[:4] == location:
+                        self.asset_locations.replace(asset_fingerprint, *NO_LOCATION, 0)
+                variant = asset_variant(entry.url, route_tag)
+                if variant is not None:
+                    identity_fingerprint = fingerprint(variant[0])
+                    best = self.asset_variants.get(identity_fingerprint)
+                    if best is not None and best[1:] == location:
+                        self.asset_variants.replace(identity_fingerprint, 0, *NO_LOCATION) # any variant archived later beats it
+
+    """
+    Runs on the writer, so it can't swap the pack writer out from under a response that's being archived.
+    """
+    def set_pack_mode(self, enabled, segment_size):
+        if self.pack_writer:
+            self.pack_writer.close()
+            self.pack_writer = None
+        if not enabled:
+            return
+        if self.packed_contents is None:
+            packed_contents_path = os.path.join(self.state_path, "packed_contents")
+            packed_contents_is_new = not os.path.exists(packed_contents_path)
+            self.packed_contents = FingerprintTable(packed_contents_path, value_count=4)
+            if packed_contents_is_new:
+                log_info("Building packed contents map from request_index. This only happens once.")
+                for entry in read_request_index(self.archive_path):
+                    if is_pack_ref(entry.filename):
+                        segment, offset, length, suffix = parse_pack_ref(entry.filename)
+                        compressed = suffix.endswith(storage.COMPRESSED_SUFFIX)
+                        key = packed_contents_key(entry.response_hash, storage.stored_encoding_suffix_of(entry.filename))
+                        self.packed_contents.add(key, segment, offset, length, compressed)
+        log_info(f"Appending response contents to pack files of up to {segment_size} bytes.")
+        self.pack_writer = PackWriter(os.path.join(self.archive_path, "packs"), segment_size, shared=bool(self.instance))
+
+    """
+    Runs on the writer, like set_pack_mode.
+    """
+    def set_message_deltas(self, enabled, segment_size):
+        if self.message_pack_writer:
+            self.message_pack_writer.close()
+            self.message_pack_writer = None
+        if not enabled:
+            return
+        if self.message_blobs is None:
+            message_blobs_path = os.path.join(self.state_path, "message_blobs")
+            message_blobs_is_new = not os.path.exists(message_blobs_path)
+            self.message_blobs = FingerprintTable(message_blobs_path, value_count=4)
+            if message_blobs_is_new:
+                log_info("Building message map from request_index. This only happens once.")
+                store = storage.ResponseStore(self.archive_path)
+                for entry in read_request_index(self.archive_path, route_tags=("channel_messages",)):
+                    if storage.stored_encoding_suffix_of(entry.filename) != MESSAGE_PAGE_SUFFIX:
+                        continue
+                    manifest = store.read_stored(entry.filename)
+                    if entry.filename.endswith(storage.COMPRESSED_SUFFIX):
+                        manifest = store.decompress(manifest)
+                    for message_id, digest, ref in parse_manifest(manifest)[1]:
+                        segment, offset, length, suffix = parse_pack_ref(ref)
+                        compressed = suffix.endswith(storage.COMPRESSED_SUFFIX)
+                        self.message_blobs.add(fingerprint(message_id, digest), segment, offset, length, compressed)
+                store.close()
+        log_info("Storing message pages as per-message deltas.")
+        self.message_pack_writer = PackWriter(os.path.join(self.archive_path, MESSAGE_PACKS_DIRECTORY), segment_size, shared=bool(self.instance))
+
+    """
+    Runs on the writer, like set_pack_mode, since that's where the ingester is fed from.
+    """
+    def set_message_store(self, enabled):
+        if self.message_ingester:
+            self.message_ingester.close()
+            self.message_ingester = None
+        if enabled:
+            log_info("Keeping the message store up to date.")
+            self.message_ingester = MessageIngester(message_store_path(self.archive_path), self.metrics)
+
+    """
+    Runs on the writer, like set_pack_mode, since that's where the archive grows.
+    """
+    def set_quota(self, quota, media_age, media_size):
+        self.quota = quota
+        self.quota_media_age = media_age
+        self.quota_media_size = media_size
+        self.quota_next_check = quota
+        self.quota_stuck_since = None # the new settings may let more be evicted
+        if not quota:
+            return
+        if self.archive_size is None:
+            log_info("Measuring the archive for witm_quota. This only happens once.")
+            self.archive_size = measure_archive(self.archive_path)
+            self.save_archive_size()
+        if self.eviction_planner is None:
+            self.eviction_planner = EvictionPlanner(self)
+        log_info(f"Keeping the archive under {quota} bytes; it takes up {self.archive_size} now.")
+        self.check_quota()
+
+    """
+    Count bytes of archived traffic written to disk. evictable is for contents written to requests/;
+    what goes in pack files and gateways/ is never evicted.
+    """
+    def count_written(self, size, category, evictable=False):
+        self.metrics.count("discordless_witm_bytes_written_total", size, category=category)
+        if self.archive_size is not None:
+            self.archive_size += size
+        if evictable:
+            self.evictable_written += size
+
+    def save_archive_size(self):
+        with open(self.archive_size_path + ".new", "w") as archive_size_file:
+            archive_size_file.write(f"{self.archive_size}\n")
+        os.replace(self.archive_size_path + ".new", self.archive_size_path)
+        self.archive_size_saved = self.archive_size
+
+    """
+    Runs on the writer after each response or Gateway message is archived, rather than in the middle of archiving one.
+    """
+    def check_quota(self):
+        if self.archive_size is None:
+            return
+        if self.archive_size - self.archive_size_saved >= ARCHIVE_SIZE_SAVE_INTERVAL:
+            self.save_archive_size()
+        if self.evicting:
+            finished = self.eviction_planner.finished_plan()
+            if finished is not None:
+                self.finish_eviction(*finished)
+        elif self.quota and self.archive_size > self.quota_next_check and self.eviction_may_help():
+            self.start_eviction()
+
+    """
+    Whether planning evictions again may free anything. After a plan that left the archive over witm_quota,
+    what's left is contents that are never evicted (like Gateways) or not yet (like recent media), so the next plan
+    waits until this recorder has archived another percent of witm_quota to requests/, or for a day, as media ages;
+    otherwise every percent of Gateway growth would read the whole index again for nothing.
+    """
+    def eviction_may_help(self):
+        if self.quota_stuck_since is None:
+            return True
+        return self.evictable_written >= self.quota // 100 or time.monotonic() - self.quota_stuck_since >= DAY
+
+    """
+    The archive is over witm_quota: have the eviction planner plan evicting from this recorder's request_index
+    down to QUOTA_TARGET of it, from the index as far as it's written now. See archive/quota.py for what gets evicted.
+    Only the running total is checked here, so the writer never has to walk the archive.
+    """
+    def start_eviction(self):
+        bytes_to_free = self.archive_size - int(self.quota * QUOTA_TARGET)
+        log_info(f"The archive takes up {self.archive_size} bytes, over witm_quota. Planning to evict {bytes_to_free} bytes.")
+        self.request_index_file.flush()
+        indexed_size = os.fstat(self.request_index_file.fileno()).st_size
+        self.evicting = True
+        self.evictable_written = 0
+        self.eviction_planner.submit_plan(self.request_index_file.name, indexed_size, bytes_to_free, self.quota_media_age, self.quota_media_size)
+
+    """
+    Applies an eviction plan for the first indexed_size bytes of request_index, on the writer (from check_quota).
+    Only the lines archived since then are read, to append them to the planned index; contents they point at
+    again are kept. Then eviction isn't planned again until the archive has grown by another percent of witm_quota.
+    """
+    def finish_eviction(self, plan, indexed_size):
+        self.evicting = False
+        if plan is not None and plan.counts:
+            index_path = self.request_index_file.name
+            self.request_index_file.close()
+            new_lines = read_index_lines(index_path, start=indexed_size)
+            with open(index_path + ".new", "a") as new_index_file:
+                new_index_file.writelines(new_lines)
+            os.replace(index_path + ".new", index_path)
+            self.request_index_file = open(index_path, "a", buffering=1)
+            # Only remove the files once the index no longer points at them.
+            referenced = {entry.filename for entry in parse_index_lines(new_lines) if entry is not None and entry.has_content()}
+            store = storage.ResponseStore(self.archive_path)
+            bytes_freed = 0
+            for filename, size in plan.filenames.items():
+                if filename not in referenced:
+                    os.remove(store.path(filename))
+                    bytes_freed += size
+            store.close()
+            self.archive_size -= bytes_freed
+            for tier, count in plan.counts.items():
+                self.metrics.count("discordless_witm_entries_evicted_total", count, tier=tier)
+            self.forget_evicted_assets(plan.changed)
+            self.eviction_planner.submit_forget(plan.filenames.keys() - referenced)
+            log_info(f"Evicted {plan.summary()}; freed {bytes_freed} bytes.")
+        self.quota_stuck_since = None
+        if self.quota and self.archive_size > self.quota:
+            log_info(f"The archive still takes up {self.archive_size} bytes; nothing else may be evicted yet. "
+                f"Not planning again until another {self.quota // 100} bytes are archived to requests/, or for a day.")
+            self.quota_stuck_since = time.monotonic()
+        self.save_archive_size()
+        self.quota_next_check = max(self.quota, self.archive_size + self.quota // 100)
+
+    def commit_gateways(self):
+        for gatekeeper in list(self.gatekeepers.values()):
+            gatekeeper.commit_if_due()
+
+    """
+    Update gauges that are cheaper to read on demand than to keep up to date.
+    """
+    def collect_metrics(self):
+        self.metrics.set("discordless_witm_writer_queue_length", self.writer.pending_jobs())
+        self.metrics.set("discordless_witm_writer_latency_seconds", self.writer.latency.seconds)
+        if self.archive_size is not None:
+            self.metrics.set("discordless_witm_archive_size_bytes", self.archive_size)
+
+    @timed_hook("websocket_message")
     def websocket_message(self, flow: http.HTTPFlow):
         # aggressively capture any potential discord traffic
-        if not url_is_gateway(flow.request.pretty_url):
+        if not request_is_gateway(flow.request):
             log_info("websocket message is from non-gateway traffic: " + flow.request.pretty_url)
             return
-        message = flow.websocket.messages[-1]
-        if message.from_client:
+        if flow.metadata.get("witm_capture_policy") == "deny":
             return
-        if flow not in self.gatekeepers:
-            gateway_filename_prefix = str(self.recorded_gateways_count)
-            self.recorded_gateways_count += 1
-            self.gatekeepers[flow] = Gatekeeper(
+        message = flow.websocket.messages[-1]
+        if not message.from_client:
+            self.writer.submit(self.archive_gateway_message, flow, message, droppable=False)
+        if self.trim_websocket_messages:
+            # Nothing else needs the older messages, and a Gateway can stay connected for days.
+            del flow.websocket.messages[:-1]
+
+    def archive_gateway_message(self, flow, message):
+        start = time.perf_counter()
+        if flow.id not in self.gatekeepers:
+            gateway_name = self.gateway_name_prefix + str(self.state.allocate_gateway_id())
+            gateway_filename_prefix = gateways.gateway_shard(flow.response.timestamp_start) + "/" + gateway_name
+            os.makedirs(os.path.dirname(os.path.join(self.gateways_path, gateway_filename_prefix)), exist_ok=True)
+            self.gatekeepers[flow.id] = Gatekeeper(
+                gateway_name,
                 os.path.join(self.gateways_path, gateway_filename_prefix + "_data"),
                 os.path.join(self.gateways_path, gateway_filename_prefix + "_timeline"),
+                **self.gatekeeper_options
             )
             self.gateway_index_file.write(
                 " ".join((str(flow.response.timestamp_start), flow.request.pretty_url, gateway_filename_prefix)) + "\n"
             )
-            
+            self.metrics.set("discordless_witm_open_gateways", len(self.gatekeepers))
+
         log_info("Archiving Gateway message.")
-        self.gatekeepers[flow].save(message)
-    
+        gatekeeper = self.gatekeepers[flow.id]
+        gatekeeper.save(message)
+        self.open_gatekeepers[flow.id] = gatekeeper
+        self.open_gatekeepers.move_to_end(flow.id)
+        while len(self.open_gatekeepers) > self.max_open_gateways:
+            _flow_id, quiet_gatekeeper = self.open_gatekeepers.popitem(last=False)
+            quiet_gatekeeper.suspend()
+        if self.message_ingester:
+            self.message_ingester.submit_gateway_message(gatekeeper.name, flow.response.timestamp_start, flow.request.pretty_url, message.content)
+
+        self.metrics.count("discordless_witm_gateway_messages_total", gateway=gatekeeper.name)
+        self.metrics.count("discordless_witm_gateway_bytes_total", len(message.content), gateway=gatekeeper.name)
+        self.count_written(len(message.content), "gateway")
+        self.metrics.observe("discordless_witm_write_duration_seconds", time.perf_counter() - start, kind="gateway")
+        self.check_quota()
+
+    @timed_hook("websocket_end")
+    def websocket_end(self, flow: http.HTTPFlow):
+        if request_is_gateway(flow.request):
+            self.writer.submit(self.end_gateway, flow.id, droppable=False)
+
+    """
+    Close an ended Gateway's files and forget about it.
+    """
+    def end_gateway(self, flow_id):
+        gatekeeper = self.gatekeepers.pop(flow_id, None)
+        if gatekeeper is None: # the server never sent anything
+            return
+        self.open_gatekeepers.pop(flow_id, None)
+        gatekeeper.done()
+        log_info(f"Gateway {gatekeeper.name} ended.")
+        if self.message_ingester:
+            self.message_ingester.submit_gateway_end(gatekeeper.name)
+        self.metrics.remove("discordless_witm_gateway_messages_total", gateway=gatekeeper.name)
+        self.metrics.remove("discordless_witm_gateway_bytes_total", gateway=gatekeeper.name)
+        self.metrics.set("discordless_witm_open_gateways", len(self.gatekeepers))
+
+    @timed_hook("response")
     def response(self, flow: http.HTTPFlow) -> None:
+        if not request_is_discord(flow.request) or flow.metadata.get("witm_served_from_archive") or flow.metadata.get("witm_shed"):
+            return
+        action = self.policy_action(flow)
+        if action != "allow":
+            self.filter_response(flow, action)
+            return
+        content_encoding = flow.response.headers.get("content-encoding")
+        # Reading .content decodes the body every time, so read it (at most) once.
+        raw = self.raw_content and storage.wire_encoding_suffix(content_encoding) is not None
+        content = flow.response.raw_content if raw else flow.response.content
+        if content:
+            self.writer.submit(
+                self.archive_response,
+                flow.response.timestamp_start, flow.request.method, flow.request.pretty_url, content,
+                flow.response.status_code, flow.response.headers.get("content-type", ""), content_encoding, raw,
+                self.immutable_asset(flow)
+            )
+
+    """
+    The capture policy's action for a flow, as decided in requestheaders.
+    """
+    def policy_action(self, flow):
+        action = flow.metadata.get("witm_capture_policy")
+        if action is None: # the flow started before we were loaded
+            action = flow.metadata["witm_capture_policy"] = self.capture_policy_action(flow.request)
+        return action
+
+    def capture_policy_action(self, request):
+        return self.capture_policy.action(request.method, request.pretty_host, request.path.split("?")[0])
+
+    """
+    Skip a response the capture policy doesn't want stored, noting it in request_index if the action is "metadata".
+    Its body was streamed through (see responseheaders), so only its headers are left to go by.
+    """
+    def filter_response(self, flow, action):
         url = flow.request.pretty_url
-        if url_has_discord_root_domain(url) and flow.response.content:
-            response_hash = str(hash(flow.response.content))
-            
-            if (url, response_hash) in self.recorded_response_hashes:
-                log_info("Skipping hash-identical {}.".format(url))
-                return
-            
-            filename = safe_filename(str(len(self.recorded_response_hashes)) + "_" + url[8:].rsplit("?", maxsplit=1)[0])
+        self.metrics.count("discordless_witm_responses_filtered_total", action=action, category=url_category(url))
+        if action != "metadata":
+            return
+        content_encoding = flow.response.headers.get("content-encoding")
+        content_length = flow.response.headers.get("content-length", "")
+        entry = RequestIndexEntry(
+            str(flow.response.timestamp_start), flow.request.method, url, NO_CONTENT, NO_CONTENT,
+            status=flow.response.status_code, content_type=media_type(flow.response.headers.get("content-type", "")) or None,
+            size=int(content_length) if content_length.isdigit() and content_encoding is None else None,
+            encoding=content_encoding, route=routes.classify(url)
+        )
+        self.writer.submit(self.index_metadata, entry)
+
+    def index_metadata(self, entry):
+        log_info(f"Noting {entry.url} without its contents.")
+        self.request_index_file.write(entry.format())
+
+    """
+    Archive a response. If raw, content is still in content_encoding, and is stored that way.
+    immutable_asset is what immutable_asset() returned for it.
+    """
+    def archive_response(self, timestamp, method, url, content, status=None, content_type="", content_encoding=None, raw=False, immutable_asset=None):
+        start = time.perf_counter()
+        category = url_category(url)
+        response_hash = content_digest(content)
+
+        response_fingerprint = fingerprint(url, response_hash)
+        if response_fingerprint in self.recorded_responses:
+            log_info("Skipping hash-identical {}.".format(url))
+            self.metrics.count("discordless_witm_responses_skipped_total", category=category)
+            self.remember_immutable_asset(immutable_asset)
+            return
+
+        # Wire-encoded bodies are already compressed; don't spend time compressing them again.
+        compress = not raw and self.compress_level is not None and storage.is_compressible_content_type(content_type)
+        wire_suffix = storage.wire_encoding_suffix(content_encoding) if raw else ""
+        route = routes.classify(url)
+        better_variant = self.better_variant_filename(url, route) if self.supersede_variants and status == 200 else None
+        stored_content, stored_suffix = content, wire_suffix
+        if self.message_pack_writer and not raw and route.tag == "channel_messages" and status == 200 and media_type(content_type) == "application/json":
+            manifest = self.store_message_page(url, category, content)
+            if manifest is not None:
+                # The manifest is small already, and its messages are compressed on their own.
+                stored_content, stored_suffix, compress = manifest, MESSAGE_PAGE_SUFFIX, False
+        if better_variant is not None:
+            log_info("Already have a better variant of {} in {}.".format(url, better_variant))
+            self.metrics.count("discordless_witm_responses_superseded_total", category=category)
+            filename = better_variant
+        elif self.pack_writer:
+            filename = self.store_packed(url, category, response_hash, stored_content, compress, stored_suffix)
+        else:
+            filename = self.store_loose(url, category, response_hash, stored_content, compress, stored_suffix)
+
+        entry = RequestIndexEntry(
+            str(timestamp), method, url, response_hash, filename,
+            status=status, content_type=media_type(content_type) or None, size=None if raw else len(content), encoding=content_encoding,
+            route=route, superseded=better_variant is not None
+        )
+        self.index_response(entry, response_fingerprint, category)
+        self.remember_immutable_asset(immutable_asset)
+        if self.message_ingester and entry.route.tag == "channel_messages" and entry.is_success() and entry.is_json():
+            self.message_ingester.submit_response(entry.seen_timestamp, content, wire_suffix)
+        self.metrics.observe("discordless_witm_write_duration_seconds", time.perf_counter() - start, kind="response")
+        self.check_quota()
+
+    """
+    Stores response contents in requests/, unless they're already there. Returns their filename.
+    """
+    def store_loose(self, url, category, response_hash, content, compress, wire_suffix=""):
+        filename = content_filename(response_hash, url) + wire_suffix
+        path = os.path.join(self.requests_path, filename)
+        stored_filename = self.find_loose(filename)
+        if stored_filename is not None:
+            filename = stored_filename
+            log_info("Already have the contents of {} in {}.".format(url, filename))
+        else:
+            if compress:
+                content = storage.compress(content, self.zstd_dict, self.compress_level)
+                filename += storage.COMPRESSED_SUFFIX
+                path += storage.COMPRESSED_SUFFIX
             log_info("Archiving {} to {}.".format(url, filename))
-            
-            with open(os.path.join(self.requests_path, filename), "wb") as file:
-                file.write(flow.response.content)
-
-            self.request_index_file.write(
-                " ".join(
-                    (
-                        str(flow.response.timestamp_start),
-                        flow.request.method,
-                        url,
-                        response_hash,
-                        filename
-                    )
-                ) + "\n"
-            )
-            self.recorded_response_hashes.add((url, response_hash))
+            # Write to a temporary file first, so a crash can't leave truncated contents under a valid digest.
+            fd, partial_path = tempfile.mkstemp(dir=self.partial_path)
+            with os.fdopen(fd, "wb") as file:
+                file.write(content)
+            os.replace(partial_path, path)
+            self.count_written(len(content), category, evictable=True)
+        return filename
+
+    """
+    Returns the filename that contents are already stored under in requests/, compressed or not, or None.
+    Looks straight in requests/ too while there are files from before it was sharded (see archive/content.py).
+    """
+    def find_loose(self, filename):
+        candidates = (filename, flat_filename(filename)) if self.flat_requests else (filename,)
+        for candidate in candidates:
+            for suffix in ("", storage.COMPRESSED_SUFFIX):
+                if os.path.exists(os.path.join(self.requests_path, candidate + suffix)):
+                    return candidate + suffix
+        return None
+
+    """
+    Appends response contents to the current pack file, unless they're already packed. Returns their pack reference.
+    """
+    def store_packed(self, url, category, response_hash, content, compress, wire_suffix=""):
+        content_fingerprint = packed_contents_key(response_hash, wire_suffix)
+        location = self.packed_contents.get(content_fingerprint)
+        if location:
+            segment, offset, length, compressed = location
+        else:
+            compressed = compress
+            if compressed:
+                content = storage.compress(content, self.zstd_dict, self.compress_level)
+            segment, offset = self.pack_writer.append(content)
+            length = len(content)
+            self.packed_contents.add(content_fingerprint, segment, offset, length, compressed)
+            self.count_written(length, category)
+        filename = pack_ref(segment, offset, length, content_extension(url) + wire_suffix + (storage.COMPRESSED_SUFFIX if compressed else ""))
+        log_info("{} {} to {}.".format("Already have the contents of" if location else "Archiving", url, filename))
+        return filename
+
+    """
+    Appends the messages of a message list response that aren't in message_packs/ yet, in the version they're in now.
+    Returns the page's manifest, or None if it isn't a list of messages.
+    """
+    def store_message_page(self, url, category, content):
+        page = split_page(content)
+        if page is None:
+            return None
+        skeleton, messages = page
+        message_refs = []
+        new_messages = 0
+        for message_id, message in messages:
+            digest = content_digest(message)
+            message_fingerprint = fingerprint(message_id, digest)
+            location = self.message_blobs.get(message_fingerprint)
+            if location:
+                segment, offset, length, compressed = location
+            else:
+                compressed = False
+                if self.compress_level is not None:
+                    compressed_message = storage.compress(message, self.zstd_dict, self.compress_level)
+                    compressed = len(compressed_message) < len(message)
+                    if compressed:
+                        message = compressed_message
+                segment, offset = self.message_pack_writer.append(message)
+                length = len(message)
+                self.message_blobs.add(message_fingerprint, segment, offset, length, compressed)
+                self.count_written(length, category)
+                new_messages += 1
+            message_refs.append((message_id, digest, pack_ref(segment, offset, length, storage.COMPRESSED_SUFFIX if compressed else "")))
+        log_info("Storing {} new or changed messages of the {} in {}.".format(new_messages, len(messages), url))
+        self.metrics.count("discordless_witm_page_messages_total", new_messages, state="new")
+        self.metrics.count("discordless_witm_page_messages_total", len(messages) - new_messages, state="unchanged")
+        return format_manifest(skeleton, message_refs)
+
+    """
+    Like archive_response, but for a response that a TeeStream already spooled to partial_path.
+    """
+    def archive_streamed_response(self, timestamp, method, url, content_type, response_hash, partial_path, size, immutable_asset=None):
+        start = time.perf_counter()
+        category = url_category(url)
+
+        response_fingerprint = fingerprint(url, response_hash)
+        if response_fingerprint in self.recorded_responses:
+            log_info("Skipping hash-identical streamed {}.".format(url))
+            self.metrics.count("discordless_witm_responses_skipped_total", category=category)
+            self.remember_immutable_asset(immutable_asset)
+            os.remove(partial_path)
+            return
+
+        filename = content_filename(response_hash, url)
+        stored_filename = self.find_loose(filename)
+        if stored_filename is not None:
+            filename = stored_filename
+            log_info("Already have the contents of streamed {} in {}.".format(url, filename))
+            os.remove(partial_path)
+        else:
+            log_info("Archiving streamed {} to {}.".format(url, filename))
+            os.replace(partial_path, os.path.join(self.requests_path, filename))
+            self.count_written(size, category, evictable=True)
+
+        # Only complete, unencoded responses are tee-streamed; see responseheaders.
+        self.index_response(
+            RequestIndexEntry(
+                str(timestamp), method, url, response_hash, filename,
+                status=200, content_type=media_type(content_type) or None, size=size, route=routes.classify(url)
+            ),
+            response_fingerprint, category
+        )
+        self.remember_immutable_asset(immutable_asset)
+        self.metrics.observe("discordless_witm_write_duration_seconds", time.perf_counter() - start, kind="streamed_response")
+        self.check_quota()
+
+    """
+    Returns (asset key fingerprint, Content-Length, ETag fingerprint or 0) for a complete response from an immutable CDN route,
+    or None for anything else. Only looks at headers, so it's cheap enough for the event loop.
+    """
+    def immutable_asset(self, flow):
+        if flow.request.method != "GET" or flow.response.status_code != 200 or not request_is_discord_cdn(flow.request):
+            return None
+        asset_key = routes.immutable_asset_key(flow.request.pretty_url)
+        content_length = flow.response.headers.get("content-length", "")
+        if asset_key is None or not content_length.isdigit():
+            return None
+        etag = flow.response.headers.get("etag")
+        return fingerprint(asset_key), int(content_length), fingerprint(etag) if etag else 0
+
+    def remember_immutable_asset(self, immutable_asset):
+        if immutable_asset is not None:
+            with self.assets_lock:
+                self.immutable_assets.add(*immutable_asset)
+
+    """
+    Remember where a complete response from an immutable CDN route is, for witm_serve_archived_assets.
+    """
+    def remember_asset_location(self, entry):
+        if entry.status != 200 or entry.superseded or entry.get_route().tag not in routes.IMMUTABLE_TAGS:
+            return
+        location = asset_location(entry.filename)
+        if location is not None:
+            asset_fingerprint = fingerprint(routes.immutable_asset_key(entry.url))
+            with self.assets_lock:
+                archived = self.asset_locations.get(asset_fingerprint)
+                if archived is None or archived[:4] == NO_LOCATION:
+                    self.asset_locations.replace(asset_fingerprint, *location, self.asset_media_types.number(entry.content_type))
+
+    """
+    Remember that a page of older messages is archived, for LoadShedder.
+    """
+    def remember_archived_page(self, entry):
+        if entry.get_route().tag == "channel_messages" and entry.is_success() and entry.has_content() and "before" in parse_qs(urlparse(entry.url).query):
+            with self.archived_pages_lock:
+                self.archived_pages.add(fingerprint(entry.url))
+
+    def is_archived_page(self, url):
+        with self.archived_pages_lock:
+            return fingerprint(url) in self.archived_pages
+
+    """
+    Remember an archived response if it's the best variant of its asset so far, for witm_supersede_variants.
+    """
+    def remember_asset_variant(self, entry):
+        variant = entry_variant(entry)
+        if variant is None or entry.superseded:
+            return
+        location = asset_location(entry.filename)
+        if location is None:
+            return
+        identity, score = variant
+        identity_fingerprint = fingerprint(identity)
+        with self.assets_lock:
+            best = self.asset_variants.get(identity_fingerprint)
+            if best is None or score > best[0]:
+                self.asset_variants.replace(identity_fingerprint, score, *location)
+
+    """
+    Returns the filename of an archived variant of a url's asset that's better than the url's, or None if there isn't one.
+    """
+    def better_variant_filename(self, url, route):
+        variant = asset_variant(url, route.tag)
+        if variant is None:
+            return None
+        identity, score = variant
+        with self.assets_lock:
+            best = self.asset_variants.get(fingerprint(identity))
+        if best is None or best[0] <= score:
+            return None
+        return asset_filename(best[1:], url)
+
+    def index_response(self, entry, response_fingerprint, category):
+        self.request_index_file.write(entry.format())
+        self.recorded_responses.add(response_fingerprint)
+        self.remember_asset_location(entry)
+        self.remember_asset_variant(entry)
+        self.remember_archived_page(entry)
+        self.metrics.count("discordless_witm_responses_archived_total", category=category)
+
+    """
+    Tee-stream big Discord CDN downloads (attachments, videos) instead of letting mitmproxy buffer the whole body,
+    so the proxy's memory use doesn't grow with the biggest attachment anyone opens.
+    Needs a Content-Length to know the size up front, and only handles unencoded, complete (200) responses,
+    since we archive decoded contents. Everything else is buffered and archived by the response hook as usual.
+    """
+    @timed_hook("responseheaders")
+    def responseheaders(self, flow):
+        if flow.metadata.get("witm_served_from_archive"):
+            return
+        if request_is_discord(flow.request) and self.policy_action(flow) != "allow":
+            flow.response.stream = True # no need to buffer what we won't store
+            return
+        if self.load_shedder.enabled() and request_is_discord(flow.request) and self.shed(flow):
+            return
+        immutable_asset = self.immutable_asset(flow) if self.pass_archived_assets or self.tee_stream_size else None
+        if self.pass_archived_assets and immutable_asset is not None and self.is_archived_asset(*immutable_asset):
+            log_info(f"Already have {flow.request.pretty_url}; streaming it through.")
+            flow.response.stream = True
+            self.metrics.count("discordless_witm_responses_passed_through_total", category=url_category(flow.request.pretty_url))
+            return
+        if not self.tee_stream_size:
+            return
+        url = flow.request.pretty_url
+        if not request_is_discord_cdn(flow.request) or flow.response.status_code != 200:
+            return
+        content_length = flow.response.headers.get("content-length", "")
+        if not content_length.isdigit() or int(content_length) < self.tee_stream_size:
+            return
+        if flow.response.headers.get("content-encoding", "identity").lower() != "identity":
+            return
+        log_info(f"Tee-streaming {content_length} byte download {url}.")
+        flow.response.stream = TeeStream(
+            self, flow.response.timestamp_start, flow.request.method, url, flow.response.headers.get("content-type", ""), immutable_asset
+        )
+
+    """
+    Stream a response straight through without archiving it, if the writer is far enough behind that it's worth shedding.
+    Returns whether it was shed.
+    """
+    def shed(self, flow):
+        level = self.load_shedder.level(self.writer)
+        if level != self.shed_level:
+            log_info(f"Writer is {'behind' if level else 'caught up'}; load shedding level is now {level}.")
+            self.shed_level = level
+            self.metrics.set("discordless_witm_shed_level", level)
+        if not level:
+            return False
+        url = flow.request.pretty_url
+        reason = self.load_shedder.shed_reason(level, url, self.is_archived_page)
+        if reason is None:
+            return False
+        log_info(f"Shedding {url} ({reason}) without archiving it.")
+        flow.response.stream = True
+        flow.metadata["witm_shed"] = reason
+        self.metrics.count("discordless_witm_responses_shed_total", reason=reason)
+        return True
+
+    """
+    Whether an immutable asset is archived with the same size, and the same ETag if both have one.
+    """
+    def is_archived_asset(self, asset_fingerprint, content_length, etag_fingerprint):
+        with self.assets_lock:
+            archived = self.immutable_assets.get(asset_fingerprint)
+        if archived is None:
+            return False
+        archived_size, archived_etag_fingerprint = archived
+        if archived_etag_fingerprint and etag_fingerprint and archived_etag_fingerprint != etag_fingerprint:
+            return False
+        return archived_size == content_length
+
+    def error(self, flow):
+        if flow.response and isinstance(flow.response.stream, TeeStream):
+            flow.response.stream.abort()
+
+    """
+    With witm_serve_archived_assets, answer requests for archived immutable CDN assets from the archive.
+    The contents are read on a worker thread, so big attachments don't hold up the event loop.
+    Anything we can't answer completely (misses, Range requests, unreadable contents) goes to Discord as usual.
+    """
+    @timed_hook("request")
+    async def request(self, flow):
+        if not self.serve_archived_assets or flow.request.method != "GET" or not request_is_discord_cdn(flow.request):
+            return
+        if "range" in flow.request.headers:
+            return
+        url = flow.request.pretty_url
+        asset_key = routes.immutable_asset_key(url)
+        if asset_key is None:
+            return
+        with self.assets_lock:
+            archived = self.asset_locations.get(fingerprint(asset_key))
+            recorded_media_type = self.asset_media_types.media_type(archived[4]) if archived is not None else None
+        if archived is None or archived[:4] == NO_LOCATION:
+            return
+        content = await asyncio.to_thread(self.read_archived_asset, asset_filename(archived[:4], url))
+        if content is None:
+            return
+        log_info(f"Serving {url} from the archive.")
+        flow.response = http.Response.make(200, content, {
+            "content-type": recorded_media_type or sniff_media_type(content, url), # sniffed only for responses that had none
+            "access-control-allow-origin": "*", # like Discord's CDN, so the web client can fetch() it
+        })
+        flow.metadata["witm_served_from_archive"] = True
+        self.metrics.count("discordless_witm_responses_served_total", category=url_category(url))
+
+    """
+    Returns an archived asset's contents, or None if they can't be read. Runs on a worker thread,
+    so it uses a ResponseStore of its own.
+    """
+    def read_archived_asset(self, filename):
+        store = storage.ResponseStore(self.archive_path)
+        try:
+            return store.read(filename)
+        except (OSError, ValueError, RuntimeError) as e:
+            log_info(f"Couldn't read archived {filename}: {e!r}")
+            return None
+        finally:
+            store.close()
 
     """
-    Select which requests should be "streamed".
+    Decide what the capture policy wants done with each request's response,
+    and select which requests should be "streamed".
     "Streaming" the request makes it sorta bypass the MitM,
     improving performance for large requests but preventing us from reading the contents.
     We only do this with file uploads, since they tend to break otherwise and often get re-downloaded anyway.
     """
+    @timed_hook("requestheaders")
     def requestheaders(self, flow):
-        if not url_has_discord_root_domain(flow.request.pretty_url):
+        if not request_is_discord(flow.request):
             return
+        if time.monotonic() - self.capture_policy_checked >= CAPTURE_POLICY_CHECK_INTERVAL:
+            self.reload_capture_policy()
+        flow.metadata["witm_capture_policy"] = self.capture_policy_action(flow.request)
         if flow.request.method == "POST" and flow.request.pretty_url.endswith("/attachments"):
             log_info("Streaming attachment upload.")
             flow.request.stream = True
     
     def done(self):
             log_info("Closing files.")
+            if self.eviction_planner:
+                self.eviction_planner.close()
+            self.writer.close() # finish any queued writes before closing their files
+            if self.archive_size is not None:
+                self.save_archive_size()
+            if self.group_committer:
+                self.group_committer.close()
+            if self.metrics_server:
+                self.metrics_server.close()
+            if self.metrics_file_writer:
+                self.metrics_file_writer.close()
             self.request_index_file.close()
             self.gateway_index_file.close()
+            self.recorded_responses.close()
+            self.immutable_assets.close()
+            self.asset_locations.close()
+            self.asset_variants.close()
+            self.archived_pages.close()
+            if self.pack_writer:
+                self.pack_writer.close()
+            if self.packed_contents is not None:
+                self.packed_contents.close()
+            if self.message_pack_writer:
+                self.message_pack_writer.close()
+            if self.message_blobs is not None:
+                self.message_blobs.close()
+            if self.message_ingester:
+                self.message_ingester.close()
             for gatekeeper in self.gatekeepers.values():
                 gatekeeper.done()
 